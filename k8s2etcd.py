@@ -25,7 +25,7 @@ import time
 import logging
 import requests
 from datetime import datetime
-from websocket import create_connection
+from websocket import create_connection, WebSocketTimeoutException
 
 logger = logging.getLogger()
 
@@ -33,6 +33,15 @@ attempts = 3
 attempt_timeout = 1
 index_file = '/var/lib/kuberdock/k8s2etcd_resourceVersion'
 loop_timeout = 0.2
+# Events are put to etcd in batches of up to batch_size events, a batch is
+# sent not later than batch_interval seconds after its first event
+batch_size = 50
+batch_interval = 0.2
+# resourceVersion is saved to index_file not more often than once in
+# checkpoint_interval seconds (after a batch has been put to etcd)
+checkpoint_interval = 5
+# How often throughput counters are written to the log
+stats_interval = 60
 
 watch_url = 'ws://127.0.0.1:8080/api/v1/pods?watch=true&resourceVersion={}'
 list_url = 'http://127.0.0.1:8080/api/v1/pods'
@@ -62,20 +71,88 @@ def prelist():
         raise Exception("Error during pre list resource version")
 
 
-def process(content):
-    """ Put content to etcd with timestamp as key """
-    ts = str((datetime.utcnow() - datetime.fromtimestamp(0)).total_seconds())
+def now_ts():
+    return (datetime.utcnow() - datetime.fromtimestamp(0)).total_seconds()
+
+
+def put(key, value):
     for i in range(attempts):
         try:
-            requests.put('/'.join([etcd_url, ts]), data={'value': content})
-            break
+            requests.put('/'.join([etcd_url, key]), data={'value': value})
+            return True
         except:
-            logger.exception("{}: Can't process event {}".format(i, content))
+            logger.exception("{}: Can't put {}".format(i, value))
             time.sleep(attempt_timeout)
-    else:
-        logger.error("Can't process event {}, skipping...".format(content))
-
-
+    logger.error("Can't put {}, skipping...".format(value))
+    return False
+
+
+class Relay(object):
+    """Collects watch events and puts them to etcd in batches.
+
+    A batch is stored in one key as {"batch": [[timestamp, event], ...]},
+    so the consumer (kubedock.listeners.process_records) reads and deletes
+    it with one request.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.first_event_at = None
+        self.resource_version = None
+        self.last_checkpoint = 0
+        self.counters = {'events': 0, 'batches': 0, 'errors': 0}
+        self.last_stats = time.time()
+
+    def timeout(self):
+        """Seconds the reader may wait for the next event."""
+        if not self.events:
+            return None
+        return max(0, self.first_event_at + batch_interval - time.time())
+
+    def add(self, content, resource_version):
+        if not self.events:
+            self.first_event_at = time.time()
+        self.events.append([str(now_ts()), content])
+        self.resource_version = resource_version
+        # after a failed put wait for batch_interval before the next try
+        if len(self.events) >= batch_size and not self.timeout():
+            self.flush()
+
+    def flush(self):
+        if self.events:
+            if not put(self.events[0][0], json.dumps({'batch': self.events})):
+                # keep the batch and retry it later, resourceVersion must
+                # not pass events which are not stored yet
+                self.counters['errors'] += 1
+                self.first_event_at = time.time()
+                self.log_stats()
+                return
+            self.counters['events'] += len(self.events)
+            self.counters['batches'] += 1
+            self.events = []
+        self.checkpoint()
+        self.log_stats()
+
+    def checkpoint(self, force=False):
+        if self.resource_version is None or self.events:
+            return
+        now = time.time()
+        if force or now - self.last_checkpoint >= checkpoint_interval:
+            logger.debug("new resourceVersion {}".format(
+                self.resource_version))
+            store(self.resource_version)
+            self.last_checkpoint = now
+
+    def log_stats(self):
+        now = time.time()
+        if now - self.last_stats >= stats_interval:
+            logger.info('relayed {events} events in {batches} batches, '
+                        '{errors} puts failed'.format(**self.counters))
+            self.counters = dict.fromkeys(self.counters, 0)
+            self.last_stats = now
+
+
+relay = Relay()
 resourceVersion = get()
 while True:
     try:
@@ -86,18 +163,26 @@ while True:
         logger.info("start watch from {}".format(resourceVersion))
         ws = create_connection(watch_url.format(resourceVersion))
         while True:
-            content = ws.recv()
+            ws.settimeout(relay.timeout())
+            try:
+                content = ws.recv()
+            except WebSocketTimeoutException:
+                relay.flush()
+                continue
             data = json.loads(content)
             if (data['type'].lower() == 'error' and
                     '401' in data['object']['message']):
+                relay.flush()
                 resourceVersion = None
                 break
-            process(content)
             resourceVersion = data['object']['metadata']['resourceVersion']
-            logger.debug("new resourceVersion {}".format(resourceVersion))
-            store(resourceVersion)
+            relay.add(content, resourceVersion)
     except KeyboardInterrupt:
+        relay.flush()
+        relay.checkpoint(force=True)
         break
     except Exception as e:
         logger.exception('restarting')
+        relay.flush()
+        relay.checkpoint(force=True)
         time.sleep(loop_timeout)
@@ -80,11 +80,12 @@ def create_app(settings_override=None, fake_sessions=False):
     from .domains import domains
     from .allowed_ports import allowed_ports
     from .restricted_ports import restricted_ports
+    from .debug import debug
 
     for bp in (images, stream, nodes, stats, users, yamlapi,
                usage, pricing, ippool, settings, podapi, auth,
                pstorage, predefined_apps, logs, hosts, billing, domains,
-               allowed_ports, restricted_ports):
+               allowed_ports, restricted_ports, debug):
         app.register_blueprint(bp)
 
     app.errorhandler(404)(on_404)
@@ -0,0 +1,59 @@
+# KuberDock - is a platform that allows users to run applications using Docker
+# container images and create SaaS / PaaS based on these applications.
+# Copyright (C) 2017 Cloud Linux INC
+#
+# This file is part of KuberDock.
+#
+# KuberDock is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# KuberDock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
+
+from flask import Blueprint
+
+from kubedock.core import ConnectionPool, EvtHub
+from kubedock.exceptions import PermissionDenied
+from kubedock.kapi.helpers import KubeQuery
+from kubedock.kubedata import kubestat
+from kubedock.login import auth_required
+from kubedock.utils import KubeUtils
+
+debug = Blueprint('debug', __name__, url_prefix='/debug')
+
+
+@debug.route('/k8s-requests', methods=['GET'])
+@auth_required
+@KubeUtils.jsonwrap
+def k8s_requests():
+    """Metrics of requests to k8s API sent by current process."""
+    if not KubeUtils.get_current_user().is_administrator():
+        raise PermissionDenied
+    return KubeQuery.metrics.snapshot()
+
+
+@debug.route('/sse-streams', methods=['GET'])
+@auth_required
+@KubeUtils.jsonwrap
+def sse_streams():
+    """Subscribers and queue depth of SSE streams in current process."""
+    if not KubeUtils.get_current_user().is_administrator():
+        raise PermissionDenied
+    return EvtHub.get(ConnectionPool.get_connection()).stats()
+
+
+@debug.route('/stats-cache', methods=['GET'])
+@auth_required
+@KubeUtils.jsonwrap
+def stats_cache():
+    """Hits and misses of InfluxDB queries cache in all processes."""
+    if not KubeUtils.get_current_user().is_administrator():
+        raise PermissionDenied
+    return kubestat.get_cache_counters()
@@ -18,7 +18,7 @@
 # You should have received a copy of the GNU General Public License
 # along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
 
-from flask import Blueprint, current_app, request
+from flask import Blueprint, current_app, jsonify, request
 from flask.views import MethodView
 
 from kubedock.billing import has_billing
@@ -29,13 +29,14 @@ from ..exceptions import PermissionDenied
 from ..kapi.apps import PredefinedApp
 from ..kapi.podcollection import PodCollection, PodNotFound
 from ..login import auth_required
+from ..pods import utils as pods_utils
 from ..pods.models import Pod
 from ..rbac import check_permission
 from ..system_settings.models import SystemSettings
 from ..tasks import make_backup
 from ..utils import KubeUtils, register_api, catch_error
 from ..validation import check_new_pod_data, check_change_pod_data, \
-    owner_optional_schema, owner_mandatory_schema
+    owner_optional_schema, owner_mandatory_schema, pods_list_schema
 
 podapi = Blueprint('podapi', __name__, url_prefix='/podapi')
 
@@ -58,10 +59,39 @@ class PodsAPI(KubeUtils, MethodView):
     decorators = [KubeUtils.jsonwrap, KubeUtils.pod_start_permissions,
                   auth_required]
 
-    @use_kwargs(schema)
-    def get(self, pod_id, owner=None):
+    @use_kwargs(dict(schema, **pods_list_schema))
+    def get(self, pod_id, owner=None, fields=None, **list_params):
         owner = check_owner_permissions(owner)
-        return PodCollection(owner).get(pod_id, as_json=False)
+        if pod_id is not None:
+            pods = PodCollection.for_pod(pod_id, owner, use_cache=True)
+            return select_fields(pods.get(pod_id, as_json=False), fields)
+        if not list_params and not fields:
+            return self._get_pods_list(owner)
+        pods, total = PodCollection.paginate(owner, use_cache=True,
+                                             **list_params)
+        return paginated_response(
+            select_fields(pods.get(as_json=False), fields), total)
+
+    @staticmethod
+    def _get_pods_list(owner):
+        """List of pods of the owner with ETag support. Serialized list is
+        cached until any of the owner's pods is changed.
+        """
+        version = pods_utils.get_pods_version(owner.id)
+        cached = pods_utils.get_cached_pods(owner.id, version)
+        if cached is not None:
+            etag, data = cached
+        else:
+            # Not from informers: the version is bumped by the listener of
+            # another process, informers of this one may not have got the
+            # change yet, and a stale list would be cached as the new version
+            data = PodCollection(owner).get(as_json=True)
+            etag = pods_utils.cache_pods(owner.id, version, data)
+        response = current_app.response_class(
+            '{{"status": "OK", "data": {0}}}'.format(data),
+            mimetype='application/json')
+        response.set_etag(etag)
+        return response.make_conditional(request)
 
     @maintenance_protected
     @catch_error(action='notify', trigger='resources')
@@ -125,7 +155,7 @@ class PodsAPI(KubeUtils, MethodView):
                 raise PermissionDenied(
                     'Direct requests are forbidden for fixed-price users.')
 
-        pods = PodCollection(owner)
+        pods = PodCollection.for_pod(pod_id, owner)
         return pods.update(pod_id, data)
 
     patch = put
@@ -134,7 +164,7 @@ class PodsAPI(KubeUtils, MethodView):
     @use_kwargs(schema)
     def delete(self, pod_id, owner=None):
         owner = check_owner_permissions(owner, 'delete')
-        pods = PodCollection(owner)
+        pods = PodCollection.for_pod(pod_id, owner)
         result = pods.delete(pod_id)
         if has_billing():
             current_billing = SystemSettings.get_by_name('billing_type')
@@ -146,13 +176,29 @@ class PodsAPI(KubeUtils, MethodView):
 register_api(podapi, PodsAPI, 'podapi', '/', 'pod_id')
 
 
+def select_fields(pods, fields=None):
+    """Leave only requested fields in pod (or list of pods)."""
+    if not fields:
+        return pods
+    if isinstance(pods, dict):
+        return {key: pods[key] for key in fields if key in pods}
+    return [select_fields(pod, fields) for pod in pods]
+
+
+def paginated_response(pods, total):
+    response = jsonify({'status': 'OK', 'data': pods})
+    response.headers['X-Total-Count'] = str(total)
+    return response
+
+
 @podapi.route('/<pod_id>/<container_name>/update', methods=['GET'])
 @auth_required
 @KubeUtils.jsonwrap
 @use_kwargs(schema)
 def check_updates(pod_id, container_name, owner=None):
     owner = check_owner_permissions(owner)
-    return PodCollection(owner).check_updates(pod_id, container_name)
+    return PodCollection.for_pod(pod_id, owner).check_updates(
+        pod_id, container_name)
 
 
 @podapi.route('/<pod_id>/<container_name>/update', methods=['POST'])
@@ -161,7 +207,8 @@ def check_updates(pod_id, container_name, owner=None):
 @use_kwargs(schema)
 def update_container(pod_id, container_name, owner=None):
     owner = check_owner_permissions(owner)
-    return PodCollection(owner).update_container(pod_id, container_name)
+    return PodCollection.for_pod(pod_id, owner).update_container(
+        pod_id, container_name)
 
 
 @podapi.route('/<pod_id>/<container_name>/exec', methods=['POST'])
@@ -171,7 +218,7 @@ def update_container(pod_id, container_name, owner=None):
     'type': 'string', 'required': True, 'empty': False}))
 def exec_in_container(pod_id, container_name, owner=None, command=''):
     owner = check_owner_permissions(owner)
-    return PodCollection(owner).exec_in_container(
+    return PodCollection.for_pod(pod_id, owner).exec_in_container(
         pod_id, container_name, command)
 
 
@@ -188,7 +235,8 @@ def reset_access_container(pod_id, owner=None):
         check_permission('get', 'pods').check()
     else:
         check_permission('get_non_owned', 'pods').check()
-    return PodCollection(owner).reset_direct_access_pass(pod_id)
+    return PodCollection.for_pod(pod_id, owner).reset_direct_access_pass(
+        pod_id)
 
 
 @podapi.route('/<pod_id>/dump', methods=['GET'])
@@ -197,7 +245,7 @@ def reset_access_container(pod_id, owner=None):
 @check_permission('dump', 'pods')
 @KubeUtils.jsonwrap
 def dump(pod_id):
-    return PodCollection().dump(pod_id)
+    return PodCollection.for_pod(pod_id).dump(pod_id)
 
 
 @podapi.route('/dump', methods=['GET'])
@@ -205,9 +253,12 @@ def dump(pod_id):
 @maintenance_protected
 @check_permission('dump', 'pods')
 @KubeUtils.jsonwrap
-@use_kwargs({'owner': owner_optional_schema})
-def batch_dump(owner=None):
-    return PodCollection(owner).dump()
+@use_kwargs(dict(pods_list_schema, owner=owner_optional_schema))
+def batch_dump(owner=None, fields=None, **list_params):
+    if not list_params and not fields:
+        return PodCollection(owner).dump()
+    pods, total = PodCollection.paginate(owner, **list_params)
+    return paginated_response(select_fields(pods.dump(), fields), total)
 
 
 restore_args_schema = {
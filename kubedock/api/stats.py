@@ -18,6 +18,8 @@
 # You should have received a copy of the GNU General Public License
 # along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
 
+import math
+import uuid
 from datetime import datetime, timedelta
 
 from flask import Blueprint
@@ -31,7 +33,10 @@ from kubedock.login import auth_required
 from kubedock.nodes.models import Node
 from kubedock.pods.models import Pod
 from kubedock.rbac import check_permission
+from kubedock.settings import STATS_DEFAULT_RANGE, STATS_MAX_POINTS
 from kubedock.utils import KubeUtils, NODE_STATUSES
+from kubedock.validation import pods_stats_schema, stats_range_schema
+from .utils import use_kwargs
 
 stats = Blueprint('stats', __name__, url_prefix='/stats')
 
@@ -48,9 +53,9 @@ class InternalStatsError(InternalAPIError):
 @auth_required
 @check_permission('get', 'nodes')
 @KubeUtils.jsonwrap
-def nodes(hostname):
-    end = datetime.utcnow()
-    start = end - timedelta(minutes=60)
+@use_kwargs(stats_range_schema)
+def nodes(hostname, **time_range):
+    start, end, resolution = _time_range(**time_range)
 
     node = Node.get_by_name(hostname)
     if node is None:
@@ -62,7 +67,7 @@ def nodes(hostname):
     resources = node_utils.get_one_node(node.id)['resources']
 
     if resources:
-        data = kubestat.get_node_stat(hostname, start, end)
+        data = kubestat.get_node_stat(hostname, start, end, resolution)
         cpu_capacity = float(resources.get('cpu')) * 1000
         memory_capacity = float(resources.get('memory'))
     else:
@@ -86,16 +91,63 @@ def nodes(hostname):
     return diagrams
 
 
+@stats.route('/cluster', methods=['GET'])
+@auth_required
+@check_permission('get', 'nodes')
+@KubeUtils.jsonwrap
+@use_kwargs(stats_range_schema)
+def cluster(**time_range):
+    """Total stats of all nodes, served from precomputed rollups."""
+    start, end, resolution = _time_range(**time_range)
+
+    data = kubestat.get_cluster_stat(start, end, resolution)
+    diagrams = [
+        CpuDiagram(_get_cpu_points(data)).to_dict(),
+        MemoryDiagram(_get_memory_points(data)).to_dict(),
+        NetworkDiagram(_get_network_points(data)).to_dict()
+    ]
+    return diagrams
+
+
+@stats.route('/pods', methods=['GET'])
+@auth_required
+@check_permission('get', 'pods')
+@KubeUtils.jsonwrap
+@use_kwargs(pods_stats_schema)
+def pods_batch(ids, **time_range):
+    """CPU and memory diagrams of several pods, fetched with one query.
+
+    :returns: dict pod_id -> list of diagrams
+    """
+    start, end, resolution = _time_range(**time_range)
+
+    ids = list(set(ids))
+    for pod_id in ids:
+        _check_pod_id(pod_id)
+    user = KubeUtils.get_current_user()
+    found = Pod.filter(Pod.owner_id == user.id, Pod.id.in_(ids)).count()
+    if found != len(ids):
+        raise PodNotFound
+    data = kubestat.get_pods_stat(ids, start, end, resolution)
+    return {
+        pod_id: [
+            CpuDiagram(_get_cpu_points(pod_data)).to_dict(),
+            MemoryDiagram(_get_memory_points(pod_data)).to_dict(),
+        ]
+        for pod_id, pod_data in data.iteritems()
+    }
+
+
 @stats.route('/pods/<pod_id>', methods=['GET'])
 @auth_required
 @check_permission('get', 'pods')
 @KubeUtils.jsonwrap
-def pods(pod_id):
-    end = datetime.utcnow()
-    start = end - timedelta(minutes=60)
+@use_kwargs(stats_range_schema)
+def pods(pod_id, **time_range):
+    start, end, resolution = _time_range(**time_range)
 
     _check_if_pod_exists(pod_id)
-    data = kubestat.get_pod_stat(pod_id, start, end)
+    data = kubestat.get_pod_stat(pod_id, start, end, resolution)
     diagrams = [
         CpuDiagram(_get_cpu_points(data)).to_dict(),
         MemoryDiagram(_get_memory_points(data)).to_dict(),
@@ -108,12 +160,13 @@ def pods(pod_id):
 @auth_required
 @check_permission('get', 'pods')
 @KubeUtils.jsonwrap
-def containers(pod_id, container_id):
-    end = datetime.utcnow()
-    start = end - timedelta(minutes=60)
+@use_kwargs(stats_range_schema)
+def containers(pod_id, container_id, **time_range):
+    start, end, resolution = _time_range(**time_range)
 
     _check_if_pod_exists(pod_id)
-    data = kubestat.get_container_stat(pod_id, container_id, start, end)
+    data = kubestat.get_container_stat(pod_id, container_id, start, end,
+                                       resolution)
     diagrams = [
         CpuDiagram(_get_cpu_points(data)).to_dict(),
         MemoryDiagram(_get_memory_points(data)).to_dict(),
@@ -121,6 +174,34 @@ def containers(pod_id, container_id):
     return diagrams
 
 
+def _time_range(start=None, end=None, resolution=None):
+    """Get time range and resolution (in seconds) of stats.
+
+    By default stats of the last STATS_DEFAULT_RANGE seconds are returned.
+    Longer ranges, or any range if resolution is specified, are aggregated
+    by intervals not shorter than needed to get STATS_MAX_POINTS points.
+
+    :returns: tuple (start, end, resolution or None)
+    """
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(seconds=STATS_DEFAULT_RANGE)
+    if start >= end:
+        raise APIError('Start of the time range must be earlier than its end')
+    span = (end - start).total_seconds()
+    if resolution is not None or span > STATS_DEFAULT_RANGE:
+        resolution = max(resolution or 1,
+                         int(math.ceil(span / STATS_MAX_POINTS)))
+    return start, end, resolution
+
+
+def _check_pod_id(pod_id):
+    # ids are put into InfluxDB query, so check them before querying db
+    try:
+        uuid.UUID(pod_id)
+    except ValueError:
+        raise PodNotFound
+
+
 def _check_if_pod_exists(pod_id):
     user = KubeUtils.get_current_user()
     try:
@@ -149,20 +230,31 @@ def _merge_graphs(base_graph, other_graphs, result_factory):
         It's signature -- (time, point_of_base_graph, *points_of_other_graphs).
     :return List of items that produced by `result_factory` callback.
     """
-    rv = []
-    los = [0 for _ in other_graphs]
-    for b in base_graph:
-        time = b.time
-        others = []
-        for i, other_graph in enumerate(other_graphs):
-            z = _floor(other_graph, time, los[i])
-            if z < 0:
-                others.append(None)
-            else:
-                others.append(other_graph[z])
-                los[i] = z
-        rv.append(result_factory(time, b, *others))
-    return rv
+    times = [b.time for b in base_graph]
+    aligned = [_align_graph(times, other_graph)
+               for other_graph in other_graphs]
+    return map(result_factory, times, base_graph, *aligned)
+
+
+def _align_graph(times, graph):
+    """For each time get nearest lesser-or-equal point of the graph in one
+    pass over both lists.
+
+    :param times: Sorted list of timestamps.
+    :param graph: Sorted list of `Point`.
+    :return: List of `Point` (or None if there is no such point) of the same
+        length as `times`.
+    """
+    aligned = []
+    append = aligned.append
+    points = iter(graph)
+    current = None
+    following = next(points, None)
+    for time in times:
+        while following is not None and following.time <= time:
+            current, following = following, next(points, None)
+        append(current)
+    return aligned
 
 
 def _get_cpu_points(data, cpu_limit=None):
@@ -302,22 +394,3 @@ class FsDiagram(Diagram):
     ylabel = 'GB'
     series = [{'label': 'available'}, {'label': 'used', 'fill': True}]
     series_colors = ['#4bb2c5', '#ff5800']
-
-
-def _floor(a_list, x_time, lo=0, hi=None):
-    """
-    Find nearest lesser-or-equal point.
-    :param a_list: Sorted list of `Point`. Point must have field 'time'.
-    :param x_time: Time to search.
-    :param lo: Index of point in list from which search will be started.
-    :param hi: Index of point in list on which search will be finished.
-    :return: Index of nearest lesser-or-equal point or -1 if timestamp of
-        first point of list is greater then `x_time`.
-    """
-    if lo < 0:
-        raise ValueError('lo must be non-negative')
-    if hi is None:
-        hi = len(a_list)
-    while lo < hi and x_time >= a_list[lo].time:
-        lo += 1
-    return lo - 1
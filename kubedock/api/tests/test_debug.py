@@ -0,0 +1,65 @@
+
+# KuberDock - is a platform that allows users to run applications using Docker
+# container images and create SaaS / PaaS based on these applications.
+# Copyright (C) 2017 Cloud Linux INC
+#
+# This file is part of KuberDock.
+#
+# KuberDock is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# KuberDock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
+
+import mock
+
+from kubedock.testutils.testcases import APITestCase
+
+
+class TestDebug(APITestCase):
+    url = '/debug/k8s-requests'
+
+    @mock.patch('kubedock.api.debug.KubeQuery.metrics')
+    def test_k8s_requests(self, metrics_mock):
+        metrics_mock.snapshot.return_value = [{'resource': 'pods'}]
+        response = self.admin_open(self.url)
+        self.assert200(response)
+        self.assertEqual(response.json['data'], [{'resource': 'pods'}])
+
+    def test_admin_only(self):
+        self.assert403(self.user_open(self.url))
+
+
+class TestDebugSSEStreams(APITestCase):
+    url = '/debug/sse-streams'
+
+    @mock.patch('kubedock.api.debug.EvtHub.get')
+    def test_sse_streams(self, get_hub_mock):
+        get_hub_mock.return_value.stats.return_value = {'subscribers': 3}
+        response = self.admin_open(self.url)
+        self.assert200(response)
+        self.assertEqual(response.json['data'], {'subscribers': 3})
+
+    def test_admin_only(self):
+        self.assert403(self.user_open(self.url))
+
+
+class TestDebugStatsCache(APITestCase):
+    url = '/debug/stats-cache'
+
+    @mock.patch('kubedock.api.debug.kubestat.get_cache_counters')
+    def test_stats_cache(self, counters_mock):
+        counters_mock.return_value = {'hits': 5, 'misses': 2}
+        response = self.admin_open(self.url)
+        self.assert200(response)
+        self.assertEqual(response.json['data'], {'hits': 5, 'misses': 2})
+
+    def test_admin_only(self):
+        self.assert403(self.user_open(self.url))
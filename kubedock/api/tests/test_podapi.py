@@ -25,6 +25,7 @@ from uuid import uuid4
 import mock
 
 from kubedock.kapi.podcollection import PodNotFound, PodCollection, KubeQuery
+from kubedock.pods.utils import bump_pods_version
 from kubedock.system_settings.models import SystemSettings
 from kubedock.testutils.testcases import APITestCase
 
@@ -54,7 +55,7 @@ class PodAPIUrl(object):
 class TestPodAPI(APITestCase):
     @mock.patch('kubedock.api.podapi.PodCollection')
     def test_get_not_found(self, PodCollection):
-        PodCollection().get.side_effect = PodNotFound()
+        PodCollection.for_pod().get.side_effect = PodNotFound()
 
         response = self.user_open(PodAPIUrl.get(12345), 'GET')
 
@@ -115,7 +116,7 @@ class TestPodAPI(APITestCase):
 
     @mock.patch('kubedock.api.podapi.PodCollection')
     def test_delete_not_found(self, PodCollection):
-        PodCollection().delete.side_effect = PodNotFound()
+        PodCollection.for_pod().delete.side_effect = PodNotFound()
 
         response = self.user_open(PodAPIUrl.delete(123), 'DELETE', {})
 
@@ -124,7 +125,7 @@ class TestPodAPI(APITestCase):
     @mock.patch('kubedock.api.podapi.PodCollection')
     def test_delete(self, PodCollection):
         delete_id = randint(1, 1000)
-        PodCollection().delete.return_value = delete_id
+        PodCollection.for_pod().delete.return_value = delete_id
 
         response = self.user_open(PodAPIUrl.delete(delete_id), 'DELETE', {})
 
@@ -132,7 +133,7 @@ class TestPodAPI(APITestCase):
 
     @mock.patch('kubedock.api.podapi.PodCollection')
     def test_check_updates(self, PodCollection):
-        PodCollection().check_updates.return_value = False
+        PodCollection.for_pod().check_updates.return_value = False
 
         pod_id = str(uuid4())
         container_name = 'just name'
@@ -142,12 +143,12 @@ class TestPodAPI(APITestCase):
 
         self.assert200(response)
 
-        PodCollection().check_updates.assert_called_once_with(
+        PodCollection.for_pod().check_updates.assert_called_once_with(
             pod_id, container_name)
 
     @mock.patch('kubedock.api.podapi.PodCollection')
     def test_update_container(self, PodCollection):
-        PodCollection().update_container.return_value = {}
+        PodCollection.for_pod().update_container.return_value = {}
 
         pod_id = str(uuid4())
         container_name = 'just name'
@@ -157,7 +158,7 @@ class TestPodAPI(APITestCase):
 
         self.assert200(response)
 
-        PodCollection().update_container.assert_called_once_with(
+        PodCollection.for_pod().update_container.assert_called_once_with(
             pod_id, container_name)
 
     @mock.patch.object(PodCollection, 'stop_unpaid', return_value=None)
@@ -178,5 +179,80 @@ class TestPodAPI(APITestCase):
         assert _stop_unpaid.call_args[0][0].id == pod.id
 
 
+class TestPodAPIPagination(APITestCase):
+    url = PodAPIUrl.post()
+
+    @mock.patch('kubedock.api.podapi.PodCollection')
+    def test_page(self, PodCollection):
+        pods = [{'id': str(i), 'name': 'pod{0}'.format(i), 'status': 'running',
+                 'containers': []} for i in range(2)]
+        PodCollection.paginate.return_value = (PodCollection(), 10)
+        PodCollection().get.return_value = pods
+
+        response = self.user_open(query_string={
+            'limit': '2', 'offset': '4', 'sort': '-name',
+            'status': 'running,pending', 'fields': 'id,name'})
+        self.assert200(response)
+        self.assertEqual(response.json['data'],
+                         [{'id': '0', 'name': 'pod0'},
+                          {'id': '1', 'name': 'pod1'}])
+        self.assertEqual(response.headers['X-Total-Count'], '10')
+        PodCollection.paginate.assert_called_with(
+            mock.ANY, use_cache=True, limit=2, offset=4, sort='-name',
+            status=['running', 'pending'])
+
+    def test_invalid_params(self):
+        response = self.user_open(query_string={
+            'limit': '0', 'sort': 'kubes', 'status': 'running,unknown'})
+        self.assertAPIError(response, 400, 'ValidationError', mock.ANY)
+
+    @mock.patch('kubedock.api.podapi.PodCollection')
+    def test_dump_page(self, PodCollection):
+        PodCollection.paginate.return_value = (PodCollection(), 3)
+        PodCollection().dump.return_value = [{'pod_data': {}, 'k8s': {}}]
+
+        response = self.admin_open('/podapi/dump', query_string={
+            'limit': '1', 'fields': 'pod_data'})
+        self.assert200(response)
+        self.assertEqual(response.json['data'], [{'pod_data': {}}])
+        PodCollection.paginate.assert_called_with(None, limit=1)
+
+
+class TestPodAPIListCache(APITestCase):
+    url = PodAPIUrl.post()
+
+    def setUp(self):
+        # start from a version which has never been cached
+        bump_pods_version(self.user.id)
+
+    def _open(self, etag=None):
+        headers = {} if etag is None else {'If-None-Match': etag}
+        return self.open(auth=self.userauth, headers=headers)
+
+    @mock.patch('kubedock.api.podapi.PodCollection')
+    def test_etag(self, PodCollection):
+        PodCollection().get.return_value = '[{"id": "1"}]'
+        PodCollection.reset_mock()
+
+        response = self._open()
+        self.assert200(response)
+        self.assertEqual(response.json['data'], [{'id': '1'}])
+        etag = response.headers['ETag']
+
+        # not changed -- served from cache
+        self.assertStatus(self._open(etag), 304)
+        self.assert200(self._open())
+        self.assertEqual(PodCollection.call_count, 1)
+        PodCollection.assert_called_once_with(mock.ANY)
+
+        # pods changed
+        bump_pods_version(self.user.id)
+        PodCollection().get.return_value = '[{"id": "2"}]'
+        response = self._open(etag)
+        self.assert200(response)
+        self.assertEqual(response.json['data'], [{'id': '2'}])
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+
 if __name__ == '__main__':
     unittest.main()
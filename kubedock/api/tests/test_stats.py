@@ -0,0 +1,289 @@
+
+# KuberDock - is a platform that allows users to run applications using Docker
+# container images and create SaaS / PaaS based on these applications.
+# Copyright (C) 2017 Cloud Linux INC
+#
+# This file is part of KuberDock.
+#
+# KuberDock is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# KuberDock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from datetime import datetime, timedelta
+
+import mock
+
+from kubedock.api import stats
+from kubedock.exceptions import APIError
+from kubedock.kubedata import kubestat
+from kubedock.testutils.testcases import APITestCase
+
+
+class TestTimeRange(unittest.TestCase):
+    def test_default_range_is_not_aggregated(self):
+        start, end, resolution = stats._time_range()
+        self.assertEqual((end - start).total_seconds(),
+                         stats.STATS_DEFAULT_RANGE)
+        self.assertIsNone(resolution)
+
+    def test_resolution(self):
+        end = datetime(2017, 1, 2)
+        start = end - timedelta(days=1)
+        self.assertEqual(stats._time_range(start, end)[2],
+                         24 * 60 * 60 / stats.STATS_MAX_POINTS)
+        self.assertEqual(stats._time_range(start, end, 3600)[2], 3600)
+        # too many points
+        self.assertEqual(stats._time_range(start, end, 1)[2],
+                         24 * 60 * 60 / stats.STATS_MAX_POINTS)
+
+    def test_invalid_range(self):
+        with self.assertRaises(APIError):
+            stats._time_range(datetime(2017, 1, 2), datetime(2017, 1, 1))
+
+
+class TestMergeGraphs(unittest.TestCase):
+    def test_merge(self):
+        base = [kubestat.Point(t, t) for t in (10, 20, 30, 40)]
+        other = [kubestat.Point(t, -t) for t in (15, 20, 35)]
+
+        def factory(time, point, other_point):
+            return time, other_point and other_point.value
+
+        self.assertEqual(stats._merge_graphs(base, [other], factory),
+                         [(10, None), (20, -20), (30, -20), (40, -35)])
+        self.assertEqual(stats._merge_graphs(base, [[]], factory),
+                         [(t, None) for t in (10, 20, 30, 40)])
+        self.assertEqual(stats._merge_graphs([], [other], factory), [])
+
+
+class TestQueryBuilder(unittest.TestCase):
+    start = datetime(2017, 1, 1)
+    end = datetime(2017, 1, 2)
+
+    def test_raw_points(self):
+        query = kubestat.QueryBuilder(self.start, self.end).start_new() \
+            .with_selector(kubestat.FsUsageSelector) \
+            .with_filter(kubestat.node_filter('node1')).build()
+        self.assertEqual(
+            query,
+            'select value from "filesystem/usage" '
+            "where nodename = 'node1' and type = 'node' "
+            "and time >= '2017-01-01 00:00:00' "
+            "and time <= '2017-01-02 00:00:00' "
+            'group by "resource_id" order by time asc;')
+
+    def test_aggregated_points(self):
+        builder = kubestat.QueryBuilder(self.start, self.end, 300)
+        query = builder.start_new() \
+            .with_selector(kubestat.FsLimitSelector) \
+            .with_filter(kubestat.node_filter('node1')).build()
+        self.assertEqual(
+            query,
+            'select max("value") as "value" from "filesystem/limit" '
+            "where nodename = 'node1' and type = 'node' "
+            "and time >= '2017-01-01 00:00:00' "
+            "and time <= '2017-01-02 00:00:00' "
+            'group by time(300s), "resource_id" fill(none) '
+            'order by time asc;')
+        query = builder.start_new() \
+            .with_selector(kubestat.CpuUsageSelector) \
+            .with_filter(kubestat.pod_filter('pod1')).build()
+        self.assertIn('select mean("value") as "value" ', query)
+        self.assertIn('group by time(300s) fill(none) ', query)
+
+    @mock.patch.object(kubestat, '_query')
+    def test_get_pod_stat(self, query_mock):
+        query_mock.return_value = {'results': [{}] * 6}
+        kubestat.get_pod_stat('pod1', self.start, self.end, 60)
+        self.assertEqual(query_mock.call_args[0][0].count('time(60s)'), 6)
+
+    def test_range_is_aligned(self):
+        a = kubestat.QueryBuilder(datetime(2017, 1, 1, 0, 0, 1),
+                                  datetime(2017, 1, 1, 1, 0, 59, 999))
+        b = kubestat.QueryBuilder(datetime(2017, 1, 1, 0, 0, 59),
+                                  datetime(2017, 1, 1, 1, 0, 0))
+        for builder in (a, b):
+            builder.start_new().with_selector(kubestat.CpuUsageSelector) \
+                .with_filter(kubestat.pod_filter('pod1'))
+        self.assertEqual(a.build(), b.build())
+        self.assertIn("time >= '2017-01-01 00:00:00'", a.build())
+        self.assertIn("time <= '2017-01-01 01:00:00'", a.build())
+
+    @mock.patch.object(kubestat, '_query')
+    def test_get_pods_stat(self, query_mock):
+        query_mock.return_value = {'results': [
+            {'series': [
+                {'tags': {'namespace_name': 'pod1'}, 'values': [[1, 10]]},
+                {'tags': {'namespace_name': 'pod2'}, 'values': [[1, 20]]},
+            ]},
+            {}, {}, {},
+        ]}
+        data = kubestat.get_pods_stat(['pod1', 'pod2', 'pod3'],
+                                      self.start, self.end)
+        query = query_mock.call_args[0][0]
+        self.assertEqual(query.count('namespace_name =~ /^(pod1|pod2|pod3)$/'),
+                         4)
+        self.assertEqual(query.count('group by "namespace_name"'), 4)
+        self.assertEqual(query_mock.call_count, 1)
+        self.assertEqual(data['pod1']['cpu/request'][0].value, 10)
+        self.assertEqual(data['pod2']['cpu/request'][0].value, 20)
+        self.assertEqual(data['pod3']['cpu/request'], [])
+        self.assertEqual(data['pod1']['memory/usage'], [])
+
+
+class TestClusterStat(unittest.TestCase):
+    start = datetime(2017, 1, 1)
+    end = datetime(2017, 1, 1, 0, 5)
+
+    @mock.patch.object(kubestat, '_write')
+    @mock.patch.object(kubestat, '_query')
+    def test_rollup(self, query_mock, write_mock):
+        results = [{}] * len(kubestat.CLUSTER_SELECTORS)
+        results[1] = {'series': [
+            {'tags': {'nodename': 'node1'},
+             'values': [['2017-01-01T00:00:00Z', 100],
+                        ['2017-01-01T00:01:00Z', 200]]},
+            {'tags': {'nodename': 'node2'},
+             'values': [['2017-01-01T00:01:00Z', 50]]},
+        ]}
+        query_mock.return_value = {'results': results}
+        self.assertEqual(
+            kubestat.rollup_cluster_stat(self.start, self.end, 60), 2)
+        query_str = query_mock.call_args[0][0]
+        self.assertEqual(query_str.count('group by time(60s), "nodename"'),
+                         len(kubestat.CLUSTER_SELECTORS))
+        self.assertEqual(query_mock.call_args[1], {'cache': False})
+        write_mock.assert_called_once_with([
+            'cluster/cpu/usage_rate,resolution=60 value=100.0 1483228800',
+            'cluster/cpu/usage_rate,resolution=60 value=250.0 1483228860',
+        ])
+
+    @mock.patch.object(kubestat, '_write')
+    @mock.patch.object(kubestat, '_query')
+    def test_rollup_no_data(self, query_mock, write_mock):
+        query_mock.return_value = {
+            'results': [{}] * len(kubestat.CLUSTER_SELECTORS)}
+        self.assertEqual(
+            kubestat.rollup_cluster_stat(self.start, self.end, 60), 0)
+        self.assertFalse(write_mock.called)
+
+    @mock.patch.object(kubestat, '_query')
+    def test_get_cluster_stat(self, query_mock):
+        query_mock.return_value = {
+            'results': [{}] * len(kubestat.CLUSTER_SELECTORS)}
+        for resolution, rollup, group_by in (
+                (None, 60, None), (60, 60, None), (600, 60, 'time(600s)'),
+                (3600, 3600, None), (7200, 3600, 'time(7200s)')):
+            data = kubestat.get_cluster_stat(self.start, self.end, resolution)
+            query_str = query_mock.call_args[0][0]
+            self.assertIn('from "cluster/memory/usage" '
+                          "where resolution = '%d' " % rollup, query_str)
+            if group_by is None:
+                self.assertNotIn('group by', query_str)
+            else:
+                self.assertIn(group_by, query_str)
+            self.assertEqual(data['memory/usage'], [])
+
+
+@mock.patch.object(kubestat, '_fetch')
+@mock.patch.object(kubestat, 'ConnectionPool')
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = {}
+
+    def _redis(self, pool_mock):
+        redis = pool_mock.get_connection.return_value
+        redis.get.side_effect = self.cache.get
+        redis.pipeline.return_value.setex.side_effect = \
+            lambda key, ttl, value: self.cache.__setitem__(key, value)
+        return redis
+
+    def test_cached(self, pool_mock, fetch_mock):
+        redis = self._redis(pool_mock)
+        fetch_mock.return_value = ('{"results": []}', True)
+        self.assertEqual(kubestat._query('select 1'), {'results': []})
+        self.assertEqual(kubestat._query('select 1'), {'results': []})
+        fetch_mock.assert_called_once_with('select 1')
+        redis.pipeline.return_value.hincrby.assert_called_once_with(
+            kubestat.CACHE_COUNTERS_KEY, 'misses')
+        redis.hincrby.assert_called_once_with(
+            kubestat.CACHE_COUNTERS_KEY, 'hits')
+
+        kubestat._query('select 2')
+        self.assertEqual(fetch_mock.call_count, 2)
+
+    def test_errors_are_not_cached(self, pool_mock, fetch_mock):
+        self._redis(pool_mock)
+        fetch_mock.return_value = ('{"error": "timeout"}', False)
+        kubestat._query('select 1')
+        kubestat._query('select 1')
+        self.assertEqual(fetch_mock.call_count, 2)
+
+    def test_unexpected_answer(self, pool_mock, fetch_mock):
+        self._redis(pool_mock)
+        fetch_mock.return_value = ('<html>', True)
+        with self.assertRaises(kubestat.InfluxDBUnexpectedAnswer):
+            kubestat._query('select 1')
+
+
+class TestPodsBatch(APITestCase):
+    url = '/stats/pods'
+
+    def setUp(self):
+        self.pods = [self.fixtures.pod(owner=self.user) for _ in range(2)]
+        self.ids = ','.join(pod.id for pod in self.pods)
+
+    @mock.patch.object(kubestat, 'get_pods_stat')
+    def test_get(self, get_pods_stat_mock):
+        get_pods_stat_mock.return_value = {pod.id: {} for pod in self.pods}
+        response = self.user_open(self.url, query_string={'ids': self.ids})
+        self.assert200(response)
+        get_pods_stat_mock.assert_called_once_with(
+            mock.ANY, mock.ANY, mock.ANY, None)
+        self.assertEqual(sorted(get_pods_stat_mock.call_args[0][0]),
+                         sorted(pod.id for pod in self.pods))
+        self.assertEqual(set(response.json['data']),
+                         {pod.id for pod in self.pods})
+
+    @mock.patch.object(kubestat, 'get_pods_stat')
+    def test_foreign_or_invalid_pod(self, get_pods_stat_mock):
+        other = self.fixtures.pod(owner=self.admin)
+        for ids in (self.ids + ',' + other.id, self.ids + ',/.*/'):
+            response = self.open(self.url, query_string={'ids': ids},
+                                 auth=self.userauth)
+            self.assert404(response)
+        self.assertFalse(get_pods_stat_mock.called)
+
+    def test_ids_required(self):
+        self.assert400(self.open(self.url, auth=self.userauth))
+
+
+class TestClusterAPI(APITestCase):
+    url = '/stats/cluster'
+
+    @mock.patch.object(kubestat, 'get_cluster_stat')
+    def test_get(self, get_cluster_stat_mock):
+        get_cluster_stat_mock.return_value = {
+            'cpu/usage_rate': [kubestat.Point(1, 1000)],
+            'cpu/request': [kubestat.Point(1, 2000)],
+        }
+        response = self.admin_open(self.url)
+        self.assert200(response)
+        self.assertEqual([d['title'] for d in response.json['data']],
+                         ['CPU', 'Memory', 'Network'])
+        self.assertEqual(response.json['data'][0]['points'],
+                         [[1, 200.0, 100.0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
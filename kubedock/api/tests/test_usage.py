@@ -18,17 +18,21 @@
 # You should have received a copy of the GNU General Public License
 # along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
 
+import csv
+import json
 import unittest
 from kubedock.testutils.testcases import APITestCase
 from kubedock.testutils import fixtures
 
 from uuid import uuid4
 from time import sleep
-from datetime import datetime
+from datetime import datetime, timedelta
 from ipaddress import ip_address
 
 from kubedock.validation import V
-from kubedock.usage.models import IpState, PersistentDiskState
+from kubedock.api import usage
+from kubedock.usage.models import (
+    ContainerState, IpState, PersistentDiskState, PodState)
 from kubedock.pods.models import Pod
 
 usage_per_user_schema = {
@@ -168,11 +172,88 @@ class UsageTestCase(APITestCase):
         self.assertEqual(len(data[self.user.username]['pd_usage']), 1)
         self.assertEqual(len(data[self.another_user.username]['pd_usage']), 1)
 
+    def test_export_ndjson(self):
+        for kwargs in ({'query_string': {'format': 'ndjson'}},
+                       {'headers': {'Accept': usage.NDJSON_MIMETYPE}}):
+            response = self.admin_open(**kwargs)
+            self.assert200(response)
+            self.assertEqual(response.mimetype, usage.NDJSON_MIMETYPE)
+            records = [json.loads(line)
+                       for line in response.data.splitlines()]
+            user_records = [r for r in records
+                            if r['username'] == self.user.username]
+            self.assertEqual(
+                sorted(r['type'] for r in user_records),
+                ['ip', 'ip', 'pd', 'pd'])
+
+    def test_export_csv(self):
+        response = self.admin_open(
+            self.item_url(self.another_user.username),
+            query_string={'format': 'csv'})
+        self.assert200(response)
+        self.assertEqual(response.mimetype, 'text/csv')
+        rows = list(csv.DictReader(response.data.splitlines()))
+        self.assertEqual(sorted(row['type'] for row in rows), ['ip', 'pd'])
+        self.assertEqual(rows[0]['username'], self.another_user.username)
+
+    def test_export_format_error(self):
+        response = self.admin_open(query_string={'format': 'xml'})
+        self.assertAPIError(response, 400, 'APIError')
+
     def test_date_error(self):
         response = self.admin_open(
             query_string={'date_from': '2016-01-00T00:00:00'})
         self.assertAPIError(response, 400, 'APIError')
 
 
+class TotalUsageQueriesTestCase(APITestCase):
+    """Usage of all users is computed with constant number of queries."""
+
+    def _seed(self, prefix, users_count, pods_count):
+        start = datetime(2017, 1, 1)
+        for i in range(users_count):
+            user, _ = fixtures.user_fixtures(
+                username='{0}{1}'.format(prefix, i),
+                email='{0}{1}@test.test'.format(prefix, i))
+            for j in range(pods_count):
+                pod = fixtures.pod(owner=user)
+                IpState.start(pod.id, int(ip_address(u'192.168.44.1')) + j)
+                pod_state = PodState(pod_id=pod.id, start_time=start,
+                                     kube_id=pod.kube_id)
+                self.db.session.add(pod_state)
+                for k in range(3):
+                    self.db.session.add(ContainerState(
+                        pod_state=pod_state, container_name='c1',
+                        docker_id='d{0}'.format(k), kubes=1,
+                        start_time=start + timedelta(hours=k),
+                        end_time=start + timedelta(hours=k + 1)))
+            PersistentDiskState.start(user.id, 'disk', 1)
+        self.db.session.flush()
+
+    def _count_queries(self):
+        with self.count_queries() as queries:
+            data = usage.get_users_usage(datetime(2016, 1, 1),
+                                         datetime.utcnow())
+        return data, len(queries)
+
+    def test_queries_count(self):
+        self._seed('few', 2, 1)
+        data, queries_count = self._count_queries()
+        self._seed('many', 3, 3)
+        data, queries_count_more = self._count_queries()
+        self.assertEqual(queries_count, queries_count_more)
+        self.assertLessEqual(queries_count_more, 4)
+
+        user_usage = data['many2']
+        self.assertEqual(len(user_usage['ip_usage']), 3)
+        self.assertEqual(len(user_usage['pd_usage']), 1)
+        self.assertEqual(len(user_usage['pods_usage']), 3)
+        pod_usage = user_usage['pods_usage'][0]
+        self.assertEqual(len(pod_usage['time']['c1']), 3)
+        self.assertEqual(
+            sorted(item['start'] for item in pod_usage['time']['c1']),
+            [1483228800, 1483232400, 1483236000])
+
+
 if __name__ == '__main__':
     unittest.main()
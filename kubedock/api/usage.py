@@ -18,10 +18,13 @@
 # You should have received a copy of the GNU General Public License
 # along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
 
+import csv
+import json
 from collections import defaultdict
+from cStringIO import StringIO
 from datetime import datetime
 import dateutil.parser
-from flask import Blueprint, request
+from flask import Blueprint, Response, request, stream_with_context
 import time
 
 from ..exceptions import APIError
@@ -30,7 +33,9 @@ from ..login import auth_required
 from ..utils import KubeUtils
 from ..users import User
 from ..kapi.users import UserNotFound
-from ..usage.models import ContainerState, IpState, PersistentDiskState
+from ..usage.models import (
+    ContainerState, PodState, IpState, PersistentDiskState)
+from ..pods.models import Pod
 from ..core import db
 
 
@@ -39,6 +44,14 @@ usage = Blueprint('usage', __name__, url_prefix='/usage')
 DATE_FROM = 'date_from'
 DATE_TO = 'date_to'
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+EXPORT_FORMATS = ('json', 'ndjson', 'csv')
+EXPORT_FIELDS = ('type', 'username', 'pod_id', 'pod_name', 'kube_id',
+                 'container_name', 'kubes', 'ip_address', 'pd_name', 'size',
+                 'start', 'end')
+# number of rows fetched at once from server-side cursor during export
+EXPORT_BATCH_SIZE = 1000
+
 
 @usage.route('/', methods=['GET'])
 @auth_required
@@ -46,12 +59,10 @@ DATE_TO = 'date_to'
 @KubeUtils.jsonwrap
 def get_total_usage():
     date_from, date_to = get_dates(request)
-    rv = {}
-    for user in User.query:
-        user_usage = get_user_usage(user, date_from, date_to)
-        if user_usage:
-            rv[user.username] = user_usage
-    return rv
+    export_format = get_export_format(request)
+    if export_format is not None:
+        return export_usage(date_from, date_to, export_format)
+    return get_users_usage(date_from, date_to)
 
 
 @usage.route('/<uid>', methods=['GET'])
@@ -63,7 +74,10 @@ def get_usage(uid):
     user = User.get(uid)
     if user is None:
         raise UserNotFound('User "{0}" does not exist'.format(uid))
-    return get_user_usage(user, date_from, date_to)
+    export_format = get_export_format(request)
+    if export_format is not None:
+        return export_usage(date_from, date_to, export_format, user)
+    return get_users_usage(date_from, date_to, user).get(user.username, {})
 
 
 def get_dates(request):
@@ -83,6 +97,20 @@ def get_dates(request):
     return (date_from, date_to)
 
 
+def get_export_format(request):
+    """Format of streaming export requested with `format` parameter or
+    Accept header, or None if usage must be returned as one JSON document.
+    """
+    export_format = request.args.get('format')
+    if export_format is None and \
+            request.accept_mimetypes.best == NDJSON_MIMETYPE:
+        export_format = 'ndjson'
+    if export_format is not None and export_format not in EXPORT_FORMATS:
+        raise APIError('format: must be one of {0}'.format(
+            ', '.join(EXPORT_FORMATS)))
+    return None if export_format == 'json' else export_format
+
+
 def filter_query_by_date(query, model, date_from, date_to):
     query = query.filter(
         db.or_(model.start_time.between(date_from, date_to),
@@ -91,58 +119,172 @@ def filter_query_by_date(query, model, date_from, date_to):
     return query
 
 
-def get_pod_usage(user, date_from, date_to):
-    rv = []
-    for pod in user.pods:
-        times = defaultdict(lambda: defaultdict(list))
-        query = ContainerState.query.filter(ContainerState.pod == pod)
-        query = filter_query_by_date(query, ContainerState, date_from, date_to)
-        states = query.all()
-        for state in states:
-            start = to_timestamp(state.start_time)
-            end = (int(time.time()) if state.end_time is None else
-                   to_timestamp(state.end_time))
-            times[state.pod_state.kube_id][state.container_name].append({
-                'kubes':
-                                                               state.kubes,
-                                                'start': start, 'end': end})
-        for (kube_id, time_) in times.iteritems():
-            rv.append({'id': pod.id,
-                       'name': pod.name,
-                       'kubes': pod.kubes,
-                       'kube_id': kube_id,
-                       'time': time_})
-    return rv
+def _pod_states_query(date_from, date_to, user=None):
+    query = db.session.query(
+        User.username, PodState.pod_id, PodState.kube_id,
+        ContainerState.container_name, ContainerState.kubes,
+        ContainerState.start_time, ContainerState.end_time,
+    ).select_from(ContainerState).join(PodState).join(
+        Pod, Pod.id == PodState.pod_id).join(User, User.id == Pod.owner_id)
+    query = filter_query_by_date(query, ContainerState, date_from, date_to)
+    if user is not None:
+        query = query.filter(Pod.owner_id == user.id)
+    return query
 
 
-def get_ip_states(user, date_from, date_to):
-    query = IpState.query.filter(IpState.user == user)
+def _ip_states_query(date_from, date_to, user=None):
+    query = db.session.query(User.username, IpState).join(
+        Pod, Pod.id == IpState.pod_id).join(User, User.id == Pod.owner_id)
     query = filter_query_by_date(query, IpState, date_from, date_to)
-    ip_states = query.all()
-    return [ip_state.to_dict() for ip_state in ip_states]
+    if user is not None:
+        query = query.filter(Pod.owner_id == user.id)
+    return query
 
 
-def get_pd_states(user, date_from, date_to):
-    query = PersistentDiskState.query.filter(PersistentDiskState.user == user)
+def _pd_states_query(date_from, date_to, user=None):
+    query = db.session.query(User.username, PersistentDiskState).join(
+        User, User.id == PersistentDiskState.user_id)
     query = filter_query_by_date(query, PersistentDiskState,
                                  date_from, date_to)
-    pd_states = query.all()
-    return [pd_state.to_dict(exclude=['user_id']) for pd_state in pd_states]
-
-
-def get_user_usage(user, date_from, date_to):
-    rv = {}
-    pods_usage = get_pod_usage(user, date_from, date_to)
-    if pods_usage:
-        rv['pods_usage'] = pods_usage
-    ip_usage = get_ip_states(user, date_from, date_to)
-    if ip_usage:
-        rv['ip_usage'] = ip_usage
-    pd_usage = get_pd_states(user, date_from, date_to)
-    if pd_usage:
-        rv['pd_usage'] = pd_usage
+    if user is not None:
+        query = query.filter(PersistentDiskState.user_id == user.id)
+    return query
+
+
+def get_pod_usage(date_from, date_to, user=None):
+    """Usage of pods by container states in the date range.
+
+    All states are loaded with one query, pods with the second one.
+    :returns: dict username -> list of pods usage
+    """
+    query = _pod_states_query(date_from, date_to, user)
+    now = int(time.time())
+    times = {}
+    for (username, pod_id, kube_id, container_name, kubes,
+         start_time, end_time) in query:
+        time_ = times.setdefault((username, pod_id, kube_id),
+                                 defaultdict(list))
+        time_[container_name].append({
+            'kubes': kubes,
+            'start': to_timestamp(start_time),
+            'end': now if end_time is None else to_timestamp(end_time)})
+    if not times:
+        return {}
+
+    pods = Pod.query.filter(
+        Pod.id.in_({pod_id for _, pod_id, _ in times})).all()
+    pods = {pod.id: pod for pod in pods}
+    rv = defaultdict(list)
+    for (username, pod_id, kube_id), time_ in times.iteritems():
+        pod = pods[pod_id]
+        rv[username].append({'id': pod.id,
+                             'name': pod.name,
+                             'kubes': pod.kubes,
+                             'kube_id': kube_id,
+                             'time': time_})
     return rv
 
 
+def get_ip_states(date_from, date_to, user=None):
+    """
+    :returns: dict username -> list of IP states in the date range
+    """
+    rv = defaultdict(list)
+    for username, ip_state in _ip_states_query(date_from, date_to, user):
+        rv[username].append(ip_state.to_dict())
+    return rv
+
+
+def get_pd_states(date_from, date_to, user=None):
+    """
+    :returns: dict username -> list of persistent disk states in the date
+        range
+    """
+    rv = defaultdict(list)
+    for username, pd_state in _pd_states_query(date_from, date_to, user):
+        rv[username].append(pd_state.to_dict(exclude=['user_id']))
+    return rv
+
+
+def get_users_usage(date_from, date_to, user=None):
+    """Usage of all users (or only of the `user`) in the date range.
+
+    Each kind of states is loaded with one query for all users, so the
+    number of queries does not depend on the number of users and pods.
+    :returns: dict username -> usage. Users without usage are omitted.
+    """
+    rv = defaultdict(dict)
+    for key, usage in (('pods_usage', get_pod_usage),
+                       ('ip_usage', get_ip_states),
+                       ('pd_usage', get_pd_states)):
+        for username, items in usage(date_from, date_to, user).iteritems():
+            rv[username][key] = items
+    return dict(rv)
+
+
+def _stream(query):
+    return query.execution_options(stream_results=True) \
+        .yield_per(EXPORT_BATCH_SIZE)
+
+
+def iter_usage_records(date_from, date_to, user=None):
+    """Yield usage of all users (or only of the `user`) as flat records, one
+    per container, IP or persistent disk state.
+    States are read from server-side cursors in batches, so memory usage
+    does not depend on the date range.
+    """
+    now = int(time.time())
+    query = _pod_states_query(date_from, date_to, user).add_columns(Pod.name)
+    for (username, pod_id, kube_id, container_name, kubes,
+         start_time, end_time, pod_name) in _stream(query):
+        yield {'type': 'pod',
+               'username': username,
+               'pod_id': pod_id,
+               'pod_name': pod_name,
+               'kube_id': kube_id,
+               'container_name': container_name,
+               'kubes': kubes,
+               'start': to_timestamp(start_time),
+               'end': now if end_time is None else to_timestamp(end_time)}
+    for username, ip_state in _stream(
+            _ip_states_query(date_from, date_to, user)):
+        yield dict(ip_state.to_dict(), type='ip', username=username)
+    for username, pd_state in _stream(
+            _pd_states_query(date_from, date_to, user)):
+        yield dict(pd_state.to_dict(exclude=['user_id']),
+                   type='pd', username=username)
+
+
+def _ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def _csv_lines(records):
+    buf = StringIO()
+    writer = csv.DictWriter(buf, EXPORT_FIELDS)
+    writer.writeheader()
+    for record in records:
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow({
+            key: value.encode('utf-8') if isinstance(value, unicode)
+            else value for key, value in record.iteritems()})
+    yield buf.getvalue()
+
+
+def export_usage(date_from, date_to, export_format, user=None):
+    """Streaming response with usage records in NDJSON or CSV format."""
+    records = iter_usage_records(date_from, date_to, user)
+    if export_format == 'csv':
+        return Response(
+            stream_with_context(_csv_lines(records)), mimetype='text/csv',
+            headers={'content-disposition':
+                     'attachment; filename="usage.csv"'})
+    return Response(stream_with_context(_ndjson_lines(records)),
+                    mimetype=NDJSON_MIMETYPE)
+
+
 def to_timestamp(date):
     return int((date - datetime(1970, 1, 1)).total_seconds())
@@ -36,7 +36,13 @@ def kubes_to_limits(count, kube_type):
 
 
 def repr_limits(count, kube_type):
-    kube = Kube.query.get(kube_type)
+    """
+    :param kube_type: Kube or its id
+    """
+    if isinstance(kube_type, Kube):
+        kube = kube_type
+    else:
+        kube = Kube.query.get(kube_type)
 
     cpu = '{0} {1}'.format(count * kube.cpu, kube.cpu_units)
     memory = '{0} {1}'.format(count * kube.memory, kube.memory_units)
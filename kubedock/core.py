@@ -19,11 +19,14 @@
 # along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
 
 import json
+import os
 import socket
 import time
 
+import gevent
 import paramiko
 import redis
+from gevent.queue import Queue, Empty, Full
 from paramiko.ssh_exception import AuthenticationException, SSHException
 from flask_sqlalchemy_fix import SQLAlchemy
 from flask import current_app
@@ -32,8 +35,9 @@ from werkzeug.contrib.cache import RedisCache
 from .login import LoginManager
 from .settings import (REDIS_HOST, REDIS_PORT,
                        SSH_KEY_FILENAME,
+                       SSH_POOL_IDLE_TIMEOUT,
                        SSE_KEEPALIVE_INTERVAL,
-                       SSE_POLL_INTERVAL)
+                       SSE_QUEUE_SIZE)
 
 
 login_manager = LoginManager()
@@ -204,29 +208,123 @@ class ServerSentEvents(object):
         self._buff = []
 
 
+class EvtHub(object):
+    """Per-process redis subscriber shared by all EvtStreams.
+
+    One greenlet listens to all channels with one pubsub connection and
+    puts messages to bounded in-memory queues of subscribed streams.
+    A stream whose queue is full is dropped: it gets `None` and closes the
+    connection, so the browser reconnects and gets missed events from
+    history by Last-Event-Id.
+    """
+    _instance = None
+
+    def __init__(self, conn, queue_size=SSE_QUEUE_SIZE):
+        self.conn = conn
+        self.queue_size = queue_size
+        self.queues = {}
+        self.dropped = 0
+        self.pid = os.getpid()
+        self._greenlet = None
+
+    @classmethod
+    def get(cls, conn):
+        """Get hub of the current process (a new one after fork)."""
+        if cls._instance is None or cls._instance.pid != os.getpid():
+            cls._instance = cls(conn)
+        return cls._instance
+
+    def subscribe(self, channel):
+        if self._greenlet is None or self._greenlet.dead:
+            self._greenlet = gevent.spawn(
+                self._listen, current_app._get_current_object())
+        queue = Queue(self.queue_size)
+        self.queues.setdefault(channel, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, channel, queue):
+        queues = self.queues.get(channel)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.queues[channel]
+
+    def publish(self, channel, data):
+        for queue in list(self.queues.get(channel, ())):
+            try:
+                queue.put_nowait(data)
+            except Full:
+                self._drop(channel, queue)
+
+    def _drop(self, channel, queue):
+        self.unsubscribe(channel, queue)
+        self.dropped += 1
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def _listen(self, app):
+        while True:
+            pubsub = self.conn.pubsub()
+            try:
+                pubsub.psubscribe('*')
+                for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self.publish(message['channel'], message['data'])
+            except redis.RedisError:
+                app.logger.warning(
+                    'SSE subscriber lost connection to redis', exc_info=True)
+                gevent.sleep(1)
+            finally:
+                # release the connection before the next try
+                pubsub.close()
+
+    def stats(self):
+        depths = [queue.qsize() for queues in self.queues.itervalues()
+                  for queue in queues]
+        return {
+            'pid': self.pid,
+            'channels': len(self.queues),
+            'subscribers': len(depths),
+            'queued': sum(depths),
+            'max_queue_depth': max(depths or [0]),
+            'queue_size': self.queue_size,
+            'dropped': self.dropped,
+        }
+
+
 class EvtStream(object):
+    """Stream of server-sent events published to redis channel.
+
+    Messages are received by the shared per-process `EvtHub`. A keepalive
+    comment is sent if nothing was sent for SSE_KEEPALIVE_INTERVAL seconds.
+    """
     key = 'SSEEVT'
 
     def __init__(self, conn, channel, last_id=None):
         self.conn = conn
         self.channel = channel
-        self.pubsub = conn.pubsub()
-        self.pubsub.subscribe(channel)
+        self.hub = EvtHub.get(conn)
+        self.queue = self.hub.subscribe(channel)
         self.last_id = last_id
-        self.timeout = int(SSE_KEEPALIVE_INTERVAL / SSE_POLL_INTERVAL)
-        self._time_is_out = self.timeout
+        self.timeout = SSE_KEEPALIVE_INTERVAL
         if self.last_id is not None:
             self.last_id = int(self.last_id)
-        self.cache_key = ':'.join([self.key, channel])
+        from .utils import event_history_keys  # utils imports core
+        _, self.cache_key = event_history_keys(channel, self.key)
 
     def __iter__(self):
+        try:
+            for msg in self._messages():
+                yield msg
+        finally:
+            self.hub.unsubscribe(self.channel, self.queue)
+
+    def _messages(self):
         sse = ServerSentEvents()
         if self.last_id is not None:
-            for key, value in sorted(
-                ((int(k), v) for k, v in self.conn.hgetall(
-                    self.cache_key).iteritems()), key=(lambda x: x[0])):
-                if key <= self.last_id:
-                    continue
+            for value in self.conn.zrangebyscore(
+                    self.cache_key, '({0}'.format(self.last_id), '+inf'):
                 eid, event, data = json.loads(value)
                 if not isinstance(data, basestring):
                     data = json.dumps(data)
@@ -236,22 +334,20 @@ class EvtStream(object):
         else:
             yield ':\n\n'
         while True:
-            message = self.pubsub.get_message()
-            if message:
-                if message['type'] == 'message':
-                    eid, event, data = json.loads(message['data'])
-                    if not isinstance(data, basestring):
-                        data = json.dumps(data)
-                    sse.make_message(eid, event, data)
-                    for msg in sse:
-                        yield msg.encode('u8')
-            else:
-                if not self._time_is_out:
-                    self._time_is_out = self.timeout
-                    yield ':\n\n'
-                else:
-                    self._time_is_out -= 1
-            time.sleep(SSE_POLL_INTERVAL)
+            try:
+                message = self.queue.get(timeout=self.timeout)
+            except Empty:
+                yield ':\n\n'
+                continue
+            if message is None:
+                # too slow consumer, client will reconnect
+                return
+            eid, event, data = json.loads(message)
+            if not isinstance(data, basestring):
+                data = json.dumps(data)
+            sse.make_message(eid, event, data)
+            for msg in sse:
+                yield msg.encode('u8')
 
 
 def ssh_connect(host, timeout=10):
@@ -278,6 +374,83 @@ def ssh_connect(host, timeout=10):
     return ssh, error_message
 
 
+class SSHConnectionPool(object):
+    """Persistent SSH connections to nodes, one per host in a process.
+
+    Connection is checked before reuse and reconnected if it is dead.
+    Connections that were not used for `idle_timeout` seconds are closed
+    by a background greenlet.
+    """
+    pool = {}
+    idle_timeout = SSH_POOL_IDLE_TIMEOUT
+    pid = None
+    _evictor = None
+
+    @staticmethod
+    def _is_alive(ssh):
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (SSHException, socket.error, EOFError):
+            return False
+        return True
+
+    @classmethod
+    def _check_pid(cls):
+        if cls.pid != os.getpid():
+            # connections and greenlet inherited from the parent process
+            # belong to it, start from scratch
+            cls.pool = {}
+            cls.pid = os.getpid()
+            cls._evictor = None
+        if cls._evictor is None or cls._evictor.dead:
+            cls._evictor = gevent.spawn(cls._evict_forever)
+
+    @classmethod
+    def get_connection(cls, host, timeout=10):
+        """Get connected SSH client for the host.
+
+        :returns: tuple (ssh, error_message) like `ssh_connect`
+        """
+        cls._check_pid()
+        ssh, _ = cls.pool.pop(host, (None, None))
+        if ssh is not None and not cls._is_alive(ssh):
+            ssh.close()
+            ssh = None
+        if ssh is None:
+            ssh, error_message = ssh_connect(host, timeout)
+            if error_message:
+                return ssh, error_message
+        cls.pool[host] = (ssh, time.time())
+        return ssh, None
+
+    @classmethod
+    def discard(cls, host, ssh):
+        """Close the connection to the host, e.g. after an error.
+        Pooled connection is dropped only if it's the same one, it may be
+        already replaced by a new connection used by other greenlet.
+        """
+        pooled, _ = cls.pool.get(host, (None, None))
+        if pooled is ssh:
+            del cls.pool[host]
+        ssh.close()
+
+    @classmethod
+    def evict_idle(cls):
+        deadline = time.time() - cls.idle_timeout
+        for host, (ssh, last_used) in cls.pool.items():
+            if last_used < deadline:
+                cls.discard(host, ssh)
+
+    @classmethod
+    def _evict_forever(cls):
+        while True:
+            gevent.sleep(cls.idle_timeout / 2.0)
+            cls.evict_idle()
+
+
 class RemoteManager(object):
     """
     Set of helper functions for convenient work with remote hosts.
@@ -19,12 +19,18 @@
 # along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
 
 import base64
+import bisect
 import copy
 import json
+import os
 import random
 import string
+import time
+from collections import defaultdict
 
 import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app
 
 from .. import settings
 from .. import utils
@@ -36,7 +42,50 @@ from ..users.models import User
 from ..utils import POD_STATUSES
 
 
+class RequestsMetrics(object):
+    """Per-process counters of requests to k8s API grouped by resource and
+    HTTP verb: number of calls and errors, bytes received and a histogram of
+    latency.
+    """
+    #: upper bounds (in seconds) of latency histogram buckets
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._metrics = defaultdict(lambda: {
+            'calls': 0, 'errors': 0, 'bytes': 0, 'latency_sum': 0.0,
+            'latency_buckets': [0] * (len(self.BUCKETS) + 1)})
+
+    def observe(self, resource, verb, latency, size=0, error=False):
+        metric = self._metrics[(resource, verb)]
+        metric['calls'] += 1
+        metric['errors'] += int(error)
+        metric['bytes'] += size
+        metric['latency_sum'] += latency
+        metric['latency_buckets'][
+            bisect.bisect_left(self.BUCKETS, latency)] += 1
+
+    def snapshot(self):
+        result = []
+        for (resource, verb), metric in sorted(self._metrics.iteritems()):
+            buckets = zip(map(str, self.BUCKETS) + ['+Inf'],
+                          metric['latency_buckets'])
+            result.append(dict(metric, resource=resource, verb=verb,
+                               pid=os.getpid(),
+                               latency_buckets=dict(buckets)))
+        return result
+
+
 class KubeQuery(object):
+    #: HTTP verbs that can be safely retried
+    IDEMPOTENT = ('get', 'put', 'del')
+
+    metrics = RequestsMetrics()
+    _sessions = {}
+    _sessions_pid = None
+
     def __init__(self, return_json=True, base_url=settings.KUBE_BASE_URL,
                  api_version=settings.KUBE_API_VERSION):
         self.return_json = return_json
@@ -125,20 +174,72 @@ class KubeQuery(object):
         args['data'] = data
         return self._run('patch', res, args, ns)
 
+    @classmethod
+    def _get_session(cls, base_url, api_version):
+        """Get keep-alive session shared by all KubeQuery instances with the
+        same base_url and api_version in current process.
+        """
+        if cls._sessions_pid != os.getpid():  # forked (uwsgi, celery)
+            cls._sessions, cls._sessions_pid = {}, os.getpid()
+        key = (base_url, api_version)
+        session = cls._sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=settings.KUBE_API_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            cls._sessions[key] = session
+        return session
+
     def _run(self, act, res, args, ns):
+        session = self._get_session(self.base_url, self.api_version)
         dispatcher = {
-            'get': requests.get,
-            'post': requests.post,
-            'put': requests.put,
-            'del': requests.delete,
-            'patch': requests.patch,
+            'get': session.get,
+            'post': session.post,
+            'put': session.put,
+            'del': session.delete,
+            'patch': session.patch,
         }
-        try:
-            req = dispatcher.get(act, requests.get)(self._make_url(res, ns),
-                                                    **args)
+        method = dispatcher.get(act, session.get)
+        args.setdefault('timeout', (settings.KUBE_API_CONNECT_TIMEOUT,
+                                    settings.KUBE_API_READ_TIMEOUT))
+        retries = settings.KUBE_API_RETRIES if act in self.IDEMPOTENT else 0
+        resource = res[0] if res else ''
+        url = self._make_url(res, ns)
+        for attempt in xrange(retries + 1):
+            start = time.time()
+            try:
+                req = method(url, **args)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout), e:
+                self.metrics.observe(resource, act, time.time() - start,
+                                     error=True)
+                if attempt < retries:
+                    continue
+                return self._raise_error(str(e))
+            self.metrics.observe(resource, act, time.time() - start,
+                                 len(req.content), error=not req.ok)
             return self._return_request(req)
-        except requests.exceptions.ConnectionError, e:
-            return self._raise_error(str(e))
+
+
+#: Functions called as `hook(name, elapsed, **details)` after some
+#: time-consuming operations with k8s API, e.g. for profiling
+TIMING_HOOKS = []
+
+
+def report_timing(name, elapsed, **details):
+    """Pass timing of some operation to all TIMING_HOOKS.
+
+    :param name: name of the operation
+    :param elapsed: time spent (in seconds)
+    :param details: any additional info about the operation
+    """
+    for hook in TIMING_HOOKS:
+        try:
+            hook(name, elapsed, **details)
+        except Exception:
+            current_app.logger.warning('Timing hook %r failed', hook,
+                                       exc_info=True)
 
 
 KUBERDOCK_POD_UID = 'kuberdock-pod-uid'
@@ -0,0 +1,268 @@
+# KuberDock - is a platform that allows users to run applications using Docker
+# container images and create SaaS / PaaS based on these applications.
+# Copyright (C) 2017 Cloud Linux INC
+#
+# This file is part of KuberDock.
+#
+# KuberDock is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# KuberDock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
+
+"""Process-wide shared informers for Kubernetes objects.
+
+Informer keeps an in-memory copy of all objects of one resource
+kind. It lists the objects once and then follows the watch API starting from
+the listed resourceVersion (like `listeners.listen_fabric` does), so readers
+may get objects without any request to apiserver.
+
+Informers are started lazily in every process on the first call of
+`get_synced` and run in their own greenlets.
+"""
+
+import copy
+import json
+import os
+import time
+from collections import defaultdict
+from socket import error as socket_error
+
+import gevent
+from flask import current_app
+from websocket import (create_connection, WebSocketException,
+                       WebSocketTimeoutException)
+
+from .. import settings
+from ..utils import get_api_url
+from .helpers import KubeQuery
+from .podutils import is_failed_k8s_answer
+
+PODS = 'pods'
+REPLICATION_CONTROLLERS = 'replicationcontrollers'
+NAMESPACES = 'namespaces'
+
+#: Index of objects by their namespace, every informer has it
+NAMESPACE_INDEX = 'namespace'
+
+
+class InformerError(Exception):
+    pass
+
+
+class Informer(object):
+    """In-memory copy of all objects of some kind of Kubernetes resources.
+
+    :param resource: resource name in k8s API, e.g. 'pods'
+    :param indexers: mapping of index name to function which takes k8s object
+        and returns list of index values for it
+    """
+
+    def __init__(self, resource, indexers=None):
+        self.resource = resource
+        self.indexers = {NAMESPACE_INDEX: self._index_by_namespace}
+        self.indexers.update(indexers or {})
+        self.resource_version = None
+        self.synced = False
+        # last time when the data was known to be in sync with apiserver:
+        # list, watch (re)connection or received event
+        self.alive_at = None
+        self._items = {}
+        self._indices = {name: defaultdict(set) for name in self.indexers}
+
+    @staticmethod
+    def _index_by_namespace(obj):
+        return [obj['metadata'].get('namespace')]
+
+    @staticmethod
+    def key(obj):
+        metadata = obj['metadata']
+        return metadata.get('namespace'), metadata['name']
+
+    def _add(self, obj):
+        key = self.key(obj)
+        self._delete(key)
+        self._items[key] = obj
+        for name, indexer in self.indexers.iteritems():
+            for value in indexer(obj):
+                self._indices[name][value].add(key)
+
+    def _delete(self, key):
+        obj = self._items.pop(key, None)
+        if obj is None:
+            return
+        for name, indexer in self.indexers.iteritems():
+            index = self._indices[name]
+            for value in indexer(obj):
+                index[value].discard(key)
+                if not index[value]:
+                    del index[value]
+
+    def replace(self, items, resource_version):
+        """Replace all cached objects with the result of list request."""
+        self._items = {}
+        self._indices = {name: defaultdict(set) for name in self.indexers}
+        for obj in items:
+            self._add(obj)
+        self.resource_version = resource_version
+        self.synced = True
+        self.alive_at = time.time()
+
+    def handle_event(self, event):
+        """Apply watch event to the cache.
+
+        :returns: False if the event is an error and the informer must
+            relist objects, True otherwise
+        """
+        event_type = event.get('type')
+        obj = event.get('object') or {}
+        if event_type == 'ERROR' or event_type is None:
+            return False
+        if event_type == 'DELETED':
+            self._delete(self.key(obj))
+        else:
+            self._add(obj)
+        self.resource_version = obj['metadata'].get(
+            'resourceVersion', self.resource_version)
+        return True
+
+    def is_fresh(self, max_staleness=None):
+        """Check that cached data may be used instead of apiserver.
+
+        Silently dropped watch connection can't be told from a quiet one,
+        so the data is fresh only if the watch got an event or was
+        (re)connected recently. The watch is reconnected after
+        K8S_INFORMERS_WATCH_TIMEOUT seconds without events.
+
+        :param max_staleness: how long (in seconds) the data can be used
+            after it was known to be in sync with apiserver.
+        """
+        if not self.synced:
+            return False
+        if max_staleness is None:
+            max_staleness = settings.K8S_INFORMERS_MAX_STALENESS
+        return time.time() - self.alive_at < max_staleness
+
+    def list(self, namespace=None):
+        """Get copies of all cached objects, optionally of one namespace."""
+        if namespace is None:
+            objects = self._items.itervalues()
+        else:
+            objects = self._by_keys(
+                self._indices[NAMESPACE_INDEX].get(namespace, ()))
+        return [copy.deepcopy(obj) for obj in objects]
+
+    def _by_keys(self, keys):
+        return (self._items[key] for key in keys if key in self._items)
+
+    def _list(self):
+        data = KubeQuery().get([self.resource], ns=False)
+        failed, message = is_failed_k8s_answer(data)
+        if failed:
+            raise InformerError('Could not list {0}: {1}'.format(
+                self.resource, message))
+        self.replace(data.get('items', []),
+                     data['metadata']['resourceVersion'])
+
+    def _watch(self):
+        url = get_api_url(self.resource, namespace=False, watch=True)
+        ws = create_connection(
+            url + '&resourceVersion={0}'.format(self.resource_version),
+            timeout=settings.K8S_INFORMERS_WATCH_TIMEOUT)
+        self.alive_at = time.time()
+        try:
+            while True:
+                try:
+                    content = ws.recv()
+                except WebSocketTimeoutException:
+                    # nothing happened for a while, reconnect from the last
+                    # seen resourceVersion to make sure the watch is alive
+                    return True
+                self.alive_at = time.time()
+                if not self.handle_event(json.loads(content)):
+                    return False
+        finally:
+            ws.close()
+
+    def run(self, app):
+        """Keep the cache in sync with apiserver. Never returns."""
+        with app.app_context():
+            relist = True
+            while True:
+                try:
+                    if relist:
+                        self._list()
+                    relist = not self._watch()
+                except (socket_error, WebSocketException) as e:
+                    current_app.logger.warning(
+                        'Informer of %s: watch error: %s', self.resource, e)
+                    gevent.sleep(1)
+                except (Exception, SystemExit):
+                    current_app.logger.warning(
+                        'Informer of %s failed', self.resource, exc_info=True)
+                    relist = True
+                    gevent.sleep(1)
+
+
+class SharedInformers(object):
+    """Informers of all resources needed by PodCollection."""
+
+    def __init__(self):
+        self.pods = Informer(PODS)
+        self.replicationcontrollers = Informer(REPLICATION_CONTROLLERS)
+        self.namespaces = Informer(NAMESPACES)
+        self.pid = os.getpid()
+        self._greenlets = []
+
+    def __getitem__(self, resource):
+        return getattr(self, resource)
+
+    def all(self):
+        return [self.pods, self.replicationcontrollers, self.namespaces]
+
+    def start(self, app):
+        self._greenlets = [gevent.spawn(informer.run, app)
+                           for informer in self.all()]
+
+    def stop(self):
+        gevent.killall(self._greenlets)
+        self._greenlets = []
+
+    def is_fresh(self, max_staleness=None):
+        return all(informer.is_fresh(max_staleness)
+                   for informer in self.all())
+
+
+_shared = None
+
+
+def get_shared(app=None):
+    """Get informers of the current process, start them if needed."""
+    global _shared
+    if _shared is None or _shared.pid != os.getpid():
+        # informers inherited from the parent process (e.g. uwsgi master)
+        # have no running greenlets, so start new ones
+        _shared = SharedInformers()
+        _shared.start(app or current_app._get_current_object())
+    return _shared
+
+
+def get_synced(max_staleness=None):
+    """Get informers if their data may be used instead of apiserver.
+
+    :returns: SharedInformers object or None if informers are disabled or
+        not synced yet (or stale) and caller must fallback to apiserver.
+    """
+    if not settings.K8S_INFORMERS_ENABLED:
+        return None
+    shared = get_shared()
+    if shared.is_fresh(max_staleness):
+        return shared
+    return None
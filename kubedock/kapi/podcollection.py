@@ -19,9 +19,11 @@
 # along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
 
 import json
+import time
 from collections import defaultdict
 from crypt import crypt
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from os import path
 from uuid import uuid4
 
@@ -29,8 +31,11 @@ import paramiko
 import pytz
 from celery.exceptions import MaxRetriesExceededError
 from flask import current_app
+from gevent.pool import Pool
+from sqlalchemy.orm import contains_eager, load_only
 
 import helpers
+import informers
 import ingress_resource
 import licensing
 import node_utils
@@ -38,7 +43,8 @@ import pod_domains
 import podutils
 import pstorage
 from helpers import (
-    KubeQuery, K8sSecretsClient, K8sSecretsBuilder, LocalService)
+    KubeQuery, K8sSecretsClient, K8sSecretsBuilder, LocalService,
+    KUBERDOCK_POD_UID, LABEL_SELECTOR_PODS)
 from images import Image
 from kubedock.exceptions import (
     ContainerCommandExecutionError, NotFound,
@@ -58,6 +64,7 @@ from .. import certificate_utils
 from .. import dns_management
 from .. import settings
 from .. import utils
+from ..billing.models import Kube
 from ..constants import AWS_UNKNOWN_ADDRESS
 from ..core import ExclusiveLockContextManager, db
 from ..domains.models import PodDomain
@@ -68,7 +75,7 @@ from ..exceptions import (
     PublicAccessAssigningError,
     PVResizeFailed
 )
-from ..kd_celery import celery
+from ..kd_celery import celery, exclusive_task
 from ..nodes.models import Node
 from ..pods.models import (
     PersistentDisk, PodIP, IPPool, Pod as DBPod, PersistentDiskStatuses)
@@ -127,6 +134,51 @@ def _get_network_policy_api():
                      base_url=settings.KUBE_NP_BASE_URL)
 
 
+class SelectorIndex(object):
+    """Index of k8s objects with label selectors (e.g. replication
+    controllers), finds objects related to labels (see
+    `PodCollection._is_related`) without checking every object.
+
+    Selectors with 'kuberdock-pod-uid' are indexed by its value, other
+    selectors are indexed by one of their key/value pairs.
+    """
+
+    def __init__(self, objects):
+        self._by_pod_uid = defaultdict(list)
+        self._by_label = defaultdict(list)
+        self._match_all = []
+        for position, obj in enumerate(objects):
+            selector = obj.get('spec', {}).get('selector')
+            entry = (position, obj)
+            if selector is None:
+                continue  # such object is never related to anything
+            elif not selector:
+                self._match_all.append(entry)
+            elif KUBERDOCK_POD_UID in selector:
+                self._by_pod_uid[selector[KUBERDOCK_POD_UID]].append(entry)
+            else:
+                self._by_label[min(selector.iteritems())].append(entry)
+
+    def find(self, labels):
+        """Get the first (in original order) object related to labels.
+
+        :param labels: labels of some k8s object (e.g. pod)
+        :returns: related object or None
+        """
+        if labels is None:
+            return None
+        candidates = list(self._match_all)
+        pod_uid = labels.get(KUBERDOCK_POD_UID)
+        if pod_uid is not None:
+            candidates.extend(self._by_pod_uid.get(pod_uid, ()))
+        if self._by_label:
+            for label in labels.iteritems():
+                candidates.extend(self._by_label.get(label, ()))
+        related = [entry for entry in candidates if PodCollection._is_related(
+            labels, entry[1]['spec']['selector'])]
+        return min(related)[1] if related else None
+
+
 class PublicAccessType:
     PUBLIC_IP = 'public_ip'
     PUBLIC_AWS = 'public_aws'
@@ -134,9 +186,21 @@ class PublicAccessType:
 
 
 class PodCollection(object):
-    def __init__(self, owner=None):
+    # ids of pods the collection is restricted to, None means all pods
+    _pod_ids = None
+    _informers = None
+    # columns of pods model loaded in `_merge`
+    _MERGED_DB_COLUMNS = ('id', 'name', 'owner_id', 'kube_id', 'config',
+                          'status', 'direct_access', 'template_id',
+                          'template_version_id', 'template_plan_name')
+
+    def __init__(self, owner=None, use_cache=False, pod_ids=None):
         """
         :param owner: User model instance
+        :param use_cache: read pods, RCs and namespaces from process-wide
+            informers instead of apiserver (if informers are synced).
+            Suitable for read-only usage, data may be a little stale.
+        :param pod_ids: load only these pods (see `for_pod`)
         """
         # Original names of pods in k8s {'metadata': 'name'}
         # Pod class store it in 'sid' field, but here it will be replaced with
@@ -144,10 +208,65 @@ class PodCollection(object):
         self.pod_names = None
         self.owner = owner
         self.k8squery = KubeQuery()
-        namespaces = self._get_namespaces()
-        self._get_pods(namespaces)
+        self._informers = informers.get_synced() if use_cache else None
+        if pod_ids is None:
+            namespaces = self._get_namespaces()
+        else:
+            self._pod_ids = list(pod_ids)
+            namespaces = self._get_pods_namespaces(self._pod_ids)
+        if namespaces or pod_ids is None:
+            self._get_pods(namespaces)
+        else:
+            self._collection, self.pod_names = {}, {}
         self._merge()
 
+    @classmethod
+    def for_pod(cls, pod_id, owner=None, use_cache=False):
+        """Create collection with one pod only.
+
+        Only namespace of the pod is fetched from k8s and only this pod is
+        fetched from DB, so it's much cheaper than full collection if you
+        need only one pod. Use `_get_by_id` to get the pod, it raises
+        PodNotFound if there is no such pod or it's not owned by `owner`.
+
+        :param pod_id: id of the pod
+        :param owner: User model instance
+        :param use_cache: see `__init__`
+        """
+        return cls(owner, use_cache=use_cache, pod_ids=[pod_id])
+
+    @classmethod
+    def paginate(cls, owner=None, limit=None, offset=0, sort='name',
+                 status=None, use_cache=False):
+        """Create collection with one page of pods.
+
+        Pods are filtered and ordered by DB data, so pods out of the page
+        are not fetched from k8s and not merged at all. Methods `get` and
+        `dump` return pods of the collection in the page order.
+
+        :param owner: User model instance, None means all users
+        :param limit: max number of pods in the page, None means no limit
+        :param offset: number of pods to skip
+        :param sort: name of the field, '-' prefix means descending order
+        :param status: list of allowed pod statuses (in DB)
+        :param use_cache: see `__init__`
+        :returns: tuple (collection, total number of pods)
+        """
+        query = DBPod.query.filter(DBPod.status != POD_STATUSES.deleted)
+        if owner is not None:
+            query = query.filter(DBPod.owner_id == owner.id)
+        if status:
+            query = query.filter(DBPod.status.in_(status))
+        total = query.count()
+
+        column = getattr(DBPod, sort.lstrip('-'))
+        if sort.startswith('-'):
+            column = column.desc()
+        query = query.with_entities(DBPod.id).order_by(column, DBPod.id)
+        query = query.offset(offset).limit(limit)
+        pod_ids = [pod_id for pod_id, in query]
+        return cls(owner, use_cache=use_cache, pod_ids=pod_ids), total
+
     def _preprocess_new_pod(self, params, original_pod=None, skip_check=False):
         """
         Do some trivial checks and changes in new pod data.
@@ -465,6 +584,9 @@ class PodCollection(object):
             owner_id = self.owner.id
             pods = [p for p in self._collection.values()
                     if p.owner.id == owner_id]
+        if self._pod_ids is not None:
+            order = {pod_id: i for i, pod_id in enumerate(self._pod_ids)}
+            pods.sort(key=lambda pod: order.get(pod.id, len(order)))
         return pods
 
     @staticmethod
@@ -907,15 +1029,153 @@ class PodCollection(object):
             return None
         return data
 
+    def _list_k8s(self, resource, ns=None, message=None, selector=None):
+        """Get list of k8s objects from informers (if available) or
+        from apiserver.
+
+        :param resource: resource name, e.g. 'pods'
+        :param ns: namespace, None or False means all namespaces
+        :param message: error message if apiserver request failed
+        :param selector: label selector (apiserver requests only)
+        """
+        if self._informers is not None:
+            return self._informers[resource].list(ns or None)
+        data = self._query_k8s(resource, ns, selector)
+        podutils.raise_if_failure(data, message)
+        return data.get('items', [])
+
+    def _query_k8s(self, resource, ns=None, selector=None):
+        if selector is None:
+            return self.k8squery.get([resource], ns=ns)
+        return self.k8squery.get([resource], {'labelSelector': selector},
+                                 ns=ns)
+
+    def _list_pods_and_replicas(self, namespace=None, selector=None):
+        return (self._list_k8s('pods', ns=namespace, selector=selector,
+                               message="Could not get pods"),
+                self._list_k8s('replicationcontrollers', ns=namespace,
+                               selector=selector,
+                               message="Could not get replicas"))
+
+    def _list_namespaces_concurrently(self, namespaces):
+        """List pods and RCs in every namespace using a pool of greenlets.
+
+        :returns: tuple (pods, replicas, time of all requests)
+        """
+        def list_namespace(namespace):
+            # only plain requests here: there is no app context in greenlets
+            start = time.time()
+            try:
+                result = (self._query_k8s('pods', namespace),
+                          self._query_k8s('replicationcontrollers', namespace))
+            except (Exception, SystemExit) as e:
+                # SystemExit must not be raised in a greenlet
+                result = e
+            return result, time.time() - start
+
+        pods, replicas, sequential_time = [], [], 0
+        pool = Pool(settings.K8S_LIST_CONCURRENCY)
+        try:
+            for result, elapsed in pool.imap(list_namespace, namespaces):
+                if isinstance(result, BaseException):
+                    raise result
+                pods_data, replicas_data = result
+                podutils.raise_if_failure(pods_data, "Could not get pods")
+                podutils.raise_if_failure(replicas_data,
+                                          "Could not get replicas")
+                pods.extend(pods_data.get('items', []))
+                replicas.extend(replicas_data.get('items', []))
+                sequential_time += elapsed
+        finally:
+            pool.kill()
+        return pods, replicas, sequential_time
+
+    def _list_namespaces_by_selector(self, namespaces):
+        """List pods and RCs in a lot of namespaces with cluster-wide
+        requests, filtered by pod ids if collection has an owner.
+
+        :returns: tuple (pods, replicas, number of requests)
+        """
+        namespaces = set(namespaces)
+        if self.owner is None:
+            selectors = [None]
+        else:
+            pod_ids = sorted(pod.id for pod in self.owner.pods
+                             if not pod.is_deleted and
+                             pod.namespace in namespaces)
+            size = settings.K8S_LABEL_SELECTOR_MAX_VALUES
+            selectors = [LABEL_SELECTOR_PODS.format(', '.join(
+                pod_ids[i:i + size])) for i in xrange(0, len(pod_ids), size)]
+        pods, replicas = [], []
+        for selector in selectors:
+            pods_part, replicas_part = self._list_pods_and_replicas(
+                selector=selector)
+            pods.extend(pod for pod in pods_part
+                        if pod['metadata'].get('namespace') in namespaces)
+            replicas.extend(rc for rc in replicas_part
+                            if rc['metadata'].get('namespace') in namespaces)
+        return pods, replicas, 2 * len(selectors)
+
+    def _fetch_pods_and_replicas(self, namespaces=None):
+        """Get pods and replication controllers from k8s.
+
+        A few namespaces are listed concurrently one by one, for a lot of
+        namespaces cluster-wide lists are used instead of hundreds of
+        requests. Timing is passed to `helpers.report_timing`.
+
+        :param namespaces: list of namespaces, all if empty
+        :returns: tuple of lists (pods, replication controllers)
+        """
+        start = time.time()
+        if not namespaces or self._informers is not None:
+            strategy = 'all' if not namespaces else 'cache'
+            pods, replicas = [], []
+            for namespace in namespaces or [None]:
+                pods_part, replicas_part = self._list_pods_and_replicas(
+                    namespace)
+                pods.extend(pods_part)
+                replicas.extend(replicas_part)
+            helpers.report_timing(
+                'PodCollection._get_pods', time.time() - start,
+                strategy=strategy, namespaces=len(namespaces or ()))
+            return pods, replicas
+
+        if len(namespaces) > settings.K8S_MAX_NAMESPACES_TO_LIST_SEPARATELY:
+            pods, replicas, requests_count = \
+                self._list_namespaces_by_selector(namespaces)
+            elapsed = time.time() - start
+            # estimated time of two requests per namespace
+            sequential_time = (elapsed / max(requests_count, 1) *
+                               2 * len(namespaces))
+            strategy = 'selector'
+        else:
+            pods, replicas, sequential_time = \
+                self._list_namespaces_concurrently(namespaces)
+            elapsed = time.time() - start
+            strategy = 'concurrent'
+        helpers.report_timing(
+            'PodCollection._get_pods', elapsed, strategy=strategy,
+            namespaces=len(namespaces),
+            saved=max(sequential_time - elapsed, 0))
+        return pods, replicas
+
     def _get_namespaces(self):
-        data = self.k8squery.get(['namespaces'], ns=False)
-        podutils.raise_if_failure(data, "Could not get namespaces")
-        namespaces = [i['metadata']['name'] for i in data.get('items', {})]
+        items = self._list_k8s(
+            'namespaces', ns=False, message="Could not get namespaces")
+        namespaces = [i['metadata']['name'] for i in items]
         if self.owner is None:
             return namespaces
         user_namespaces = get_user_namespaces(self.owner)
         return [ns for ns in namespaces if ns in user_namespaces]
 
+    def _get_pods_namespaces(self, pod_ids):
+        """Get namespaces of given (not deleted) pods from DB."""
+        query = DBPod.query.filter(
+            DBPod.id.in_(pod_ids), DBPod.status != POD_STATUSES.deleted)
+        if self.owner is not None:
+            query = query.filter(DBPod.owner_id == self.owner.id)
+        return [db_pod.namespace for db_pod in query]
+
     def _drop_namespace(self, namespace, force=False):
         rv = self.k8squery.delete(['namespaces', namespace], ns=False)
         if not force:
@@ -966,42 +1226,23 @@ class PodCollection(object):
             self._collection = {}
         pod_index = set()
 
-        data = []
-        replicas_data = []
-
-        if namespaces:
-            for namespace in namespaces:
-                pods = self.k8squery.get(['pods'], ns=namespace)
-                podutils.raise_if_failure(pods, "Could not get pods")
-                data.extend(pods.get('items', {}))
-                replicas = self.k8squery.get(
-                    ['replicationcontrollers'], ns=namespace)
-                podutils.raise_if_failure(replicas, "Could not get replicas")
-                replicas_data.extend(replicas['items'])
-        else:
-            pods = self.k8squery.get(['pods'])
-            podutils.raise_if_failure(pods, "Could not get pods")
-            data.extend(pods.get('items', {}))
-            replicas = self.k8squery.get(['replicationcontrollers'])
-            podutils.raise_if_failure(replicas, "Could not get replicas")
-            replicas_data.extend(replicas.get('items', {}))
+        data, replicas_data = self._fetch_pods_and_replicas(namespaces)
 
         pod_names = defaultdict(set)
+        replicas_index = SelectorIndex(replicas_data)
 
         for item in data:
             pod = Pod.populate(item)
             self.update_public_address(pod)
             pod_name = pod.sid
 
-            for r in replicas_data:
-                if self._is_related(item['metadata']['labels'],
-                                    r['spec']['selector']):
-                    # If replication controller manages more then one pod,
-                    # _get_pods must return only one of them
-                    # (we will filter by sid)
-                    pod.sid = r['metadata']['name']
-                    pod.replicas = r['spec']['replicas']
-                    break
+            r = replicas_index.find(item['metadata'].get('labels'))
+            if r is not None:
+                # If replication controller manages more then one pod,
+                # _get_pods must return only one of them
+                # (we will filter by sid)
+                pod.sid = r['metadata']['name']
+                pod.replicas = r['spec']['replicas']
             else:
                 pod.replicas = 1
 
@@ -1023,12 +1264,26 @@ class PodCollection(object):
                 if pod.id in dns:
                     set_public_address(dns[pod.id], pod.id)
 
+    def _fetch_db_pods(self):
+        """Get from DB only pods of this collection and only those columns,
+        that are needed to merge them with data from kubernetes.
+        """
+        query = helpers.fetch_pods(users=True).options(
+            load_only(*self._MERGED_DB_COLUMNS),
+            contains_eager(DBPod.owner).load_only('id', 'username'))
+        if self.owner is not None:
+            query = query.filter(DBPod.owner_id == self.owner.id)
+        if self._pod_ids is not None:
+            query = query.filter(DBPod.id.in_(self._pod_ids))
+        return query
+
     def _merge(self):
         """ Merge pods retrieved from kubernetes api with data from DB """
-        db_pods = helpers.fetch_pods(users=True)
-        for db_pod in db_pods:
+        kube_types = None  # all kube types by id, loaded once if needed
+        for db_pod in self._fetch_db_pods():
             db_pod_config = json.loads(db_pod.config)
-            namespace = db_pod.namespace
+            # the same as db_pod.namespace, but without parsing config again
+            namespace = db_pod_config.get('namespace', 'default')
 
             # exists in DB only
             if (db_pod.id, namespace) not in self._collection:
@@ -1105,8 +1360,10 @@ class PodCollection(object):
                 container.pop('resources', None)
                 kubes = container.get('kubes')
                 if kubes:
-                    container['limits'] = billing.repr_limits(kubes,
-                                                              pod.kube_type)
+                    if kube_types is None:
+                        kube_types = {kube.id: kube for kube in Kube.query}
+                    container['limits'] = billing.repr_limits(
+                        kubes, kube_types[pod.kube_type])
 
     def _resize_replicas(self, pod, data):
         # FIXME: not working for now
@@ -1401,7 +1658,7 @@ class PodCollection(object):
         helpers.replace_pod_config(pod, db_config)
 
         # get pod again after change
-        pod = PodCollection()._get_by_id(pod.id)
+        pod = PodCollection.for_pod(pod.id)._get_by_id(pod.id)
 
         config = pod.prepare()
         rv = self.k8squery.put(
@@ -1424,7 +1681,7 @@ class PodCollection(object):
             pods will not be restarted.
         :return: Pod.as_dict()
         """
-        pod = PodCollection()._get_by_id(pod_id)
+        pod = PodCollection.for_pod(pod_id)._get_by_id(pod_id)
         rcdata = json.dumps({'spec': {'template': data}})
         rv = self.k8squery.patch(['replicationcontrollers', pod.sid], rcdata,
                                  ns=pod.namespace,
@@ -1442,7 +1699,7 @@ class PodCollection(object):
                     "Could not change '{0}' pod".format(
                         pod.name.encode('ascii', 'replace'))
                 )
-        pod = PodCollection()._get_by_id(pod_id)
+        pod = PodCollection.for_pod(pod_id)._get_by_id(pod_id)
         return pod.as_dict()
 
     def _redeploy(self, pod, data):
@@ -1453,8 +1710,8 @@ class PodCollection(object):
         else:
             finish_redeploy(pod.id, data)
         # return updated pod
-        return PodCollection(owner=User.get(owner_id)).get(pod.id,
-                                                           as_json=False)
+        return PodCollection.for_pod(pod.id, User.get(owner_id)).get(
+            pod.id, as_json=False)
 
     def exec_in_container(self, pod_id, container_name, command):
         k8s_pod = self._get_by_id(pod_id)
@@ -1734,7 +1991,7 @@ def wait_pod_status(pod_id, wait_status, interval=1, max_retries=120,
         # we need a fresh status
         db.session.expire(DBPod.query.get(pod_id), ['status'])
         db_pod = db.session.query(DBPod).get(pod_id)
-        pod = PodCollection()._get_by_id(pod_id)
+        pod = PodCollection.for_pod(pod_id)._get_by_id(pod_id)
         current_app.logger.debug(
             'Current pod status: {}, {}, wait for {}, pod_id: {}'.format(
                 pod.status, db_pod.status, wait_status, pod_id))
@@ -1763,7 +2020,7 @@ def scale_replicationcontroller(pod_id, size=0):
     """Set new replicas size and wait until replication controller increase or
     decrease real number of pods or max retries exceed
     """
-    pc = PodCollection()
+    pc = PodCollection.for_pod(pod_id)
     pod = pc._get_by_id(pod_id)
     data = json.dumps({'spec': {'replicas': size}})
     rc = pc.k8squery.patch(
@@ -1782,7 +2039,7 @@ def scale_replicationcontroller_task(*args, **kwargs):
 @celery.task(ignore_results=True)
 def finish_redeploy(pod_id, data, start=True):
     db_pod = DBPod.query.get(pod_id)
-    pod_collection = PodCollection(db_pod.owner)
+    pod_collection = PodCollection.for_pod(pod_id, db_pod.owner)
     pod = pod_collection._get_by_id(pod_id)
     try:
         pod_collection._stop_pod(pod, block=True, raise_=False)
@@ -1804,7 +2061,7 @@ def finish_redeploy(pod_id, data, start=True):
                 pstorage.delete_drive_by_id(pd.id)
 
     if start:  # start updated pod
-        PodCollection(db_pod.owner).update(
+        PodCollection.for_pod(pod_id, db_pod.owner).update(
             pod_id,
             {
                 # already in celery, use the same task, sync
@@ -2330,10 +2587,41 @@ def change_pv_size(persistent_disk_id, new_size, dry_run=False):
 
 
 @celery.task(ignore_result=True)
+@exclusive_task(60 * 30)
 def pod_set_unpaid_state_task():
-    q = DBPod.query.filter(DBPod.unpaid.is_(True),
-                           DBPod.status.notin_([POD_STATUSES.stopping,
-                                                POD_STATUSES.deleted,
-                                                POD_STATUSES.unpaid]))
-    for db_pod in q:
-        PodCollection.stop_unpaid(PodCollection()._get_by_id(db_pod.id))
+    start = time.time()
+    q = db.session.query(DBPod.id).filter(
+        DBPod.unpaid.is_(True),
+        DBPod.status.notin_([POD_STATUSES.stopping,
+                             POD_STATUSES.deleted,
+                             POD_STATUSES.unpaid]))
+    pod_ids = [pod_id for pod_id, in q]
+    if not pod_ids:
+        return
+    # one collection for all unpaid pods instead of a collection per pod
+    pods = PodCollection(pod_ids=pod_ids)._get_owned()
+    app = current_app._get_current_object()
+
+    def stop_unpaid(pod):
+        # every thread has its own app context and DB session,
+        # changes are committed on teardown
+        with app.app_context():
+            try:
+                PodCollection.stop_unpaid(pod)
+            except Exception:
+                current_app.logger.exception(
+                    'Failed to stop unpaid pod %s', pod.id)
+                # do not commit partial changes on teardown
+                db.session.rollback()
+                return False
+            return True
+
+    pool = ThreadPool(min(settings.UNPAID_PODS_STOP_CONCURRENCY, len(pods)))
+    try:
+        stopped = sum(pool.map(stop_unpaid, pods))
+    finally:
+        pool.close()
+        pool.join()
+    current_app.logger.info(
+        'Unpaid pods processed: %d of %d in %.2fs', stopped, len(pods),
+        time.time() - start)
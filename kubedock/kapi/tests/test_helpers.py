@@ -23,6 +23,53 @@ import unittest
 from kubedock.kapi import helpers
 
 
+@mock.patch.object(helpers.KubeQuery, '_sessions_pid', None)
+@mock.patch.object(helpers.requests, 'Session')
+class TestKubeQuery(unittest.TestCase):
+    def setUp(self):
+        helpers.KubeQuery.metrics.reset()
+
+    def test_session_reused(self, session_mock):
+        helpers.KubeQuery().get(['pods'])
+        helpers.KubeQuery(return_json=False).get(['nodes'])
+        helpers.KubeQuery(api_version='v1beta1').get(['ingresses'])
+        self.assertEqual(session_mock.call_count, 2)
+
+    @mock.patch.object(helpers.settings, 'KUBE_API_RETRIES', 2)
+    def test_idempotent_retries(self, session_mock):
+        session = session_mock.return_value
+        error = helpers.requests.exceptions.ConnectionError('fail')
+        session.get.side_effect = [error, error, mock.Mock(content='{}')]
+        helpers.KubeQuery().get(['pods'])
+        self.assertEqual(session.get.call_count, 3)
+
+        session.post.side_effect = error
+        with self.assertRaises(SystemExit):
+            helpers.KubeQuery().post(['pods'], '{}')
+        self.assertEqual(session.post.call_count, 1)
+
+    def test_timeout(self, session_mock):
+        helpers.KubeQuery().get(['pods'])
+        session_mock.return_value.get.assert_called_once_with(
+            mock.ANY, timeout=(helpers.settings.KUBE_API_CONNECT_TIMEOUT,
+                               helpers.settings.KUBE_API_READ_TIMEOUT))
+
+    def test_metrics(self, session_mock):
+        session = session_mock.return_value
+        session.get.return_value = mock.Mock(content='{"items": []}', ok=True)
+        session.delete.return_value = mock.Mock(content='{}', ok=False)
+        helpers.KubeQuery().get(['pods'])
+        helpers.KubeQuery().get(['pods'], ns='default')
+        helpers.KubeQuery().delete(['pods', 'pod1'], ns='default')
+
+        metrics = helpers.KubeQuery.metrics.snapshot()
+        self.assertEqual(
+            [(m['resource'], m['verb'], m['calls'], m['errors'], m['bytes'])
+             for m in metrics],
+            [('pods', 'del', 1, 1, 2), ('pods', 'get', 2, 0, 26)])
+        self.assertEqual(sum(metrics[1]['latency_buckets'].values()), 2)
+
+
 class TestServices(unittest.TestCase):
 
     SERVICES = {
@@ -0,0 +1,140 @@
+
+# KuberDock - is a platform that allows users to run applications using Docker
+# container images and create SaaS / PaaS based on these applications.
+# Copyright (C) 2017 Cloud Linux INC
+#
+# This file is part of KuberDock.
+#
+# KuberDock is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# KuberDock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
+
+import json
+import time
+import unittest
+
+import mock
+
+from .. import informers
+
+
+def k8s_pod(name, namespace, pod_id=None, version='1'):
+    labels = {}
+    if pod_id is not None:
+        labels['kuberdock-pod-uid'] = pod_id
+    return {'metadata': {'name': name, 'namespace': namespace,
+                         'labels': labels, 'resourceVersion': version}}
+
+
+class TestInformer(unittest.TestCase):
+    def setUp(self):
+        self.informer = informers.Informer('pods')
+
+    def test_not_synced_until_listed(self):
+        self.assertFalse(self.informer.synced)
+        self.assertFalse(self.informer.is_fresh())
+        self.informer.replace([], '10')
+        self.assertTrue(self.informer.synced)
+        self.assertEqual(self.informer.resource_version, '10')
+
+    def test_list_by_namespace(self):
+        self.informer.replace([k8s_pod('a', 'ns1', 'p1'),
+                               k8s_pod('b', 'ns1', 'p1'),
+                               k8s_pod('c', 'ns2', 'p2')], '10')
+        self.assertEqual(len(self.informer.list()), 3)
+        self.assertItemsEqual(
+            [p['metadata']['name'] for p in self.informer.list('ns1')],
+            ['a', 'b'])
+        self.assertEqual(self.informer.list('unknown'), [])
+
+    def test_events(self):
+        self.informer.replace([k8s_pod('a', 'ns1', 'p1')], '10')
+
+        self.informer.handle_event(
+            {'type': 'ADDED', 'object': k8s_pod('b', 'ns1', 'p2', '11')})
+        self.assertEqual(len(self.informer.list('ns1')), 2)
+
+        self.informer.handle_event(
+            {'type': 'MODIFIED', 'object': k8s_pod('b', 'ns1', 'p3', '12')})
+        self.assertItemsEqual(
+            [p['metadata']['labels'] for p in self.informer.list('ns1')],
+            [{'kuberdock-pod-uid': 'p1'}, {'kuberdock-pod-uid': 'p3'}])
+
+        self.informer.handle_event(
+            {'type': 'DELETED', 'object': k8s_pod('a', 'ns1', 'p1', '13')})
+        self.assertEqual(
+            [p['metadata']['name'] for p in self.informer.list()], ['b'])
+        self.assertEqual(self.informer.resource_version, '13')
+
+        self.assertFalse(self.informer.handle_event(
+            {'type': 'ERROR', 'object': {'message': 'too old'}}))
+
+    def test_readers_get_copies(self):
+        self.informer.replace([k8s_pod('a', 'ns1', 'p1')], '10')
+        self.informer.list()[0]['metadata']['name'] = 'changed'
+        self.informer.list('ns1')[0]['metadata']['labels'].clear()
+        self.assertEqual(self.informer.list(), [k8s_pod('a', 'ns1', 'p1')])
+
+    def test_staleness(self):
+        self.informer.replace([], '10')
+        self.assertTrue(self.informer.is_fresh(max_staleness=1))
+        # nothing is received, even if the watch looks alive
+        self.informer.alive_at = time.time() - 10
+        self.assertTrue(self.informer.is_fresh(max_staleness=20))
+        self.assertFalse(self.informer.is_fresh(max_staleness=5))
+
+    @mock.patch.object(informers, 'create_connection')
+    def test_watch_keeps_data_fresh(self, create_connection_mock):
+        self.informer.replace([], '10')
+        self.informer.alive_at = time.time() - 100
+        ws = create_connection_mock.return_value
+        ws.recv.side_effect = [
+            json.dumps({'type': 'ADDED',
+                        'object': k8s_pod('a', 'ns1', 'p1', '11')}),
+            informers.WebSocketTimeoutException]
+        self.assertTrue(self.informer._watch())
+        ws.close.assert_called_once_with()
+        self.assertEqual(self.informer.resource_version, '11')
+        self.assertTrue(self.informer.is_fresh(max_staleness=5))
+
+    def test_watch_timeout_is_less_than_staleness(self):
+        self.assertLess(informers.settings.K8S_INFORMERS_WATCH_TIMEOUT,
+                        informers.settings.K8S_INFORMERS_MAX_STALENESS)
+
+
+class TestGetSynced(unittest.TestCase):
+    @mock.patch.object(informers, 'get_shared')
+    def test_disabled(self, get_shared_mock):
+        with mock.patch.object(informers.settings, 'K8S_INFORMERS_ENABLED',
+                               False):
+            self.assertIsNone(informers.get_synced())
+        self.assertFalse(get_shared_mock.called)
+
+    @mock.patch.object(informers, 'get_shared')
+    def test_fallback_if_not_synced(self, get_shared_mock):
+        get_shared_mock.return_value.is_fresh.return_value = False
+        self.assertIsNone(informers.get_synced())
+        get_shared_mock.return_value.is_fresh.return_value = True
+        self.assertIs(informers.get_synced(), get_shared_mock.return_value)
+
+    @mock.patch.object(informers.SharedInformers, 'start')
+    def test_started_once_per_process(self, start_mock):
+        with mock.patch.object(informers, '_shared', None):
+            shared = informers.get_shared(app=mock.Mock())
+            self.assertIs(informers.get_shared(), shared)
+            start_mock.assert_called_once_with(mock.ANY)
+            shared.pid = -1  # e.g. forked process
+            self.assertIsNot(informers.get_shared(app=mock.Mock()), shared)
+
+
+if __name__ == '__main__':
+    unittest.main()
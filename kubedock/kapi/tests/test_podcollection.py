@@ -553,6 +553,135 @@ class TestPodCollection(DBTestCase, TestCaseMixin):
             self.pod_collection.get(3)
 
 
+class TestPodCollectionForPod(DBTestCase, TestCaseMixin):
+    def setUp(self):
+        self.user, _ = self.fixtures.user_fixtures()
+        self.pod = self.fixtures.pod(owner=self.user)
+        self.other_pods = [self.fixtures.pod(owner=self.user),
+                           self.fixtures.pod()]
+        self.mock_methods(podcollection.PodCollection,
+                          update_public_address=mock.Mock())
+        patcher = mock.patch.object(podcollection.KubeQuery, 'get',
+                                    return_value={'items': []})
+        self.addCleanup(patcher.stop)
+        self.get_mock = patcher.start()
+
+    def test_only_one_pod_loaded(self):
+        for owner in (self.user, None):
+            self.get_mock.reset_mock()
+            pod_collection = podcollection.PodCollection.for_pod(
+                self.pod.id, owner)
+
+            self.get_mock.assert_has_calls([
+                mock.call([api], ns=self.pod.namespace)
+                for api in ('pods', 'replicationcontrollers')
+            ])
+            self.assertEqual(self.get_mock.call_count, 2)
+            self.assertEqual(pod_collection._collection.keys(),
+                             [(self.pod.id, self.pod.namespace)])
+            self.assertEqual(pod_collection.get(self.pod.id, as_json=False)
+                             ['id'], self.pod.id)
+
+    def test_pod_of_another_user(self):
+        pod_collection = podcollection.PodCollection.for_pod(
+            self.other_pods[1].id, self.user)
+        self.assertFalse(self.get_mock.called)
+        with self.assertRaises(podcollection.PodNotFound):
+            pod_collection.get(self.other_pods[1].id)
+
+
+class TestPodCollectionPaginate(DBTestCase, TestCaseMixin):
+    def setUp(self):
+        self.user, _ = self.fixtures.user_fixtures()
+        self.pods = [
+            self.fixtures.pod(owner=self.user, name='pod{0}'.format(i),
+                              status=status)
+            for i, status in enumerate([POD_STATUSES.running,
+                                        POD_STATUSES.stopped,
+                                        POD_STATUSES.running,
+                                        POD_STATUSES.deleted,
+                                        POD_STATUSES.running])]
+        self.fixtures.pod()  # another user
+        self.mock_methods(podcollection.PodCollection,
+                          update_public_address=mock.Mock())
+        patcher = mock.patch.object(podcollection.KubeQuery, 'get',
+                                    return_value={'items': []})
+        self.addCleanup(patcher.stop)
+        self.get_mock = patcher.start()
+
+    def test_page(self):
+        pod_collection, total = podcollection.PodCollection.paginate(
+            self.user, limit=2, offset=1, sort='-name')
+        self.assertEqual(total, 4)
+        self.assertEqual(
+            [pod['name'] for pod in pod_collection.get(as_json=False)],
+            ['pod2', 'pod1'])
+        # only namespaces of pods in the page are fetched from k8s
+        self.assertEqual(self.get_mock.call_count, 4)
+
+    def test_status_filter(self):
+        pod_collection, total = podcollection.PodCollection.paginate(
+            self.user, status=[POD_STATUSES.running])
+        self.assertEqual(total, 3)
+        self.assertEqual(
+            [pod['name'] for pod in pod_collection.get(as_json=False)],
+            ['pod0', 'pod2', 'pod4'])
+
+    def test_empty_page(self):
+        pod_collection, total = podcollection.PodCollection.paginate(
+            self.user, offset=10)
+        self.assertEqual(total, 4)
+        self.assertEqual(pod_collection.get(as_json=False), [])
+        self.assertFalse(self.get_mock.called)
+
+
+class TestPodSetUnpaidStateTask(DBTestCase):
+    def setUp(self):
+        user, _ = self.fixtures.user_fixtures()
+        self.unpaid_pods = [
+            self.fixtures.pod(owner=user, unpaid=True,
+                              status=POD_STATUSES.running)
+            for i in range(3)]
+        self.fixtures.pod(owner=user, unpaid=True, status=POD_STATUSES.unpaid)
+        self.fixtures.pod(owner=user, status=POD_STATUSES.running)
+        patcher = mock.patch.object(podcollection.KubeQuery, 'get',
+                                    return_value={'items': []})
+        self.addCleanup(patcher.stop)
+        self.get_mock = patcher.start()
+
+    @mock.patch.object(podcollection.PodCollection, 'stop_unpaid')
+    def test_stop_unpaid_pods(self, stop_unpaid_mock):
+        failed_pod_id = self.unpaid_pods[0].id
+
+        def stop_unpaid(pod):
+            if pod.id == failed_pod_id:
+                raise APIError()
+        stop_unpaid_mock.side_effect = stop_unpaid
+
+        with mock.patch.object(podcollection, 'PodCollection',
+                               wraps=podcollection.PodCollection) as pc_mock:
+            podcollection.pod_set_unpaid_state_task.run()
+        # single collection for all pods
+        pc_mock.assert_called_once_with(pod_ids=mock.ANY)
+        self.assertItemsEqual(
+            [c[0][0].id for c in stop_unpaid_mock.call_args_list],
+            [pod.id for pod in self.unpaid_pods])
+
+    @mock.patch.object(podcollection.PodCollection, 'stop_unpaid')
+    def test_rollback_failed_stop(self, stop_unpaid_mock):
+        failed_pod_id = self.unpaid_pods[0].id
+
+        def stop_unpaid(pod):
+            if pod.id == failed_pod_id:
+                raise APIError()
+        stop_unpaid_mock.side_effect = stop_unpaid
+
+        with mock.patch.object(podcollection.db.session,
+                               'rollback') as rollback_mock:
+            podcollection.pod_set_unpaid_state_task.run()
+        rollback_mock.assert_called_once_with()
+
+
 # TODO: Move common mocks in setUp (refactor this hell)
 class TestPodCollectionStartPod(DBTestCase, TestCaseMixin):
     def setUp(self):
@@ -1392,6 +1521,70 @@ class TestPodCollectionGetPods(unittest.TestCase, TestCaseMixin):
             for api in ('pods', 'replicationcontrollers')
         ])
 
+    @mock.patch.object(podcollection.settings,
+                       'K8S_MAX_NAMESPACES_TO_LIST_SEPARATELY', 3)
+    @mock.patch.object(podcollection.KubeQuery, 'get')
+    def test_lot_of_namespaces(self, get_mock):
+        """
+        If there are a lot of namespaces, _get_pods must use cluster-wide
+        requests instead of a request per namespace
+        """
+        namespaces = [str(uuid4()) for i in range(5)]
+        get_mock.return_value = {'items': [
+            {'metadata': {'namespace': ns}} for ns in namespaces + ['other']]}
+        pod_collection = podcollection.PodCollection()
+
+        data, replicas = pod_collection._fetch_pods_and_replicas(namespaces)
+
+        get_mock.assert_has_calls([
+            mock.call([api], ns=None)
+            for api in ('pods', 'replicationcontrollers')
+        ])
+        self.assertEqual(get_mock.call_count, 2)
+        self.assertEqual([item['metadata']['namespace'] for item in data],
+                         namespaces)
+        self.assertEqual(data, replicas)
+
+    @mock.patch.object(podcollection.settings,
+                       'K8S_LABEL_SELECTOR_MAX_VALUES', 2)
+    @mock.patch.object(podcollection.settings,
+                       'K8S_MAX_NAMESPACES_TO_LIST_SEPARATELY', 3)
+    @mock.patch.object(podcollection.KubeQuery, 'get')
+    def test_lot_of_namespaces_selector(self, get_mock):
+        """
+        If there are a lot of namespaces of some user, _get_pods must filter
+        pods and RCs by label selector
+        """
+        get_mock.return_value = {'items': []}
+        self.user.pods = [mock.Mock(id=str(i), namespace=str(i),
+                                    is_deleted=(i == 2)) for i in range(6)]
+        namespaces = [str(i) for i in range(5)]
+        pod_collection = podcollection.PodCollection(self.user)
+
+        pod_collection._fetch_pods_and_replicas(namespaces)
+
+        get_mock.assert_has_calls([
+            mock.call([api], {'labelSelector': selector}, ns=None)
+            for selector in ('kuberdock-pod-uid in (0, 1)',
+                             'kuberdock-pod-uid in (3, 4)')
+            for api in ('pods', 'replicationcontrollers')
+        ])
+        self.assertEqual(get_mock.call_count, 4)
+
+    @mock.patch.object(podcollection.helpers, 'TIMING_HOOKS')
+    @mock.patch.object(podcollection.KubeQuery, 'get')
+    def test_timing_reported(self, get_mock, hooks_mock):
+        get_mock.return_value = {'items': []}
+        hook = mock.Mock()
+        hooks_mock.__iter__.return_value = [hook]
+        namespaces = [str(uuid4()) for i in range(3)]
+
+        podcollection.PodCollection()._fetch_pods_and_replicas(namespaces)
+
+        hook.assert_called_once_with(
+            'PodCollection._get_pods', mock.ANY, strategy='concurrent',
+            namespaces=3, saved=mock.ANY)
+
     @mock.patch('kubedock.kapi.podcollection.Pod')
     @mock.patch.object(podcollection.KubeQuery, 'get')
     def test_replication(self, get_mock, PodMock):
@@ -1446,11 +1639,115 @@ class TestPodCollectionGetPods(unittest.TestCase, TestCaseMixin):
         PodMock.populate.side_effect = self._get_uniq_fake_pod
 
         pod_collection = podcollection.PodCollection(self.user)
-        pod_collection._get_pods(namespace)
+        pod_collection._get_pods([namespace])
+
+        PodMock.populate.assert_has_calls(map(mock.call, api_pod_items))
+
+    @mock.patch('kubedock.kapi.podcollection.Pod')
+    @mock.patch.object(podcollection.KubeQuery, 'get')
+    def test_informers_used(self, get_mock, PodMock):
+        """
+        If informers are synced, _get_pods must not send requests to k8s
+        """
+        namespace = str(uuid4())
+        api_pod_items = [{'metadata': {'name': str(uuid4()), 'labels': {}}}
+                         for i in range(5)]
+        informers_mock = mock.MagicMock()
+        informers_mock.__getitem__.side_effect = lambda res: mock.Mock(**{
+            'list.return_value': {'pods': api_pod_items,
+                                  'replicationcontrollers': []}[res]})
+        PodMock.populate.side_effect = self._get_uniq_fake_pod
+
+        pod_collection = podcollection.PodCollection(self.user)
+        pod_collection._informers = informers_mock
+        pod_collection._get_pods([namespace])
 
+        self.assertFalse(get_mock.called)
         PodMock.populate.assert_has_calls(map(mock.call, api_pod_items))
 
 
+class TestSelectorIndex(unittest.TestCase):
+    @staticmethod
+    def _rc(name, selector):
+        return {'metadata': {'name': name},
+                'spec': {'selector': selector, 'replicas': 1}}
+
+    def test_find(self):
+        rcs = [self._rc('no-selector', None),
+               self._rc('uid1', {'kuberdock-pod-uid': 'uid1'}),
+               self._rc('uid2', {'kuberdock-pod-uid': 'uid2', 'a': 'b'}),
+               self._rc('name', {'name': 'pod1', 'app': 'web'})]
+        index = podcollection.SelectorIndex(rcs)
+
+        self.assertIs(index.find({'kuberdock-pod-uid': 'uid1'}), rcs[1])
+        self.assertIsNone(index.find({'kuberdock-pod-uid': 'uid2'}))
+        self.assertIs(index.find({'kuberdock-pod-uid': 'uid2', 'a': 'b'}),
+                      rcs[2])
+        self.assertIs(index.find({'name': 'pod1', 'app': 'web', 'x': 'y'}),
+                      rcs[3])
+        self.assertIsNone(index.find({'name': 'pod1'}))
+        self.assertIsNone(index.find({}))
+        self.assertIsNone(index.find(None))
+
+    def test_first_related_is_found(self):
+        """Result is the same as of sequential search using _is_related"""
+        rcs = [self._rc('name', {'name': 'pod1'}),
+               self._rc('uid', {'kuberdock-pod-uid': 'uid1'}),
+               self._rc('all', {})]
+        labels = {'kuberdock-pod-uid': 'uid1', 'name': 'pod1'}
+        self.assertIs(podcollection.SelectorIndex(rcs).find(labels), rcs[0])
+        self.assertIs(podcollection.SelectorIndex(rcs[1:]).find(labels),
+                      rcs[1])
+        self.assertIs(podcollection.SelectorIndex(rcs[::-1]).find(labels),
+                      rcs[2])
+
+
+class TestPodCollectionGetPodsPerformance(unittest.TestCase, TestCaseMixin):
+    """Micro-benchmark: matching pods with RCs must stay linear."""
+
+    def setUp(self):
+        def _init_podcollection(self, owner=None):
+            self.owner = owner
+            self._collection = {}
+
+        self.mock_methods(podcollection.PodCollection,
+                          '_get_namespaces', '_merge',
+                          'update_public_address',
+                          __init__=_init_podcollection)
+
+    @staticmethod
+    def _k8s_data(size):
+        pods, rcs = [], []
+        for i in xrange(size):
+            pod_id = 'pod-uid-{0}'.format(i)
+            labels = {'kuberdock-pod-uid': pod_id, 'name': 'pod-{0}'.format(i)}
+            pods.append({'metadata': {'name': 'pod-{0}-abcde'.format(i),
+                                      'namespace': pod_id, 'labels': labels},
+                         'spec': {'containers': []},
+                         'status': {'phase': 'Running'}})
+            rcs.append({'metadata': {'name': 'rc-{0}'.format(i),
+                                     'namespace': pod_id},
+                        'spec': {'replicas': 1,
+                                 'selector': {'kuberdock-pod-uid': pod_id}}})
+        return {'pods': pods, 'replicationcontrollers': rcs}
+
+    def _check(self, size):
+        data = self._k8s_data(size)
+        pod_collection = podcollection.PodCollection()
+        pod_collection._list_k8s = lambda res, **kwargs: data[res]
+        with mock.patch.object(
+                podcollection.PodCollection, '_is_related',
+                wraps=podcollection.PodCollection._is_related) as is_related:
+            pod_collection._get_pods()
+        self.assertEqual(len(pod_collection._collection), size)
+        # every RC is compared only with pods of its namespace
+        self.assertEqual(is_related.call_count, size)
+
+    def test_get_pods_is_linear(self):
+        self._check(1000)
+        self._check(10000)
+
+
 class TestPodCollectionIsRelated(unittest.TestCase, TestCaseMixin):
     def test_related(self):
         """
@@ -1509,8 +1806,10 @@ class TestPodCollectionMerge(unittest.TestCase, TestCaseMixin):
                        'owner': self.user,
                        'direct_access': '{}',
                        'kube_id': randrange(3),
-                       'config': json.dumps({'name': pod_id,
-                                             'containers': ()})}
+                       'config': json.dumps({
+                           'name': pod_id,
+                           'namespace': namespaces[i % namespaces_total],
+                           'containers': ()})}
                       for i, pod_id in enumerate(pod_ids)]
         pod_model_instances = []
         for i, data in enumerate(pods_in_db):
@@ -1521,17 +1820,17 @@ class TestPodCollectionMerge(unittest.TestCase, TestCaseMixin):
             pod_model_instances.append(pod_model_instance)
         return pod_model_instances
 
-    @mock.patch.object(podcollection.helpers, 'fetch_pods')
+    @mock.patch.object(podcollection.PodCollection, '_fetch_db_pods')
     def test_pods_fetched(self, fetch_pods_mock):
         """ _merge will fetch pods from db """
         fetch_pods_mock.return_value = []
         pod_collection = podcollection.PodCollection()
         pod_collection._collection = {}
         pod_collection._merge()
-        fetch_pods_mock.assert_called_once_with(users=True)
+        fetch_pods_mock.assert_called_once_with()
 
     @mock.patch('kubedock.kapi.podcollection.Pod')
-    @mock.patch.object(podcollection.helpers, 'fetch_pods')
+    @mock.patch.object(podcollection.PodCollection, '_fetch_db_pods')
     def test_pods_in_db_only(self, fetch_pods_mock, pod_mock):
         """ If pod exists in db only, then forge_dockers and add in
         _collection """
@@ -1569,7 +1868,7 @@ class TestPodCollectionMerge(unittest.TestCase, TestCaseMixin):
         )
 
     @mock.patch.object(podcollection.podutils, 'merge_lists')
-    @mock.patch.object(podcollection.helpers, 'fetch_pods')
+    @mock.patch.object(podcollection.PodCollection, '_fetch_db_pods')
     def test_pods_in_db_and_kubernetes(self, fetch_pods_mock,
                                        merge_lists_mock):
         """ If pod exists in db and kubernetes, then merge """
@@ -1609,6 +1908,70 @@ class TestPodCollectionMerge(unittest.TestCase, TestCaseMixin):
         ])
 
 
+class TestPodCollectionFetchDBPods(DBTestCase, TestCaseMixin):
+    def setUp(self):
+        self.mock_methods(
+            podcollection.PodCollection, '_get_namespaces', '_get_pods',
+            __init__=lambda self, owner=None: setattr(self, 'owner', owner)
+        )
+        self.kube_id = self.fixtures.Kube.get_default_kube_type()
+
+    def _add_pods(self, owner, number):
+        for i in range(number):
+            pod_id = str(uuid4())
+            self.db.session.add(DBPod(
+                id=pod_id, name='pod{0}'.format(i), owner=owner,
+                kube_id=self.kube_id, status=POD_STATUSES.stopped,
+                config=json.dumps({'namespace': pod_id, 'sid': pod_id,
+                                   'containers': [{'name': 'c', 'kubes': 1,
+                                                   'image': 'nginx'}],
+                                   'volumes': []})))
+        self.db.session.commit()
+
+    def _merge(self, owner):
+        pod_collection = podcollection.PodCollection(owner)
+        pod_collection._collection = {}
+        pod_collection._merge()
+        return pod_collection
+
+    def test_owner_pods_only(self):
+        user, _ = self.fixtures.user_fixtures()
+        another_user, _ = self.fixtures.user_fixtures()
+        self._add_pods(user, 2)
+        self._add_pods(another_user, 3)
+
+        self.assertEqual(len(self._merge(user)._collection), 2)
+        self.assertEqual(len(self._merge(another_user)._collection), 3)
+        self.assertEqual(len(self._merge(None)._collection), 5)
+
+    def test_needed_columns_only(self):
+        user, _ = self.fixtures.user_fixtures()
+        self._add_pods(user, 1)
+        self.db.session.expire_all()
+
+        db_pod = self._merge(user)._fetch_db_pods().one()
+        self.assertNotIn('unpaid', db_pod.__dict__)
+        self.assertIn('config', db_pod.__dict__)
+
+    def test_queries_count(self):
+        """Number of queries of _merge must not depend on number of pods."""
+        another_user, _ = self.fixtures.user_fixtures()
+        self._add_pods(another_user, 1000)
+        queries_count = {}
+        for pods_number in (1, 100, 1000):
+            user, _ = self.fixtures.user_fixtures()
+            self._add_pods(user, pods_number)
+            self.db.session.expire_all()
+            user.id  # refresh
+
+            with self.count_queries() as queries:
+                pod_collection = self._merge(user)
+            queries_count[pods_number] = len(queries)
+
+            self.assertEqual(len(pod_collection._collection), pods_number)
+        self.assertEqual(len(set(queries_count.values())), 1, queries_count)
+
+
 @mock.patch.object(podcollection.SystemSettings, 'get_by_name',
                    return_value=10)
 class TestPodCollectionCheckTrial(unittest.TestCase, TestCaseMixin):
@@ -1967,7 +2330,8 @@ class TestPodCollectionChangePodConfig(TestCase, TestCaseMixin):
 
     def setUp(self):
         self.mock_methods(podcollection.PodCollection,
-                          '_get_namespaces', '_get_pods', '_merge')
+                          '_get_namespaces', '_get_pods_namespaces',
+                          '_get_pods', '_merge')
 
         self.node = 'node1.kuberdock.local'
         self.pod_collection = podcollection.PodCollection()
@@ -208,7 +208,8 @@ class TestPodStates(DBTestCase):
         self.pod1.kube_id = bill_models.Kube.get_default_kube_type(),
 
 
-@mock.patch.object(usage, 'fix_pods_timeline_heavy', mock.Mock())
+@mock.patch.object(usage, 'fix_pods_timeline_heavy',
+                   mock.Mock(return_value=set()))
 class TestUpdateStates(DBTestCase):
     def setUp(self):
         self.containers = [{'name': '23edwed3', 'kubes': 3},
@@ -367,6 +368,112 @@ class TestUpdateStates(DBTestCase):
         db.session.refresh(cs1)
         self.assertEqual(cs1.end_time, cs2.start_time)
 
+    def test_heavy_fix_states_are_returned(self):
+        CS = usage.ContainerState
+        name = self.containers[0]['name']
+        # two open states overlap the started one
+        for minute in (0, 1):
+            CS(pod_state=self.pod_state, container_name=name,
+               docker_id=str(uuid4()),
+               start_time=datetime(2015, 11, 25, 12, minute)).save()
+        fixed = CS.query.first()
+        with mock.patch.object(usage, 'fix_pods_timeline_heavy',
+                               return_value={fixed}) as heavy_mock:
+            updated = usage.update_states(self.event_started)
+        heavy_mock.assert_called_once_with()
+        self.assertIn(fixed, updated)
+
+    def _pod_with_containers(self, count):
+        containers = [{'name': 'c{0}'.format(i)} for i in range(count)]
+        pod = self.fixtures.pod(config=json.dumps({'containers': containers}))
+        statuses = [{
+            'name': container['name'],
+            'state': {'running': {'startedAt': '2015-11-25T12:42:45Z'}},
+            'lastState': {},
+            'containerID': 'docker://{0}'.format(uuid4().hex),
+        } for container in containers]
+        return pod, {
+            'metadata': {'labels': {'kuberdock-pod-uid': pod.id}},
+            'spec': {},
+            'status': {'containerStatuses': statuses,
+                       'startTime': '2015-11-10T12:12:12Z'},
+        }
+
+    def test_number_of_statements(self):
+        """Number of SQL statements per event doesn't depend on number of
+        containers in the pod."""
+        counts = []
+        for size in (2, 20):
+            pod, k8s_pod = self._pod_with_containers(size)
+            with self.count_queries() as modified:
+                usage.update_states(k8s_pod, event_type='MODIFIED')
+            with self.count_queries() as deleted:
+                usage.update_states(k8s_pod, event_type='DELETED')
+            counts.append((len(modified), len(deleted)))
+            self.assertEqual(
+                usage.ContainerState.query.join(usage.PodState).filter(
+                    usage.PodState.pod_id == pod.id,
+                    usage.ContainerState.end_time.isnot(None)).count(),
+                size)
+        self.assertEqual(counts[0], counts[1])
+
+
+class TestFixContainerStatesOverlap(DBTestCase):
+    """kapi.usage.fix_container_states_overlap"""
+    def setUp(self):
+        self.pod = self.fixtures.pod()
+        self.pod_state = usage.PodState(
+            pod_id=self.pod.id, kube_id=self.pod.kube_id,
+            start_time=datetime(2015, 11, 25, 12)).save()
+        self.t = [datetime(2015, 11, 25, 12, i) for i in range(6)]
+
+    def _cs(self, start, end=None, exit_code=None, **kwargs):
+        return usage.ContainerState(
+            pod_state=self.pod_state, container_name='c1',
+            docker_id=str(uuid4()), start_time=start, end_time=end,
+            exit_code=exit_code, **kwargs).save()
+
+    def test_fix(self):
+        CS, t = usage.ContainerState, self.t
+        # kubes of the last state differ, it's still the same container
+        cs1, cs2 = self._cs(t[0]), self._cs(t[1], t[5], exit_code=0)
+        cs3 = self._cs(t[2], kubes=2)
+        self.assertEqual(len(usage.fix_container_states_overlap()), 2)
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(
+            (cs1.end_time, cs1.exit_code, cs1.reason),
+            (t[1],) + CS.REASONS.missed)
+        self.assertEqual((cs2.end_time, cs2.exit_code), (t[2], 0))
+        self.assertIsNone(cs3.end_time)
+
+    def test_same_start_time(self):
+        t = self.t
+        cs1, cs2 = self._cs(t[0]), self._cs(t[0], kubes=2)
+        cs3 = self._cs(t[1])
+        self.assertEqual(len(usage.fix_container_states_overlap()), 2)
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual((cs1.end_time, cs2.end_time), (t[1], t[1]))
+        self.assertIsNone(cs3.end_time)
+
+    def test_since(self):
+        t = self.t
+        # closed long ago, overlapped states are fixed by heavy fix only
+        old = self._cs(t[0], t[3])
+        self._cs(t[1], t[2])
+        self.assertEqual(usage.fix_container_states_overlap(since=t[4]), [])
+
+        # an open state is checked with all history of the container
+        self._cs(t[3])
+        self.assertEqual(
+            len(usage.fix_container_states_overlap(since=t[4])), 1)
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(old.end_time, t[1])
+
 
 if __name__ == '__main__':
     # logging.basicConfig(stream=sys.stderr)
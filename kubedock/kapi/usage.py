@@ -21,12 +21,11 @@
 import json
 from flask import current_app
 from datetime import datetime
-from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 
 from ..core import db, ConnectionPool
 from ..pods.models import Pod
 from ..usage.models import PodState, ContainerState
-from ..utils import atomic
+from ..utils import atomic, parse_datetime_str
 
 
 def select_pod_states_history(pod_id, depth=0):
@@ -48,11 +47,81 @@ def select_pod_states_history(pod_id, depth=0):
     return [item.to_dict() for item in query]
 
 
+def _to_datetime(value):
+    if isinstance(value, basestring):
+        return parse_datetime_str(value)
+    return value
+
+
+def _container_states_info(container_statuses):
+    """Get states of containers from k8s container statuses.
+
+    :returns: list of tuples
+        (container_name, state_type, state, docker_id, start_time)
+    """
+    result = []
+    for container in container_statuses:
+        if 'containerID' not in container:
+            continue
+        # k8s fires "MODIFIED" pod event when docker_id of container changes.
+        # (container restart in the same pod)
+        # k8s provides us last state of previous docker container and the
+        # current state of a new one.
+        for state_type, state in (container['lastState'].items() +
+                                  container['state'].items()):
+            if state_type == 'terminated':
+                # Terminated state may optionally include containerID. It means
+                # previous container in running state. There are some issues
+                # about wrong assignment of terminated state:
+                # https://github.com/kubernetes/kubernetes/issues/17971
+                # https://github.com/kubernetes/kubernetes/issues/21125
+                docker_id_source = state
+            else:
+                docker_id_source = container
+            if 'containerID' not in docker_id_source:
+                # Do not process states with empty container id. The field is
+                # optional. We can't process such states.
+                continue
+            docker_id = docker_id_source['containerID'].split('docker://')[-1]
+
+            start = _to_datetime(state.get('startedAt'))
+            if start is None:
+                continue
+            result.append((container['name'], state_type, state, docker_id,
+                           start))
+    return result
+
+
+def _load_container_states(pod_id, names, min_start):
+    """Load, with one query, all container states of the pod that may be
+    updated by states of containers `names` started not before `min_start`:
+    the same states and the ones that overlap them.
+
+    :returns: dict container_name -> list of ContainerState
+    """
+    result = {name: [] for name in names}
+    if not names:
+        return result
+    query = ContainerState.query.join(PodState).filter(
+        PodState.pod_id == pod_id,
+        ContainerState.container_name.in_(names),
+        db.or_(ContainerState.start_time >= min_start,
+               ContainerState.end_time.is_(None),
+               ContainerState.end_time > min_start),
+    )
+    for cs in query:
+        result[cs.container_name].append(cs)
+    return result
+
+
 @atomic(nested=False)
 def update_states(k8s_pod, event_type=None, event_time=None):
     """Update and fix container and pod states using data from k8s pod resource.
     Works well even if `k8s_pod_status`es are processed in a wrong order.
 
+    All needed states of the pod are loaded with one query, changes are
+    computed in memory and written with one flush at the end.
+
     :param k8s_pod: k8s Pod
         http://kubernetes.io/v1.1/docs/api-reference/v1/definitions.html#_v1_pod
     :param event_type: k8s event type or None
@@ -66,31 +135,12 @@ def update_states(k8s_pod, event_type=None, event_time=None):
     host = k8s_pod['spec'].get('nodeName')
     k8s_pod_status = k8s_pod['status']
     event_time = event_time or datetime.utcnow().replace(microsecond=0)
-    pod_start_time = k8s_pod_status.get('startTime')
+    pod_start_time = _to_datetime(k8s_pod_status.get('startTime'))
     if pod_start_time is None:
         return updated_CS
     needs_heavy_timeline_fix = False
     deleted = event_type == 'DELETED'
 
-    # get or create pod state
-    pod = Pod.query.get(pod_id)
-    pod_state = PodState.query.filter(PodState.start_time == pod_start_time,
-                                      PodState.pod_id == pod_id
-                                      ).first()
-    if pod_state is None:
-        current_app.logger.debug(
-            'create PodState: {0} {1} {2}'.format(pod_id, host, pod_start_time)
-        )
-        pod_state = PodState(pod_id=pod_id,
-                             hostname=host,
-                             start_time=pod_start_time,
-                             kube_id=pod.kube_id)
-        db.session.add(pod_state)
-    if event_type is not None and (pod_state.last_event_time is None or
-                                   event_time >= pod_state.last_event_time):
-        pod_state.last_event = event_type
-        pod_state.last_event_time = event_time
-
     # get data from our db
     pod = Pod.query.get(pod_id)
     kubes = {container.get('name'): container.get('kubes', 1)  # fallback
@@ -99,45 +149,44 @@ def update_states(k8s_pod, event_type=None, event_time=None):
     if k8s_kubes:
         kubes.update(json.loads(k8s_kubes))
 
-    # process container states
-    for container in (k8s_pod_status.get('containerStatuses') or []):
-        if 'containerID' not in container:
-            continue
-        container_name = container['name']
-        container_kubes = kubes.get(container_name, 1)
+    states_info = _container_states_info(
+        k8s_pod_status.get('containerStatuses') or [])
 
-        # k8s fires "MODIFIED" pod event when docker_id of container changes.
-        # (container restart in the same pod)
-        # k8s provides us last state of previous docker container and the
-        # current state of a new one.
-        for state_type, state in (container['lastState'].items() +
-                                  container['state'].items()):
-            if state_type == 'terminated':
-                # Terminated state may optionally include containerID. It means
-                # previous container in running state. There are some issues
-                # about wrong assignment of terminated state:
-                # https://github.com/kubernetes/kubernetes/issues/17971
-                # https://github.com/kubernetes/kubernetes/issues/21125
-                docker_id_source = state
-            else:
-                docker_id_source = container
-            if 'containerID' not in docker_id_source:
-                # Do not process states with empty container id. The field is
-                # optional. We can't process such states.
-                continue
-            docker_id = docker_id_source['containerID'].split('docker://')[-1]
+    with db.session.no_autoflush:
+        # get or create pod state, load open pod states with the same query
+        pod_states = PodState.query.filter(
+            PodState.pod_id == pod_id,
+            db.or_(PodState.start_time == pod_start_time,
+                   PodState.end_time.is_(None))).all()
+        pod_state = next((ps for ps in pod_states
+                          if ps.start_time == pod_start_time), None)
+        if pod_state is None:
+            current_app.logger.debug('create PodState: {0} {1} {2}'.format(
+                pod_id, host, pod_start_time))
+            pod_state = PodState(pod_id=pod_id,
+                                 hostname=host,
+                                 start_time=pod_start_time,
+                                 kube_id=pod.kube_id)
+            db.session.add(pod_state)
+        if event_type is not None and (pod_state.last_event_time is None or
+                                       event_time >= pod_state.last_event_time):
+            pod_state.last_event = event_type
+            pod_state.last_event_time = event_time
 
-            start = state.get('startedAt')
-            if start is None:
-                continue
+        container_states = _load_container_states(
+            pod_id, list({info[0] for info in states_info}),
+            min([info[4] for info in states_info] or [None]))
+        existing = {(cs.container_name, cs.docker_id, cs.kubes, cs.start_time):
+                    cs for states in container_states.itervalues()
+                    for cs in states}
+
+        # process container states
+        for container_name, state_type, state, docker_id, start in states_info:
+            container_kubes = kubes.get(container_name, 1)
 
             # get or create CS
-            cs = ContainerState.query.filter(
-                ContainerState.container_name == container_name,
-                ContainerState.docker_id == docker_id,
-                ContainerState.kubes == container_kubes,
-                ContainerState.start_time == start,
-            ).first()
+            cs = existing.get((container_name, docker_id, container_kubes,
+                               start))
             if cs is None:
                 cs = ContainerState(
                     pod_state=pod_state,
@@ -147,6 +196,9 @@ def update_states(k8s_pod, event_type=None, event_time=None):
                     start_time=start,
                 )
                 db.session.add(cs)
+                existing[(container_name, docker_id, container_kubes,
+                          start)] = cs
+                container_states[container_name].append(cs)
             updated_CS.add(cs)
 
             # reset CS if it was marked as missing
@@ -155,7 +207,7 @@ def update_states(k8s_pod, event_type=None, event_time=None):
                 cs.end_time, cs.exit_code, cs.reason = None, None, None
 
             # get end_time
-            cs.end_time = state.get('finishedAt') or cs.end_time
+            cs.end_time = _to_datetime(state.get('finishedAt')) or cs.end_time
             if cs.end_time is None and (state_type == 'terminated' or deleted):
                 cs.end_time = event_time
 
@@ -180,31 +232,26 @@ def update_states(k8s_pod, event_type=None, event_time=None):
                 cs.exit_code, cs.reason = ContainerState.REASONS.pod_was_stopped
 
             # fix overlaping
-            try:
-                prev_cs = ContainerState.query.join(PodState).filter(
-                    PodState.pod_id == pod_id,
-                    ContainerState.container_name == container_name,
-                    ContainerState.start_time < start,
-                    db.or_(ContainerState.end_time > start,
-                           ContainerState.end_time.is_(None)),
-                ).one()
-            except MultipleResultsFound:
+            overlapped = [
+                prev_cs for prev_cs in container_states[container_name]
+                if prev_cs.start_time < start and
+                (prev_cs.end_time is None or prev_cs.end_time > start)]
+            if len(overlapped) > 1:
                 needs_heavy_timeline_fix = True
-            except NoResultFound:
-                pass
-            else:
-                prev_cs.fix_overlap(start)
-                updated_CS.add(prev_cs)
-    prev_ps = PodState.query.filter(PodState.pod_id == pod_id,
-                                    PodState.start_time < pod_state.start_time,
-                                    db.or_(PodState.end_time > pod_state.start_time,
-                                           PodState.end_time.is_(None))).first()
-    if prev_ps:
-        PodState.close_other_pod_states(pod_id, pod_state.start_time, commit=False)
-
-    if deleted and (pod_state.end_time is None or
-                    k8s_pod_status.get('phase') == 'Failed'):
-        pod_state.end_time = event_time
+            elif overlapped:
+                overlapped[0].fix_overlap(start, refresh=False)
+                updated_CS.add(overlapped[0])
+
+        if deleted and (pod_state.end_time is None or
+                        k8s_pod_status.get('phase') == 'Failed'):
+            pod_state.end_time = event_time
+
+    # all changes are written here with one flush
+    db.session.flush()
+    if any(ps.end_time is None and ps.start_time < pod_state.start_time
+           for ps in pod_states):
+        PodState.close_other_pod_states(pod_id, pod_state.start_time,
+                                        commit=False)
 
     if needs_heavy_timeline_fix:
         updated_CS.update(fix_pods_timeline_heavy())
@@ -212,46 +259,81 @@ def update_states(k8s_pod, event_type=None, event_time=None):
     return updated_CS
 
 
+def fix_container_states_overlap(since=None):
+    """Close container states that overlap the next state of the same
+    container in one UPDATE statement.
+
+    The next state is found with LEAD() over distinct start times of each
+    container of a pod, so states started at the same time are cut at the
+    start of the next later one. Overlapping state is cut at the start of
+    the next one (see `ContainerState.fix_overlap`).
+
+    :param since: if specified, only containers with open states or states
+        started or finished after this time are checked
+    :returns: list of primary keys of fixed ContainerStates
+    """
+    cs_table = ContainerState.__table__
+    ps_table = PodState.__table__
+    container = (PodState.pod_id, ContainerState.container_name)
+    next_start = db.func.lead(ContainerState.start_time).over(
+        partition_by=container, order_by=ContainerState.start_time)
+    starts = db.session.query(
+        PodState.pod_id, ContainerState.container_name,
+        ContainerState.start_time, next_start.label('next_start'),
+    ).join(PodState).group_by(*(container + (ContainerState.start_time,)))
+    if since is not None:
+        changed = db.session.query(*container).join(PodState).filter(
+            db.or_(ContainerState.end_time.is_(None),
+                   ContainerState.end_time >= since,
+                   ContainerState.start_time >= since),
+        ).distinct().subquery()
+        starts = starts.join(changed, db.and_(
+            PodState.pod_id == changed.c.pod_id,
+            ContainerState.container_name == changed.c.container_name))
+    timeline = starts.subquery()
+    missed_exit_code, missed_reason = ContainerState.REASONS.missed
+    no_reason = db.and_(cs_table.c.exit_code.is_(None),
+                        cs_table.c.reason.is_(None))
+    query = cs_table.update().where(db.and_(
+        cs_table.c.pod_state_id == ps_table.c.id,
+        ps_table.c.pod_id == timeline.c.pod_id,
+        cs_table.c.container_name == timeline.c.container_name,
+        cs_table.c.start_time == timeline.c.start_time,
+        timeline.c.next_start.isnot(None),
+        db.or_(cs_table.c.end_time.is_(None),
+               cs_table.c.end_time > timeline.c.next_start),
+    )).values(
+        end_time=timeline.c.next_start,
+        exit_code=db.case([(no_reason, missed_exit_code)],
+                          else_=cs_table.c.exit_code),
+        reason=db.case([(no_reason, missed_reason)],
+                       else_=cs_table.c.reason),
+    ).returning(*cs_table.primary_key.columns)
+    fixed = [tuple(row) for row in db.session.execute(query)]
+    if fixed:
+        current_app.logger.warn(
+            '{0} overlapping ContainerStates fixed'.format(len(fixed)))
+    return fixed
+
+
 def fix_pods_timeline_heavy():
     """
     Fix time lines overlapping
     This task should not be performed during normal operation
     :returns: set of updated ContainerStates
     """
-    updated_CS = set()
     redis = ConnectionPool.get_connection()
 
     if redis.get('fix_pods_timeline_heavy'):
-        return updated_CS
+        return set()
 
     redis.setex('fix_pods_timeline_heavy', 3600, 'true')
-
-    # t0 = datetime.now()
-
-    cs1 = db.aliased(ContainerState, name='cs1')
-    ps1 = db.aliased(PodState, name='ps1')
-    cs2 = db.session.query(ContainerState, PodState.pod_id).join(PodState).subquery()
-    cs_query = db.session.query(cs1, cs2.c.start_time).join(
-        ps1, ps1.id == cs1.pod_state_id
-    ).join(
-        cs2, db.and_(ps1.pod_id == cs2.c.pod_id,
-                     cs1.container_name == cs2.c.container_name)
-    ).filter(
-        cs1.start_time < cs2.c.start_time,
-        db.or_(cs1.end_time > cs2.c.start_time,
-               cs1.end_time.is_(None))
-    ).order_by(
-        ps1.pod_id, cs1.container_name, db.desc(cs1.start_time), cs2.c.start_time
-    )
-
-    prev_cs = None
-    for cs1_obj, cs2_start_time in cs_query:
-        if cs1_obj is not prev_cs:
-            cs1_obj.fix_overlap(cs2_start_time)
-            updated_CS.add(cs1_obj)
-        prev_cs = cs1_obj
-
-    # print('fix_pods_timeline_heavy: {0}'.format(datetime.now() - t0))
-
+    fixed = fix_container_states_overlap()
     redis.delete('fix_pods_timeline_heavy')
-    return updated_CS
+    if not fixed:
+        return set()
+    # states were changed by UPDATE statement, so reload the ones which
+    # are already in the session
+    primary_key = ContainerState.__table__.primary_key.columns
+    return set(ContainerState.query.populate_existing().filter(
+        db.tuple_(*primary_key).in_(fixed)))
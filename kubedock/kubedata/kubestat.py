@@ -18,13 +18,22 @@
 # You should have received a copy of the GNU General Public License
 # along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
 
+import calendar
+import json
+import re
 import sys
+from datetime import datetime
+from hashlib import md5
 
 import requests
 
 from kubedock import settings
+from kubedock.core import ConnectionPool
 from kubedock.exceptions import InternalAPIError
 
+#: redis hash with numbers of cache hits and misses of InfluxDB queries
+CACHE_COUNTERS_KEY = 'influxdb-cache/counters'
+
 
 class InfluxDBError(InternalAPIError):
     pass
@@ -42,7 +51,38 @@ class InfluxDBUnexpectedAnswer(InfluxDBError):
         super(InfluxDBUnexpectedAnswer, self).__init__(message)
 
 
-def _query(query_str):
+def _query(query_str, cache=True):
+    """Query InfluxDB. Results are cached in redis for STATS_CACHE_TIMEOUT
+    seconds, so equal queries from different processes hit InfluxDB once.
+    """
+    if not cache:
+        content, _ = _fetch(query_str)
+        try:
+            return json.loads(content)
+        except ValueError as e:
+            raise InfluxDBUnexpectedAnswer(e), None, sys.exc_info()[2]
+    key = 'influxdb-cache/' + md5(query_str).hexdigest()
+    redis = ConnectionPool.get_connection()
+    content = redis.get(key)
+    if content is not None:
+        redis.hincrby(CACHE_COUNTERS_KEY, 'hits')
+    else:
+        content, ok = _fetch(query_str)
+        p = redis.pipeline()
+        p.hincrby(CACHE_COUNTERS_KEY, 'misses')
+        if ok:
+            p.setex(key, settings.STATS_CACHE_TIMEOUT, content)
+        p.execute()
+    try:
+        return json.loads(content)
+    except ValueError as e:
+        raise InfluxDBUnexpectedAnswer(e), None, sys.exc_info()[2]
+
+
+def _fetch(query_str):
+    """
+    :returns: tuple (response body, True if request was successful)
+    """
     url = 'http://{host}:{port}/query' \
         .format(host=settings.INFLUXDB_HOST,
                 port=settings.INFLUXDB_PORT)
@@ -59,15 +99,47 @@ def _query(query_str):
             url=url,
             params=params
         )
-        return r.json()
+        return r.content, r.ok
     except requests.ConnectionError as e:
         raise InfluxDBConnectionError(e), None, sys.exc_info()[2]
-    except ValueError as e:
-        raise InfluxDBUnexpectedAnswer(e), None, sys.exc_info()[2]
 
 
-def get_node_stat(nodename, start, end):
-    b = QueryBuilder(start, end)
+def _write(lines):
+    """Write points to InfluxDB.
+
+    :param lines: list of points in line protocol with timestamps in seconds
+    """
+    url = 'http://{host}:{port}/write' \
+        .format(host=settings.INFLUXDB_HOST,
+                port=settings.INFLUXDB_PORT)
+    params = {
+        'db': settings.INFLUXDB_DATABASE,
+        'u': settings.INFLUXDB_USER,
+        'p': settings.INFLUXDB_PASSWORD,
+        'precision': 's',
+    }
+    try:
+        r = requests.post(url=url, params=params, data='\n'.join(lines))
+    except requests.ConnectionError as e:
+        raise InfluxDBConnectionError(e), None, sys.exc_info()[2]
+    if not r.ok:
+        raise InfluxDBUnexpectedAnswer(r.content)
+
+
+def get_cache_counters():
+    """Numbers of hits and misses of InfluxDB queries cache."""
+    counters = ConnectionPool.get_connection().hgetall(CACHE_COUNTERS_KEY)
+    return {name: int(counters.get(name, 0)) for name in ('hits', 'misses')}
+
+
+def _align(dt, interval=settings.STATS_SAMPLING_INTERVAL):
+    """Round datetime down to the multiple of interval (in seconds)."""
+    timestamp = calendar.timegm(dt.utctimetuple())
+    return datetime.utcfromtimestamp(timestamp - timestamp % interval)
+
+
+def get_node_stat(nodename, start, end, resolution=None):
+    b = QueryBuilder(start, end, resolution)
     f = node_filter(nodename)
     query_str = ' '.join((
         b.start_new().with_selector(CpuLimitSelector).with_filter(f).build(),
@@ -95,8 +167,8 @@ def get_node_stat(nodename, start, end):
     }
 
 
-def get_pod_stat(pod_name, start, end):
-    b = QueryBuilder(start, end)
+def get_pod_stat(pod_name, start, end, resolution=None):
+    b = QueryBuilder(start, end, resolution)
     f = pod_filter(pod_name)
     query_str = ' '.join((
         b.start_new().with_selector(CpuLimitSelector).with_filter(f).build(),
@@ -120,8 +192,32 @@ def get_pod_stat(pod_name, start, end):
     }
 
 
-def get_container_stat(pod_name, container_name, start, end):
-    b = QueryBuilder(start, end)
+def get_pods_stat(pod_names, start, end, resolution=None):
+    """Get CPU and memory stats of several pods with one query.
+
+    :returns: dict pod_name -> dict with the same CPU and memory series as
+        `get_pod_stat` returns
+    """
+    b = QueryBuilder(start, end, resolution)
+    f = pods_filter(pod_names)
+    selectors = (CpuLimitSelector, CpuUsageSelector, MemoryLimitSelector,
+                 MemoryUsageSelector)
+    query_str = ' '.join(
+        b.start_new().with_selector(selector).with_filter(f)
+        .with_group_by('namespace_name').build()
+        for selector in selectors)
+    response = _query(query_str)
+    data = response['results']
+    result = {pod_name: {} for pod_name in pod_names}
+    for selector, selector_data in zip(selectors, data):
+        series = transform_grouped_data(selector_data, 'namespace_name')
+        for pod_name in pod_names:
+            result[pod_name][selector.measurement] = series.get(pod_name, [])
+    return result
+
+
+def get_container_stat(pod_name, container_name, start, end, resolution=None):
+    b = QueryBuilder(start, end, resolution)
     f = container_filter(pod_name, container_name)
     query_str = ' '.join((
         b.start_new().with_selector(CpuLimitSelector).with_filter(f).build(),
@@ -142,15 +238,24 @@ def get_container_stat(pod_name, container_name, start, end):
 
 
 class QueryBuilder(object):
+    """Builds InfluxDB queries of points in the time range.
+
+    If resolution (in seconds) is set, points are aggregated by intervals of
+    this length with `GROUP BY time()` and empty intervals are skipped.
+    Start and end of the range are rounded down to STATS_SAMPLING_INTERVAL.
+    """
     template = 'select {fields} from "{measurement}" ' \
                'where {filter} ' \
                "and time >= '{start}' and time <= '{end}' " \
                '{group_by_section}' \
                'order by time asc;'
 
-    def __init__(self, start, end):
-        self._start = start
-        self._end = end
+    def __init__(self, start, end, resolution=None):
+        # aligned to heapster sampling, so the same query is built for
+        # requests within one sampling interval
+        self._start = _align(start)
+        self._end = _align(end)
+        self._resolution = resolution
         self._source = {}
 
     def start_new(self):
@@ -160,15 +265,27 @@ class QueryBuilder(object):
     def build(self):
         source = self._source
         selector = source['selector']
-        if selector.group_by:
-            group_by = 'group by "%s" ' % selector.group_by
+        group_by = []
+        if self._resolution:
+            fields = ', '.join('{0}("{1}") as "{1}"'.format(
+                selector.aggregate, field) for field in selector.fields)
+            group_by.append('time(%ds)' % self._resolution)
+        else:
+            fields = ', '.join(selector.fields)
+        for tag in (selector.group_by, source.get('group_by')):
+            if tag:
+                group_by.append('"%s"' % tag)
+        if group_by:
+            group_by_section = 'group by %s ' % ', '.join(group_by)
         else:
-            group_by = ""
+            group_by_section = ""
+        if self._resolution:
+            group_by_section += 'fill(none) '
         return self.template.format(
-            fields=', '.join(selector.fields),
-            measurement=selector.measurement,
+            fields=fields,
+            measurement=source.get('measurement', selector.measurement),
             filter=source['filter'],
-            group_by_section=group_by,
+            group_by_section=group_by_section,
             start=self._start,
             end=self._end
         )
@@ -177,10 +294,19 @@ class QueryBuilder(object):
         self._source['selector'] = selector
         return self
 
+    def with_measurement(self, measurement):
+        """Query other measurement than the selector's one."""
+        self._source['measurement'] = measurement
+        return self
+
     def with_filter(self, filter_):
         self._source['filter'] = filter_
         return self
 
+    def with_group_by(self, tag):
+        self._source['group_by'] = tag
+        return self
+
 
 def node_filter(nodename):
     return "nodename = '%s' and type = 'node'" % nodename
@@ -190,6 +316,15 @@ def pod_filter(pod_name):
     return "namespace_name = '%s' and type = 'pod'" % pod_name
 
 
+def pods_filter(pod_names):
+    return "namespace_name =~ /^(%s)$/ and type = 'pod'" \
+           % '|'.join(re.escape(pod_name) for pod_name in pod_names)
+
+
+def cluster_filter(rollup):
+    return "resolution = '%d'" % rollup
+
+
 def container_filter(pod_name, container_name):
     return "namespace_name = '%s' and container_name = '%s' " \
            "and type = 'pod_container'" \
@@ -200,10 +335,13 @@ class SelectorBase(object):
     fields = ('value',)
     measurement = 'some_measurement'
     group_by = None
+    # function used to aggregate points of one interval
+    aggregate = 'mean'
 
 
 class CpuLimitSelector(SelectorBase):
     measurement = 'cpu/request'
+    aggregate = 'max'
 
 
 class CpuUsageSelector(SelectorBase):
@@ -212,6 +350,7 @@ class CpuUsageSelector(SelectorBase):
 
 class MemoryLimitSelector(SelectorBase):
     measurement = 'memory/request'
+    aggregate = 'max'
 
 
 class MemoryUsageSelector(SelectorBase):
@@ -229,6 +368,7 @@ class TxbSelector(SelectorBase):
 class FsLimitSelector(SelectorBase):
     measurement = 'filesystem/limit'
     group_by = 'resource_id'
+    aggregate = 'max'
 
 
 class FsUsageSelector(SelectorBase):
@@ -236,6 +376,78 @@ class FsUsageSelector(SelectorBase):
     group_by = 'resource_id'
 
 
+#: intervals (in seconds) of precomputed cluster stats
+CLUSTER_ROLLUPS = (60, 60 * 60)
+#: selectors of node stats summed up in cluster rollups
+CLUSTER_SELECTORS = (CpuLimitSelector, CpuUsageSelector, MemoryLimitSelector,
+                     MemoryUsageSelector, RxbSelector, TxbSelector)
+
+
+def rollup_cluster_stat(start, end, resolution):
+    """Sum up stats of all nodes by intervals of `resolution` seconds in the
+    time range and write the totals to "cluster/..." measurements.
+    Points of every node are aggregated first, so the total does not depend
+    on how many samples of a node got into the interval. Rollups may be
+    recomputed for the same range, points are just overwritten.
+
+    :returns: number of written points
+    """
+    b = QueryBuilder(start, end, resolution)
+    query_str = ' '.join(
+        b.start_new().with_selector(selector).with_filter("type = 'node'")
+        .with_group_by('nodename').build()
+        for selector in CLUSTER_SELECTORS)
+    response = _query(query_str, cache=False)
+    lines = []
+    for selector, data in zip(CLUSTER_SELECTORS, response['results']):
+        totals = {}
+        for series in data.get('series', []):
+            for time, value in series['values']:
+                totals[time] = totals.get(time, 0) + value
+        lines.extend(
+            '{0},resolution={1} value={2} {3}'.format(
+                cluster_measurement(selector), resolution, float(value),
+                _timestamp(time))
+            for time, value in sorted(totals.iteritems()))
+    if lines:
+        _write(lines)
+    return len(lines)
+
+
+def get_cluster_stat(start, end, resolution=None):
+    """Get stats of the whole cluster from rollups.
+
+    The longest rollups that are not longer than resolution are used.
+    If resolution is longer than rollups interval, points are aggregated
+    further.
+    """
+    rollup = CLUSTER_ROLLUPS[0]
+    for interval in CLUSTER_ROLLUPS:
+        if (resolution or 0) >= interval:
+            rollup = interval
+    b = QueryBuilder(start, end,
+                     resolution if resolution > rollup else None)
+    f = cluster_filter(rollup)
+    query_str = ' '.join(
+        b.start_new().with_selector(selector)
+        .with_measurement(cluster_measurement(selector))
+        .with_filter(f).build()
+        for selector in CLUSTER_SELECTORS)
+    response = _query(query_str)
+    data = response['results']
+    return {selector.measurement: transform_flat_data(selector_data)
+            for selector, selector_data in zip(CLUSTER_SELECTORS, data)}
+
+
+def cluster_measurement(selector):
+    return 'cluster/' + selector.measurement
+
+
+def _timestamp(time):
+    return calendar.timegm(
+        datetime.strptime(time, '%Y-%m-%dT%H:%M:%SZ').utctimetuple())
+
+
 def transform_flat_data(data):
     try:
         d = data['series'][0]
@@ -260,7 +472,21 @@ def transform_fs_grouped_data(data):
     return values
 
 
+def transform_grouped_data(data, tag):
+    """
+    :returns: dict value of the tag -> list of Point
+    """
+    try:
+        d = data['series']
+    except KeyError:
+        return {}
+    return {s['tags'][tag]: [Point(*x) for x in s['values']] for s in d}
+
+
 class Point(object):
+    # there are tens of thousands of points in stats of long time ranges
+    __slots__ = ('time', 'value')
+
     def __init__(self, time, value):
         self.time = time
         self.value = value
@@ -22,19 +22,23 @@ import gevent
 import json
 import os
 import requests
+from collections import OrderedDict
 from datetime import datetime
+from gevent.event import Event
+from gevent.lock import BoundedSemaphore
 from socket import error as socket_error
 from paramiko.ssh_exception import SSHException
 from websocket import (create_connection, WebSocketException,
                        WebSocketConnectionClosedException)
 
 from flask import current_app
-from .core import ConnectionPool, ssh_connect, db
+from .core import ConnectionPool, SSHConnectionPool, db
 from .billing.models import Kube
 from .nodes.models import Node
 from .pods.models import Pod, PersistentDisk
+from .pods.utils import bump_pods_version
 from .users.models import User
-from .settings import KUBERDOCK_INTERNAL_USER
+from .settings import KUBERDOCK_INTERNAL_USER, FSLIMIT_BATCH_WINDOW
 from .utils import (get_api_url, unregistered_pod_warning,
                     send_event_to_role, send_event_to_user,
                     pod_without_id_warning, k8s_json_object_hook,
@@ -60,6 +64,12 @@ ETCD_POD_STATES = 'pod_states'
 ETCD_POD_STATES_URL = ETCD_URL.format('/'.join([
     ETCD_KUBERDOCK, ETCD_POD_STATES]))
 MAX_ATTEMPTS = 10
+# How often throughput of pod_states relay is logged
+RELAY_STATS_INTERVAL = 60  # in seconds
+# Number of greenlets handling events of one listener
+EVENT_WORKERS = 4
+# Max number of received, but not handled events of one listener
+EVENT_QUEUE_SIZE = 1000
 # How ofter we will send error about listener reconnection to sentry
 ERROR_TIMEOUT = 3 * 60  # in seconds
 LISTENER_PROBLEM_MSG = ("Problems in the listeners module have been "
@@ -115,6 +125,9 @@ def process_pods_event(data, app, event_time=None, live=True):
         unregistered_pod_warning(pod_id)
         return
 
+    # state of the pod in k8s is a part of cached pod lists
+    bump_pods_version(db_pod.owner_id)
+
     # if live, we need to send events to frontend
     if db_pod.status == POD_STATUSES.stopping and event_type == 'DELETED':
         helpers.set_pod_status(pod_id, POD_STATUSES.stopped, send_update=live)
@@ -143,21 +156,94 @@ def process_pods_event(data, app, event_time=None, live=True):
             set_limit(host, pod_id, containers, app)
 
 
-# TODO: put it in some other place if needed.
-# It was moved from utils to resolve
-# circular imports (Kube model)
-def set_limit(host, pod_id, containers, app):
-    ssh, errors = ssh_connect(host)
+class FsLimitBatcher(object):
+    """Collects fs limits of containers and applies all limits for one node
+    with a single fslimit.py call after a short batching window.
+    """
+
+    def __init__(self, window=FSLIMIT_BATCH_WINDOW):
+        self.window = window
+        # host -> (limits, attempt)
+        self._pending = {}
+        # host -> scheduled flush, at most one per host
+        self._timers = {}
+
+    def add(self, host, limits, app, attempt=1):
+        """Schedule limits ({container_id: disk_space}) for the host."""
+        pending, pending_attempt = self._pending.get(host, (None, attempt))
+        if pending is None:
+            pending = OrderedDict()
+        pending.update(limits)
+        self._pending[host] = (pending, max(attempt, pending_attempt))
+        if host not in self._timers:
+            self._timers[host] = gevent.spawn_later(
+                self.window, self.flush, host, app)
+
+    def flush(self, host, app):
+        """Apply pending limits of the host. Failed batch is retried up to
+        MAX_ATTEMPTS times together with limits added in the meantime.
+        """
+        # limits added while this batch is being applied get a new timer
+        self._timers.pop(host, None)
+        limits, attempt = self._pending.pop(host, (None, 1))
+        if not limits:
+            return True
+        with app.app_context():
+            if apply_fslimits(host, limits):
+                return True
+            if attempt >= MAX_ATTEMPTS:
+                current_app.logger.error(
+                    "Can't set fs limits on {0}, skip {1}".format(
+                        host, dict(limits)))
+                return False
+            current_app.logger.warning(
+                "Can't set fs limits on {0}, retry".format(host))
+        # limits added while this batch was being applied are newer
+        newer, _ = self._pending.pop(host, ({}, attempt))
+        limits.update(newer)
+        self.add(host, limits, app, attempt + 1)
+        return False
+
+
+fslimit_batcher = FsLimitBatcher()
+
+
+def apply_fslimits(host, limits):
+    """Run fslimit.py on the node using pooled SSH connection.
+
+    :param limits: dict {container_id: disk_space_str}
+    """
+    ssh, errors = SSHConnectionPool.get_connection(host)
     if errors:
         current_app.logger.warning(
             "Can't connect to {}, {}".format(host, errors))
         return False
-    spaces = dict(
-        (i, (s, u)) for i, s, u in Kube.query.values(
-            Kube.id, Kube.disk_space, Kube.disk_space_units
+    limits_repr = ' '.join('='.join(limit) for limit in limits.items())
+    try:
+        _, o, e = ssh.exec_command(
+            'python /var/lib/kuberdock/scripts/fslimit.py containers '
+            '{0}'.format(limits_repr)
         )
-    )  # workaround
+        exit_status = o.channel.recv_exit_status()
+        if exit_status > 0:
+            current_app.logger.error(
+                'Error fslimit.py with exit status {}, {},{}'.format(
+                    exit_status, o.read(), e.read()))
+            return False
+    except SSHException:
+        current_app.logger.warning("Can't set fslimit", exc_info=True)
+        SSHConnectionPool.discard(host, ssh)
+        return False
+    return True
 
+
+# TODO: put it in some other place if needed.
+# It was moved from utils to resolve
+# circular imports (Kube model)
+def set_limit(host, pod_id, containers, app):
+    """Schedule fs limits for running containers of the pod.
+    Limits are applied by `fslimit_batcher` in background.
+    """
     pod = Pod.query.filter_by(id=pod_id).first()
 
     if pod is None:
@@ -167,36 +253,22 @@ def set_limit(host, pod_id, containers, app):
     config = json.loads(pod.config)
     kube_type = pod.kube_id
     # kube = Kube.query.get(kube_type) this query raises an exception
-    limits = []
+    space, unit = next(Kube.query.filter(Kube.id == kube_type).values(
+        Kube.disk_space, Kube.disk_space_units), (0, 'GB'))  # workaround
+    disk_space_unit = unit[0].lower() if unit else ''
+    if disk_space_unit not in ('', 'k', 'm', 'g', 't'):
+        disk_space_unit = ''
+    limits = OrderedDict()
     for container in config['containers']:
         container_name = container['name']
         if container_name not in containers:
             continue
         # disk_space = kube.disk_space * container['kubes']
-        space, unit = spaces.get(kube_type, (0, 'GB'))
         disk_space = space * container['kubes']
-        disk_space_unit = unit[0].lower() if unit else ''
-        if disk_space_unit not in ('', 'k', 'm', 'g', 't'):
-            disk_space_unit = ''
         disk_space_str = '{0}{1}'.format(disk_space, disk_space_unit)
-        limits.append((containers[container_name], disk_space_str))
-    limits_repr = ' '.join('='.join(limit) for limit in limits)
-    try:
-        _, o, e = ssh.exec_command(
-            'python /var/lib/kuberdock/scripts/fslimit.py containers '
-            '{0}'.format(limits_repr)
-        )
-        exit_status = o.channel.recv_exit_status()
-        if exit_status > 0:
-            current_app.logger.error(
-                'Error fslimit.py with exit status {}, {},{}'.format(
-                    exit_status, o.read(), e.read()))
-            return False
-    except SSHException:
-        current_app.logger.warning("Can't set fslimit", exc_info=True)
-        return False
-    finally:
-        ssh.close()
+        limits[containers[container_name]] = disk_space_str
+    if limits:
+        fslimit_batcher.add(host, limits, app)
     return True
 
 
@@ -505,14 +577,153 @@ def prelist_version(url):
                         'Request result is {0}'.format(res.text))
 
 
+class EventDispatcher(object):
+    """Bounded queue of watch events between websocket reader and handlers.
+
+    Events are partitioned between workers by namespace (by name for
+    objects without namespace), so events of one KuberDock pod, including
+    old and new k8s pods during restart, are handled in order by one worker,
+    while events of different namespaces are handled concurrently. Pending
+    MODIFIED event of an object is dropped when a newer MODIFIED event of
+    the same object is queued.
+
+    Resource version saved in redis is the last one such that all events up
+    to it are handled, so no events are lost after restart.
+    """
+
+    def __init__(self, app, func, redis_key, workers=EVENT_WORKERS,
+                 max_size=EVENT_QUEUE_SIZE):
+        self.app = app
+        self.func = func
+        self.redis_key = redis_key
+        self.last_received = 0
+        self.last_saved = 0
+        self.coalesced = 0
+        self._slots = BoundedSemaphore(max_size)
+        # every partition is a queue of events by their sequence number
+        self._partitions = [OrderedDict() for _ in range(workers)]
+        # object key -> sequence number of the object's last queued event,
+        # if it's MODIFIED and not handled yet
+        self._modified = {}
+        self._seq = 0
+        self._wakeups = [Event() for _ in range(workers)]
+        self._in_flight = set()
+        self._greenlets = []
+
+    @staticmethod
+    def _version(data):
+        return int(data['object']['metadata']['resourceVersion'])
+
+    def start(self):
+        if not self._greenlets:
+            self._greenlets = [gevent.spawn(self._work, i)
+                               for i in range(len(self._partitions))]
+
+    def stop(self):
+        gevent.killall(self._greenlets)
+        self._greenlets = []
+
+    def reset(self, version):
+        """Start from the version (already handled)."""
+        self.last_received = self.last_saved = int(version)
+        self._in_flight.clear()
+
+    def put(self, data):
+        """Add event to the queue. Blocks if the queue is full.
+
+        :returns: False if the event is already received, True otherwise
+        """
+        version = self._version(data)
+        if version <= self.last_received:
+            return False
+        self.last_received = version
+        metadata = data['object']['metadata']
+        key = (metadata.get('namespace'), metadata['name'])
+        index = hash(key[0] or key[1]) % len(self._partitions)
+        partition = self._partitions[index]
+
+        self._seq += 1
+        if data['type'] == 'MODIFIED' and key in self._modified:
+            replaced = partition.pop(self._modified[key])
+            partition[self._seq] = data
+            self._modified[key] = self._seq
+            self._in_flight.add(version)
+            self._done(self._version(replaced))
+            self.coalesced += 1
+            return True
+        self._slots.acquire()
+        self._in_flight.add(version)
+        partition[self._seq] = data
+        if data['type'] == 'MODIFIED':
+            self._modified[key] = self._seq
+        else:
+            self._modified.pop(key, None)
+        self._wakeups[index].set()
+        return True
+
+    def _done(self, version):
+        self._in_flight.discard(version)
+        if self._in_flight:
+            safe_version = min(self._in_flight) - 1
+        else:
+            safe_version = self.last_received
+        if safe_version > self.last_saved:
+            ConnectionPool.get_connection().set(self.redis_key, safe_version)
+            self.last_saved = safe_version
+
+    def _work(self, index):
+        partition = self._partitions[index]
+        wakeup = self._wakeups[index]
+        with self.app.app_context():
+            while True:
+                if not partition:
+                    wakeup.clear()
+                    wakeup.wait()
+                    continue
+                seq, data = partition.popitem(last=False)
+                # worker must survive any error, otherwise its partition is
+                # never drained and `put` blocks forever on full queue
+                try:
+                    try:
+                        metadata = data['object']['metadata']
+                        key = (metadata.get('namespace'), metadata['name'])
+                        if self._modified.get(key) == seq:
+                            del self._modified[key]
+                        self._handle(data)
+                    finally:
+                        self._slots.release()
+                        self._done(self._version(data))
+                except Exception:
+                    current_app.logger.exception(
+                        'Error while handle event {}'.format(data))
+
+    def _handle(self, data):
+        for _ in range(MAX_ATTEMPTS):
+            try:
+                # Because listeners aren't managed by flask we
+                # have to do all transaction management manually
+                with session_scope(db.session):
+                    self.func(data, self.app)
+                return
+            except Exception:
+                current_app.logger.warning(
+                    'Error while process event {}'.format(data),
+                    exc_info=True)
+                gevent.sleep(0.2)
+        send_event_to_role(
+            'notify:error', {'message': LISTENER_PROBLEM_MSG}, 'Admin')
+        current_app.logger.error('skip event {}'.format(data))
+
+
 def listen_fabric(watch_url, list_url, func, k8s_json_object_hook=None):
     fn_name = func.func_name
     redis_key = 'LAST_EVENT_' + fn_name
 
     def result(app):
-        retry = 0
         last_reconnect = datetime.fromtimestamp(0)
+        dispatcher = EventDispatcher(app, func, redis_key)
         with app.app_context():
+            dispatcher.start()
             while True:
                 try:
                     current_app.logger.debug(
@@ -529,6 +740,8 @@ def listen_fabric(watch_url, list_url, func, k8s_json_object_hook=None):
                         # Only after connection to ensure last_saved was correct
                         # before save it to redis
                         redis.set(redis_key, last_saved)
+                        if not dispatcher.last_received:
+                            dispatcher.reset(last_saved)
                     except (socket_error, WebSocketException) as e:
                         now = datetime.now()
                         logger = current_app.logger.warning
@@ -550,32 +763,16 @@ def listen_fabric(watch_url, list_url, func, k8s_json_object_hook=None):
                             new_version = str(int(prelist_version(list_url)) -
                                               MAX_ETCD_VERSIONS)
                             redis.set(redis_key, new_version)
+                            dispatcher.reset(new_version)
                             break
                         data = filter_event(data, app)
                         if not data:
                             continue
-                        evt_version = data['object']['metadata']['resourceVersion']
-                        last_saved = redis.get(redis_key)
-                        if int(evt_version) > int(last_saved or '0'):
-                            if retry < MAX_ATTEMPTS:
-                                # Because listeners aren't managed by flask we
-                                # have to do all transaction management manually
-                                with session_scope(db.session):
-                                    func(data, app)
-                            else:
-                                send_event_to_role(
-                                    'notify:error',
-                                    {'message': LISTENER_PROBLEM_MSG},
-                                    'Admin')
-                                current_app.logger.error(
-                                    'skip event {}'.format(data), exc_info=True)
-
-                            redis.set(redis_key, evt_version)
-                        retry = 0
+                        dispatcher.put(data)
                 except KeyboardInterrupt:
+                    dispatcher.stop()
                     break
                 except Exception as e:
-                    retry += 1
                     if not (isinstance(e, WebSocketConnectionClosedException)
                             and e.message == 'Connection is already closed.'):
                         now = datetime.now()
@@ -675,45 +872,103 @@ def listen_fabric_etcd(url):
     return result
 
 
+class RelayStats(object):
+    """Throughput counters of pod_states relay, logged periodically."""
+
+    def __init__(self, interval=RELAY_STATS_INTERVAL):
+        self.interval = interval
+        self.counters = {'records': 0, 'events': 0, 'skipped': 0}
+        self.last_logged = datetime.now()
+
+    def count(self, **counters):
+        for name, value in counters.iteritems():
+            self.counters[name] += value
+        now = datetime.now()
+        if (now - self.last_logged).total_seconds() >= self.interval:
+            current_app.logger.info(
+                'pod_states: processed {events} events from {records} etcd '
+                'records, {skipped} skipped'.format(**self.counters))
+            self.counters = dict.fromkeys(self.counters, 0)
+            self.last_logged = now
+
+
+relay_stats = RelayStats()
+
+
+def _pod_states_events(node):
+    """Get (timestamp, event) pairs from pod_states record.
+
+    k8s2etcd puts either one event, where key is the timestamp, or
+    a batch: {"batch": [[timestamp, event], ...]}.
+    """
+    _, ts = node['key'].rsplit('/', 1)
+    value = json.loads(node['value'])
+    if isinstance(value, dict) and 'batch' in value:
+        return value['batch']
+    return [(ts, node['value'])]
+
+
+def process_pod_state(app, ts, obj):
+    """Process one relayed event.
+
+    :returns: False if event was skipped
+    """
+    try:
+        k8s_obj = json.loads(obj, object_hook=k8s_json_object_hook)
+        k8s_obj = filter_event(k8s_obj, app)
+        event_time = datetime.fromtimestamp(float(ts))
+    except Exception:
+        current_app.logger.exception(
+            'Error while parse event {}'.format(obj))
+        return False
+    if k8s_obj is None:
+        return True
+    for _ in range(MAX_ATTEMPTS):
+        try:
+            process_pods_event(k8s_obj, app, event_time, live=True)
+            return True
+        except Exception:
+            current_app.logger.warning(
+                "Error while process event {}".format(obj), exc_info=True)
+    # max_attempts exceeded, we skip event
+    send_event_to_role(
+        'notify:error', {'message': LISTENER_PROBLEM_MSG}, 'Admin')
+    current_app.logger.error('skip event {}'.format(obj))
+    return False
+
+
 def process_records(app, nodes):
     for node in nodes:
         # TODO: for now send all prelist event to process,
         # but there are no need to send old events to frontend,
         # just need to save them to db. Need to have separate method
         # or filter old events by time.
+        key = node['key']
+        events = skipped = 0
         try:
-            key = node['key']
-            for _ in range(MAX_ATTEMPTS):
-                _, ts = key.rsplit('/', 1)
-                obj = node['value']
-                k8s_obj = json.loads(obj, object_hook=k8s_json_object_hook)
-                k8s_obj = filter_event(k8s_obj, app)
-                event_time = datetime.fromtimestamp(float(ts))
-                if k8s_obj is not None:
-                    try:
-                        process_pods_event(k8s_obj, app, event_time, live=True)
-                        break
-                    except Exception:
-                        current_app.logger.warning(
-                            "Error while process event {}".format(node),
-                            exc_info=True)
-
-            else:
-                # max_attempts exceeded, we skip event
-                send_event_to_role(
-                    'notify:error', {'message': LISTENER_PROBLEM_MSG}, 'Admin')
-                current_app.logger.error(
-                    'skip event {}'.format(node), exc_info=True)
-        except:
+            records = _pod_states_events(node)
+        except Exception:
             current_app.logger.exception(
                 "Error while parse event {}".format(node))
-        finally:
-            # at the end we remove node anyway
-            r = requests.delete(ETCD_URL.format(key))
-            # don't know what we can do more, just log it
-            if not r.ok:
-                current_app.logger.warning(
-                    "error while delete:{}".format(r.text))
+            records = []
+        for record in records:
+            # a bad event must not prevent handling of the rest of batch
+            events += 1
+            try:
+                ts, obj = record
+                if not process_pod_state(app, ts, obj):
+                    skipped += 1
+            except Exception:
+                current_app.logger.exception(
+                    'Error while process event {}'.format(record))
+                skipped += 1
+        # at the end we remove node anyway, one request per batch
+        r = requests.delete(ETCD_URL.format(key))
+        # don't know what we can do more, just log it
+        if not r.ok:
+            current_app.logger.warning(
+                "error while delete:{}".format(r.text))
+        relay_stats.count(records=1, events=events, skipped=skipped)
 
 
 listen_pods = listen_fabric(
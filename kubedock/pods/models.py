@@ -25,12 +25,14 @@ import string
 import types
 import uuid
 from functools import reduce
+from itertools import chain
 from hashlib import md5
 
 import ipaddress
 from datetime import datetime
 from flask import current_app
 from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
 
 from ..core import db
 from ..exceptions import NoFreeIPs, PodExists
@@ -39,6 +41,7 @@ from kubedock import utils
 from ..models_mixin import BaseModelMixin
 from ..settings import DOCKER_IMG_CACHE_TIMEOUT, KUBERDOCK_INTERNAL_USER
 from ..users.models import User
+from .utils import bump_pods_version
 
 
 class Pod(BaseModelMixin, db.Model):
@@ -776,3 +779,24 @@ class PrivateRegistryFailedLogin(BaseModelMixin, db.Model):
     login = db.Column(db.String(255), primary_key=True, nullable=False)
     registry = db.Column(db.String(255), primary_key=True, nullable=False)
     created = db.Column(db.DateTime, primary_key=True, nullable=False)
+
+
+@db.event.listens_for(Session, 'after_flush')
+def _collect_changed_pods(session, flush_context):
+    owners = session.info.setdefault('changed_pods_owners', set())
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Pod):
+            owners.add(obj.owner_id)
+
+
+@db.event.listens_for(Session, 'after_commit')
+def _invalidate_changed_pods(session):
+    """Invalidate cached pod lists after changes are visible to others."""
+    owners = session.info.pop('changed_pods_owners', None)
+    if owners:
+        bump_pods_version(*owners)
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def _forget_changed_pods(session):
+    session.info.pop('changed_pods_owners', None)
@@ -20,6 +20,7 @@
 
 import json
 
+import mock
 from uuid import uuid4
 from ..models import Pod as DBPod, PodIP
 from .. import models
@@ -150,3 +151,22 @@ class TestPod(DBTestCase, TestCaseMixin):
 
         res = self.pod_with_ip.pinned_node
         self.assertEqual(res, None)
+
+
+class TestPodsVersion(DBTestCase):
+    @mock.patch.object(models, 'bump_pods_version')
+    def test_changed_pods_invalidated(self, bump_pods_version_mock):
+        pod = self.fixtures.pod()
+        bump_pods_version_mock.assert_called_once_with(pod.owner_id)
+
+        bump_pods_version_mock.reset_mock()
+        pod.name = 'new-name'
+        self.db.session.commit()
+        bump_pods_version_mock.assert_called_once_with(pod.owner_id)
+
+        bump_pods_version_mock.reset_mock()
+        pod.name = 'another-name'
+        self.db.session.flush()
+        self.db.session.rollback()
+        self.db.session.commit()
+        self.assertFalse(bump_pods_version_mock.called)
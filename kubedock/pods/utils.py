@@ -0,0 +1,83 @@
+# KuberDock - is a platform that allows users to run applications using Docker
+# container images and create SaaS / PaaS based on these applications.
+# Copyright (C) 2017 Cloud Linux INC
+#
+# This file is part of KuberDock.
+#
+# KuberDock is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# KuberDock is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
+
+"""Versions of users' pod lists and cache of serialized pod lists.
+
+Version of pods of some owner is incremented on every change of the pods
+(see `bump_pods_version`), so a cached list is valid while the version is
+the same. Cached lists also expire after PODS_LIST_CACHE_TIMEOUT seconds,
+because some parts of pods (e.g. state in kubernetes) may change without
+any events.
+"""
+from hashlib import md5
+
+from ..core import ConnectionPool
+from ..settings import PODS_LIST_CACHE_TIMEOUT
+
+
+def _version_key(owner_id):
+    return 'pods-version/%s' % owner_id
+
+
+def _list_key(owner_id, version):
+    return 'pods-list/%s/%s' % (owner_id, version)
+
+
+def get_pods_version(owner_id):
+    redis = ConnectionPool.get_connection()
+    return int(redis.get(_version_key(owner_id)) or 0)
+
+
+def bump_pods_version(*owner_ids):
+    """Invalidate cached pod lists of the owners."""
+    owner_ids = set(owner_ids) - {None}
+    if not owner_ids:
+        return
+    redis = ConnectionPool.get_connection()
+    p = redis.pipeline()
+    for owner_id in owner_ids:
+        p.incr(_version_key(owner_id))
+    p.execute()
+
+
+def get_cached_pods(owner_id, version):
+    """Get serialized pod list of the owner.
+
+    :returns: tuple (etag, serialized list) or None if it's not cached
+    """
+    redis = ConnectionPool.get_connection()
+    cached = redis.hmget(_list_key(owner_id, version), 'etag', 'data')
+    if None in cached:
+        return None
+    return tuple(cached)
+
+
+def cache_pods(owner_id, version, data):
+    """Save serialized pod list of the owner.
+
+    :returns: etag of the data
+    """
+    etag = md5(data).hexdigest()
+    key = _list_key(owner_id, version)
+    redis = ConnectionPool.get_connection()
+    p = redis.pipeline()
+    p.hmset(key, {'etag': etag, 'data': data})
+    p.expire(key, PODS_LIST_CACHE_TIMEOUT)
+    p.execute()
+    return etag
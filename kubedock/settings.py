@@ -177,6 +177,33 @@ KUBE_API_VERSION = 'v1'
 KUBE_API_PORT = 8080
 KUBE_API_HOST = 'localhost'
 KUBE_MASTER_URL = 'http://{}:{}/'.format(KUBE_API_HOST, KUBE_API_PORT)
+# Timeouts (in seconds) of requests to k8s API
+KUBE_API_CONNECT_TIMEOUT = 5
+KUBE_API_READ_TIMEOUT = 60
+# How many times GET, PUT and DELETE requests to k8s API are retried on
+# connection errors and timeouts
+KUBE_API_RETRIES = 2
+# Max number of keep-alive connections to k8s API in one process
+KUBE_API_POOL_SIZE = 20
+
+# In-memory copy of pods, replication controllers and namespaces kept in sync
+# with k8s in every process (see kapi/informers.py)
+K8S_INFORMERS_ENABLED = True
+# How long (in seconds) cached data may be used after it was known to be in
+# sync with k8s (last list, watch reconnect or event)
+K8S_INFORMERS_MAX_STALENESS = 30
+# Reconnect to the watch if there were no events during this time (seconds),
+# must be less than K8S_INFORMERS_MAX_STALENESS, otherwise data of a quiet
+# cluster is considered stale
+K8S_INFORMERS_WATCH_TIMEOUT = 20
+
+# PodCollection lists pods of up to this number of namespaces with separate
+# (concurrent) requests, for more namespaces cluster-wide lists are used
+K8S_MAX_NAMESPACES_TO_LIST_SEPARATELY = 20
+# Max number of concurrent requests to k8s API in one PodCollection
+K8S_LIST_CONCURRENCY = 10
+# Max number of values in one "label in (...)" selector
+K8S_LABEL_SELECTOR_MAX_VALUES = 100
 
 # network policy
 KUBE_NP_API_VERSION = 'net.alpha.kubernetes.io/v1alpha1'
@@ -184,6 +211,12 @@ KUBE_NP_BASE_URL = 'apis'
 
 # If None, defaults will be used
 SSH_KEY_FILENAME = '/var/lib/nginx/.ssh/id_rsa'
+# Persistent SSH connections to nodes (see core.SSHConnectionPool) are closed
+# after this number of seconds without use
+SSH_POOL_IDLE_TIMEOUT = 5 * 60
+# fs limits of containers that are started on one node within this number of
+# seconds are applied with one fslimit.py call
+FSLIMIT_BATCH_WINDOW = 0.5
 
 INFLUXDB_HOST = os.environ.get('INFLUXDB_HOST', '127.0.0.1')
 INFLUXDB_PORT = 8086
@@ -191,6 +224,21 @@ INFLUXDB_TABLE = 'stats'
 INFLUXDB_USER = 'root'
 INFLUXDB_PASSWORD = 'root'
 INFLUXDB_DATABASE = 'k8s'
+# Time range of stats graphs if it's not specified in request
+STATS_DEFAULT_RANGE = 60 * 60  # in seconds
+# Stats are aggregated by intervals of such length that graphs have not more
+# points than this. Default range is not aggregated unless resolution is set.
+STATS_MAX_POINTS = 300
+# How often heapster writes stats to InfluxDB. Time ranges of stats queries
+# are aligned to it, so equal requests are served from cache
+STATS_SAMPLING_INTERVAL = 60  # in seconds
+# Results of InfluxDB queries are cached in redis for this time
+STATS_CACHE_TIMEOUT = 60  # in seconds
+# Max number of pods in one request of batch pods stats
+STATS_BATCH_MAX_PODS = 100
+# Cluster stats rollups of this number of last intervals are recomputed on
+# every run of the rollup task
+STATS_CLUSTER_ROLLUP_DEPTH = 5
 
 # Port to access elasticsearch via rest api
 ELASTICSEARCH_REST_PORT = 9200
@@ -212,13 +260,25 @@ DEFAULT_IMAGES_URL = 'https://registry.hub.docker.com'
 DOCKER_IMG_CACHE_TIMEOUT = timedelta(hours=4)
 
 SSE_KEEPALIVE_INTERVAL = 15
-SSE_POLL_INTERVAL = 0.5
+# Max number of not sent events of one SSE connection, slower clients are
+# disconnected and get missed events after reconnect
+SSE_QUEUE_SIZE = 100
 
 ID_PATH = '/var/lib/kuberdock/installation-id'
 STAT_URL = 'https://cln.cloudlinux.com/api/kd/validate.json'
 
 PUBLIC_ACCESS_ASSIGNING_TIMEOUT = 10
 
+# Max lifetime (in seconds) of cached serialized pod lists
+PODS_LIST_CACHE_TIMEOUT = 60
+
+# Max number of unpaid pods stopped concurrently by pod_set_unpaid_state_task
+UNPAID_PODS_STOP_CONCURRENCY = 10
+
+# fix_pods_timeline checks overlapping only of containers which have open
+# states or states started/finished during this period
+FIX_PODS_TIMELINE_PERIOD = timedelta(hours=1)
+
 CELERYBEAT_SCHEDULE = {
     'process-node-actions': {
         'task': 'kubedock.tasks.process_node_actions',
@@ -249,6 +309,17 @@ CELERYBEAT_SCHEDULE = {
         'task': 'kubedock.kapi.podcollection.pod_set_unpaid_state_task',
         'schedule': timedelta(minutes=5)
     },
+    # Precompute per-minute and per-hour totals of nodes stats
+    'rollup-cluster-stats-minutely': {
+        'task': 'kubedock.tasks.rollup_cluster_stats',
+        'schedule': timedelta(minutes=1),
+        'args': (60,)
+    },
+    'rollup-cluster-stats-hourly': {
+        'task': 'kubedock.tasks.rollup_cluster_stats',
+        'schedule': crontab(minute=5),
+        'args': (60 * 60,)
+    },
 }
 CELERY_IMPORTS = ('kubedock.kapi.podcollection', 'kubedock.kapi.ingress')
 # Do not store results too long. Default is 1 day.
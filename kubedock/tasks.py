@@ -43,8 +43,9 @@ from .kapi.node_utils import (
 from .kapi.pstorage import (
     delete_persistent_drives, remove_drives_marked_for_deletion,
     check_namespace_exists)
-from .kapi.usage import update_states
+from .kapi.usage import update_states, fix_container_states_overlap
 from .kd_celery import celery, exclusive_task
+from .kubedata import kubestat
 from .models import Pod, ContainerState, PodState, PersistentDisk, User
 from .nodes.models import Node, NodeAction, NodeFlag, NodeFlagNames
 from .rbac.models import Role
@@ -53,7 +54,8 @@ from .settings import (
     NODE_CEPH_AWARE_KUBERDOCK_LABEL, CEPH, CEPH_KEYRING_PATH,
     CEPH_POOL_NAME, CEPH_CLIENT_USER,
     KUBERDOCK_INTERNAL_USER, NODE_SSH_COMMAND_SHORT_EXEC_TIMEOUT,
-    CALICO, NODE_STORAGE_MANAGE_DIR, ZFS, NODE_TOBIND_EXTERNAL_IPS)
+    CALICO, NODE_STORAGE_MANAGE_DIR, ZFS, NODE_TOBIND_EXTERNAL_IPS,
+    STATS_CLUSTER_ROLLUP_DEPTH, FIX_PODS_TIMELINE_PERIOD)
 from .system_settings.models import SystemSettings
 from .users.models import SessionData
 from .utils import (
@@ -443,6 +445,21 @@ def send_stat():
     # send(collect())
 
 
+@celery.task(ignore_result=True)
+def rollup_cluster_stats(resolution):
+    """Precompute stats of the whole cluster by intervals of `resolution`
+    seconds for the last STATS_CLUSTER_ROLLUP_DEPTH intervals.
+    Intervals are recomputed by next runs, because heapster writes points
+    with a delay.
+    """
+    now = int(time.time())
+    end = datetime.utcfromtimestamp(now - now % resolution)
+    start = end - timedelta(seconds=resolution * STATS_CLUSTER_ROLLUP_DEPTH)
+    count = kubestat.rollup_cluster_stat(start, end, resolution)
+    current_app.logger.debug('Cluster stats rollup ({0}s): {1} points'.format(
+        resolution, count))
+
+
 def get_node_interface(data, node_ip):
     ip = ipaddress.ip_address(unicode(node_ip))
     patt = re.compile(r'(?P<iface>\w+)\s+inet\s+(?P<ip>[0-9\/\.]+)')
@@ -462,10 +479,10 @@ def fix_pods_timeline():
     Create ContainerStates that wasn't created and
     close the ones that must be closed.
     Close PodStates that wasn't closed.
+
+    :returns: dict with numbers of fixed states and elapsed time
     """
-    t = [time.time()]
-    css = ContainerState.query.filter(ContainerState.end_time.is_(None))
-    t.append(time.time())
+    start = time.time()
     # get pods from k8s
     # we need to get only KuberDock pods
     pods = KubeQuery().get(['pods'], {'labelSelector': 'kuberdock-pod-uid'})
@@ -474,52 +491,56 @@ def fix_pods_timeline():
         pod['metadata']['labels']['kuberdock-pod-uid']:
             k8s_json_object_hook(pod) for pod in pods.get('items', [])}
     now = datetime.utcnow().replace(microsecond=0)
-    t.append(time.time())
 
-    updated_CS = set()
     for k8s_pod in pods.itervalues():
-        updated_CS.update(update_states(k8s_pod, event_time=now))
-    t.append(time.time())
-
-    for cs in css:
-        if cs in updated_CS:
-            # pod was found in db and k8s,
-            # and k8s have info about this container
-            continue  # ContainerState was fixed in update_states()
-        cs_next = ContainerState.query.join(PodState).filter(
-            PodState.pod_id == cs.pod_state.pod_id,
-            ContainerState.container_name == cs.container_name,
-            ContainerState.start_time > cs.start_time,
-        ).order_by(ContainerState.start_time).first()
-        if cs_next:
-            cs.fix_overlap(cs_next.start_time)
-        elif pods.get(cs.pod_state.pod_id) is None:
-            # it's the last CS and pod not found in k8s
-            cs.end_time = now
-            cs.exit_code, cs.reason = ContainerState.REASONS.pod_was_stopped
+        update_states(k8s_pod, event_time=now)
+
+    # Cut every recently changed ContainerState that overlaps the next one,
+    # after that only the last states of containers may be left open.
+    # Older history is fixed by usage.fix_pods_timeline_heavy.
+    fixed_states = len(fix_container_states_overlap(
+        since=now - FIX_PODS_TIMELINE_PERIOD))
+
+    # Close the last states of pods that are not found in k8s.
+    stopped_exit_code, stopped_reason = ContainerState.REASONS.pod_was_stopped
+    open_states = db.session.query(ContainerState.pod_state_id).join(
+        PodState).filter(ContainerState.end_time.is_(None))
+    if pods:
+        open_states = open_states.filter(~PodState.pod_id.in_(pods.keys()))
+    stopped_states = ContainerState.query.filter(
+        ContainerState.end_time.is_(None),
+        ContainerState.pod_state_id.in_(open_states.subquery()),
+    ).update({
+        ContainerState.end_time: now,
+        ContainerState.exit_code: stopped_exit_code,
+        ContainerState.reason: stopped_reason,
+    }, synchronize_session=False)
 
     # Close states for deleted pods if not closed.
     # Actually it is needed to be run once, but let it be run regularly.
     # Needed because there was bug in k8s2etcd service.
     # Sometime later it can be deleted (now is 2016-04-06).
-    non_consistent_pss = db.session.query(PodState).join(PodState.pod).filter(
-        Pod.status == POD_STATUSES.deleted,
-        PodState.end_time.is_(None)
-    )
-    closed_states = 0
-    for ps in non_consistent_pss:
-        ps.end_time = datetime.utcnow()
-        closed_states += 1
+    deleted_pods = db.session.query(Pod.id).filter(
+        Pod.status == POD_STATUSES.deleted)
+    closed_states = PodState.query.filter(
+        PodState.end_time.is_(None),
+        PodState.pod_id.in_(deleted_pods.subquery()),
+    ).update({PodState.end_time: datetime.utcnow()},
+             synchronize_session=False)
 
     try:
         db.session.commit()
     except Exception:
         db.session.rollback()
         raise
-    t.append(time.time())
-    current_app.logger.debug('Fixed pods timeline: {0}'.format(
-        ['{0:.3f}'.format(t2 - t1) for t1, t2 in zip(t[:-1], t[1:])]))
-    current_app.logger.debug('Closed %s pod_states', closed_states)
+    result = {
+        'fixed_container_states': fixed_states,
+        'stopped_container_states': stopped_states,
+        'closed_pod_states': closed_states,
+        'elapsed': round(time.time() - start, 3),
+    }
+    current_app.logger.info('Fixed pods timeline: {0}'.format(result))
+    return result
 
 
 def add_k8s_node_labels(nodename, labels):
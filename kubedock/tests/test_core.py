@@ -18,12 +18,17 @@
 # You should have received a copy of the GNU General Public License
 # along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
 
+import itertools
+import json
+import os
 import unittest
 import time
 
+import mock
+
 from kubedock.testutils.testcases import FlaskTestCase
 from kubedock.testutils import create_app
-from kubedock import core
+from kubedock import core, utils
 
 
 class TestCase(FlaskTestCase):
@@ -84,5 +89,167 @@ class TestExclusiveLock(TestCase):
         self.assertTrue(lock4.lock())
 
 
+@mock.patch.object(core.EvtHub, 'get', mock.Mock())
+class TestEventHistory(TestCase):
+    """Test for utils.send_event history and core.EvtStream replay."""
+    channel = 'kd.unittest.core.TestEventHistory'
+
+    def tearDown(self):
+        core.ConnectionPool.get_connection().delete(
+            *utils.event_history_keys(self.channel))
+
+    def test_replay(self):
+        for i in range(utils.EVENT_HISTORY_SIZE + 5):
+            utils.send_event('evt', {'i': i}, channels=[self.channel])
+        conn = core.ConnectionPool.get_connection()
+        _, history_key = utils.event_history_keys(self.channel)
+        self.assertEqual(conn.zcard(history_key), utils.EVENT_HISTORY_SIZE)
+
+        last_id = utils.EVENT_HISTORY_SIZE + 3
+        messages = iter(core.EvtStream(conn, self.channel, last_id))
+        self.assertEqual(
+            list(itertools.islice(messages, 8)),
+            ['event:evt\n', 'data:{"i": 103}\n', 'id:104\n', '\n',
+             'event:evt\n', 'data:{"i": 104}\n', 'id:105\n', '\n'])
+
+
+@mock.patch.object(core, 'current_app', mock.Mock())
+@mock.patch.object(core.gevent, 'spawn')
+class TestEvtStream(unittest.TestCase):
+    """Test for core.EvtStream and core.EvtHub classes."""
+
+    def setUp(self):
+        self.conn = mock.Mock()
+        self.hub = core.EvtHub(self.conn, queue_size=2)
+        patcher = mock.patch.object(core.EvtHub, 'get',
+                                    return_value=self.hub)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fan_out(self, spawn_mock):
+        spawn_mock.return_value.dead = False
+        stream1 = core.EvtStream(self.conn, 'channel1')
+        stream2 = core.EvtStream(self.conn, 'channel1')
+        core.EvtStream(self.conn, 'channel2')
+        spawn_mock.assert_called_once_with(self.hub._listen, mock.ANY)
+        self.assertEqual(self.hub.stats()['subscribers'], 3)
+
+        self.hub.publish('channel1', json.dumps([1, 'evt', {'a': 1}]))
+        self.assertEqual(self.hub.stats()['queued'], 2)
+        for stream in (stream1, stream2):
+            messages = iter(stream)
+            self.assertEqual(next(messages), ':\n\n')
+            self.assertEqual(list(itertools.islice(messages, 4)),
+                             ['event:evt\n', 'data:{"a": 1}\n', 'id:1\n',
+                              '\n'])
+            messages.close()
+        self.assertEqual(self.hub.stats()['subscribers'], 1)
+
+    def test_keepalive(self, spawn_mock):
+        stream = core.EvtStream(self.conn, 'channel')
+        stream.timeout = 0.01
+        messages = iter(stream)
+        self.assertEqual(next(messages), ':\n\n')
+        self.assertEqual(next(messages), ':\n\n')
+
+    def test_drop_slow_consumer(self, spawn_mock):
+        stream = core.EvtStream(self.conn, 'channel')
+        for eid in range(3):
+            self.hub.publish('channel', json.dumps([eid, 'evt', {}]))
+        self.assertEqual(self.hub.stats()['dropped'], 1)
+        self.assertEqual(self.hub.stats()['subscribers'], 0)
+        self.assertEqual(list(stream), [':\n\n'])
+
+    @mock.patch.object(core.gevent, 'sleep')
+    def test_reconnect_closes_pubsub(self, sleep_mock, spawn_mock):
+        pubsubs = [mock.Mock(), mock.Mock()]
+        pubsubs[0].listen.side_effect = core.redis.ConnectionError
+        pubsubs[1].listen.side_effect = ValueError
+        self.conn.pubsub.side_effect = pubsubs
+        with self.assertRaises(ValueError):
+            self.hub._listen(mock.Mock())
+        sleep_mock.assert_called_once_with(1)
+        for pubsub in pubsubs:
+            pubsub.close.assert_called_once_with()
+
+
+@mock.patch.object(core, 'ssh_connect')
+class TestSSHConnectionPool(unittest.TestCase):
+    """Test for core.SSHConnectionPool class."""
+
+    def setUp(self):
+        core.SSHConnectionPool.pool = {}
+        core.SSHConnectionPool.pid = os.getpid()
+        patcher = mock.patch.object(core.gevent, 'spawn')
+        self.addCleanup(patcher.stop)
+        self.spawn_mock = patcher.start()
+        self.spawn_mock.return_value.dead = False
+
+    def tearDown(self):
+        core.SSHConnectionPool.pool = {}
+        core.SSHConnectionPool._evictor = None
+
+    def test_reuse_connection(self, ssh_connect_mock):
+        ssh = mock.Mock()
+        ssh_connect_mock.return_value = (ssh, None)
+        self.assertEqual(core.SSHConnectionPool.get_connection('node1'),
+                         (ssh, None))
+        self.assertEqual(core.SSHConnectionPool.get_connection('node1'),
+                         (ssh, None))
+        ssh_connect_mock.assert_called_once_with('node1', 10)
+
+        ssh.get_transport.return_value.is_active.return_value = False
+        core.SSHConnectionPool.get_connection('node1')
+        ssh.close.assert_called_once_with()
+        self.assertEqual(ssh_connect_mock.call_count, 2)
+
+    def test_connection_error(self, ssh_connect_mock):
+        ssh_connect_mock.return_value = (mock.Mock(), 'error')
+        _, error = core.SSHConnectionPool.get_connection('node1')
+        self.assertEqual(error, 'error')
+        self.assertEqual(core.SSHConnectionPool.pool, {})
+
+    @mock.patch.object(core.time, 'time')
+    def test_evict_idle(self, time_mock, ssh_connect_mock):
+        ssh = mock.Mock()
+        ssh_connect_mock.return_value = (ssh, None)
+        time_mock.return_value = 1000
+        core.SSHConnectionPool.get_connection('node1')
+        time_mock.return_value += core.SSHConnectionPool.idle_timeout + 1
+        core.SSHConnectionPool.evict_idle()
+        ssh.close.assert_called_once_with()
+        self.assertEqual(core.SSHConnectionPool.pool, {})
+
+    def test_evict_in_background(self, ssh_connect_mock):
+        ssh_connect_mock.return_value = (mock.Mock(), None)
+        core.SSHConnectionPool.get_connection('node1')
+        core.SSHConnectionPool.get_connection('node2')
+        self.spawn_mock.assert_called_once_with(
+            core.SSHConnectionPool._evict_forever)
+
+    def test_discard_failed_connection_only(self, ssh_connect_mock):
+        failed, new = mock.Mock(), mock.Mock()
+        ssh_connect_mock.return_value = (new, None)
+        core.SSHConnectionPool.pool['node1'] = (new, 1000)
+        core.SSHConnectionPool.discard('node1', failed)
+        failed.close.assert_called_once_with()
+        self.assertFalse(new.close.called)
+        self.assertEqual(core.SSHConnectionPool.pool['node1'][0], new)
+
+        core.SSHConnectionPool.discard('node1', new)
+        new.close.assert_called_once_with()
+        self.assertEqual(core.SSHConnectionPool.pool, {})
+
+    def test_fork(self, ssh_connect_mock):
+        inherited, new = mock.Mock(), mock.Mock()
+        ssh_connect_mock.return_value = (new, None)
+        core.SSHConnectionPool.pool['node1'] = (inherited, time.time())
+        core.SSHConnectionPool.pid = -1
+        self.assertEqual(core.SSHConnectionPool.get_connection('node1'),
+                         (new, None))
+        self.assertEqual(core.SSHConnectionPool.pid, os.getpid())
+        self.assertFalse(inherited.close.called)
+
+
 if __name__ == '__main__':
     unittest.main()
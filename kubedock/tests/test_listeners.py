@@ -19,8 +19,10 @@
 # along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
 
 from copy import deepcopy
+from datetime import datetime
 from collections import OrderedDict
 import flask
+import gevent
 import json
 import unittest
 import mock
@@ -167,16 +169,17 @@ class TestPodEventK8s(DBTestCase):
 
 
 class TestSetLimit(unittest.TestCase):
+    @mock.patch('kubedock.listeners.fslimit_batcher')
     @mock.patch('kubedock.listeners.Pod')
     @mock.patch('kubedock.listeners.Kube')
-    @mock.patch('kubedock.listeners.ssh_connect')
-    def test_set_limit(self, ssh_connect_mock, kube_mock, pod_mock):
+    def test_set_limit(self, kube_mock, pod_mock, batcher_mock):
         host = 'node'
         pod_id = 'abcd'
         containers = OrderedDict([('second', 'ipsum'), ('first', 'lorem')])
         app = flask.Flask(__name__)
 
-        kube_mock.query.values.return_value = (1, 1, 'GB'),
+        kube_mock.query.filter.return_value.values.return_value = iter(
+            [(1, 'GB')])
         pod_cls = type('Pod', (), {
             'kube_id': 1,
             'config': json.dumps({
@@ -187,33 +190,297 @@ class TestSetLimit(unittest.TestCase):
         })
         pod_mock.query.filter_by.return_value.first.return_value = pod_cls
 
-        stdout = mock.Mock()
-        stdout.channel.recv_exit_status.return_value = 1
-
-        ssh = mock.Mock()
-        ssh.exec_command.return_value = (mock.Mock(), stdout, mock.Mock())
-        ssh_connect_mock.return_value = (ssh, 'ignore this message')
+        self.assertTrue(listeners.set_limit(host, pod_id, containers, app))
+        batcher_mock.add.assert_called_once_with(
+            host, {'ipsum': '6g', 'lorem': '5g'}, app)
 
-        res = listeners.set_limit(host, pod_id, containers, app)
-        self.assertFalse(res)
+        pod_mock.query.filter_by.return_value.first.return_value = None
+        self.assertFalse(listeners.set_limit(host, pod_id, containers, app))
+        self.assertEqual(batcher_mock.add.call_count, 1)
 
-        ssh_connect_mock.return_value = (ssh, None)
-        res = listeners.set_limit(host, pod_id, containers, app)
-        self.assertFalse(res)
 
+class TestFsLimitBatcher(unittest.TestCase):
+    @mock.patch.object(listeners.SSHConnectionPool, 'discard')
+    @mock.patch.object(listeners.SSHConnectionPool, 'get_connection')
+    def test_one_call_per_node(self, get_connection_mock, discard_mock):
+        app = flask.Flask(__name__)
+        stdout = mock.Mock()
         stdout.channel.recv_exit_status.return_value = 0
-        res = listeners.set_limit(host, pod_id, containers, app)
-        self.assertTrue(res)
-
-        ssh.exec_command.assert_called_with(
-            'python '
-            '/var/lib/kuberdock/scripts/fslimit.py containers '
-            'ipsum=6g lorem=5g'
-        )
+        ssh = mock.Mock()
+        ssh.exec_command.return_value = (mock.Mock(), stdout, mock.Mock())
+        get_connection_mock.return_value = (ssh, None)
+
+        batcher = listeners.FsLimitBatcher(window=0.01)
+        batcher.add('node1', OrderedDict([('ipsum', '6g')]), app)
+        batcher.add('node1', OrderedDict([('lorem', '5g')]), app)
+        batcher.add('node2', OrderedDict([('dolor', '1g')]), app)
+        gevent.sleep(0.05)
+
+        self.assertEqual(get_connection_mock.call_count, 2)
+        ssh.exec_command.assert_has_calls([
+            mock.call('python /var/lib/kuberdock/scripts/fslimit.py '
+                      'containers ipsum=6g lorem=5g'),
+            mock.call('python /var/lib/kuberdock/scripts/fslimit.py '
+                      'containers dolor=1g'),
+        ], any_order=True)
         self.assertEqual(ssh.exec_command.call_count, 2)
 
-        ssh_connect_mock.assert_called_with(host)
-        self.assertEqual(ssh_connect_mock.call_count, 3)
+        stdout.channel.recv_exit_status.return_value = 1
+        self.assertFalse(listeners.apply_fslimits('node1', {'a': '1g'}))
+        ssh.exec_command.side_effect = listeners.SSHException
+        self.assertFalse(listeners.apply_fslimits('node1', {'a': '1g'}))
+        discard_mock.assert_called_once_with('node1', ssh)
+
+        get_connection_mock.return_value = (ssh, 'error')
+        self.assertFalse(listeners.apply_fslimits('node1', {'a': '1g'}))
+
+    @mock.patch.object(listeners, 'apply_fslimits')
+    def test_retry_failed_batch(self, apply_mock):
+        app = flask.Flask(__name__)
+        batcher = listeners.FsLimitBatcher(window=0.01)
+
+        def apply_fslimits(host, limits):
+            # new limits of the same container come during the first call
+            if apply_mock.call_count == 1:
+                batcher.add(host, {'lorem': '7g', 'dolor': '1g'}, app)
+                return False
+            return True
+        apply_mock.side_effect = apply_fslimits
+
+        batcher.add('node1', OrderedDict([('ipsum', '6g'), ('lorem', '5g')]),
+                    app)
+        gevent.sleep(0.05)
+        self.assertEqual(apply_mock.call_count, 2)
+        self.assertEqual(dict(apply_mock.call_args[0][1]),
+                         {'ipsum': '6g', 'lorem': '7g', 'dolor': '1g'})
+
+    @mock.patch.object(listeners, 'MAX_ATTEMPTS', 3)
+    @mock.patch.object(listeners, 'apply_fslimits', return_value=False)
+    def test_give_up(self, apply_mock):
+        batcher = listeners.FsLimitBatcher(window=0.01)
+        batcher.add('node1', {'ipsum': '6g'}, flask.Flask(__name__))
+        gevent.sleep(0.1)
+        self.assertEqual(apply_mock.call_count, 3)
+        self.assertEqual(batcher._pending, {})
+
+    @mock.patch.object(listeners, 'MAX_ATTEMPTS', 3)
+    @mock.patch.object(listeners, 'apply_fslimits', return_value=False)
+    def test_give_up_with_limits_added_during_retry(self, apply_mock):
+        app = flask.Flask(__name__)
+        batcher = listeners.FsLimitBatcher(window=0.01)
+
+        def apply_fslimits(host, limits):
+            if apply_mock.call_count == 1:
+                batcher.add(host, {'lorem': '5g'}, app)
+            return False
+        apply_mock.side_effect = apply_fslimits
+
+        batcher.add('node1', {'ipsum': '6g'}, app)
+        gevent.sleep(0.1)
+        self.assertEqual(apply_mock.call_count, 3)
+        self.assertEqual(dict(apply_mock.call_args[0][1]),
+                         {'ipsum': '6g', 'lorem': '5g'})
+        self.assertEqual(batcher._pending, {})
+        self.assertEqual(batcher._timers, {})
+
+
+@mock.patch.object(listeners, 'relay_stats', mock.Mock())
+@mock.patch.object(listeners.requests, 'delete')
+@mock.patch.object(listeners, 'process_pods_event')
+class TestProcessRecords(unittest.TestCase):
+    """Consumer of pod states relayed by k8s2etcd."""
+
+    @staticmethod
+    def _event(name):
+        return json.dumps({'type': 'MODIFIED',
+                           'object': {'metadata': {'name': name}}})
+
+    def test_single_and_batch_records(self, process_mock, delete_mock):
+        app = flask.Flask(__name__)
+        nodes = [
+            {'key': '/kuberdock/pod_states/100.5',
+             'value': self._event('pod1')},
+            {'key': '/kuberdock/pod_states/101.5',
+             'value': json.dumps({'batch': [
+                 ['101.5', self._event('pod2')],
+                 ['101.6', self._event('pod3')]]})},
+        ]
+        with app.app_context():
+            listeners.process_records(app, nodes)
+
+        self.assertEqual(
+            [c[0][0]['object']['metadata']['name']
+             for c in process_mock.call_args_list],
+            ['pod1', 'pod2', 'pod3'])
+        self.assertEqual(process_mock.call_args_list[2][0][2],
+                         datetime.fromtimestamp(101.6))
+        self.assertEqual(delete_mock.call_args_list, [
+            mock.call(listeners.ETCD_URL.format(n['key'])) for n in nodes])
+
+    def test_skip_malformed_event_only(self, process_mock, delete_mock):
+        app = flask.Flask(__name__)
+        node = {'key': '/kuberdock/pod_states/101.5',
+                'value': json.dumps({'batch': [
+                    ['101.5', self._event('pod1')],
+                    ['101.6', '{not a json'],
+                    ['bad ts', self._event('pod2')],
+                    ['101.8', self._event('pod3')]]})}
+        with app.app_context():
+            listeners.process_records(app, [node])
+
+        self.assertEqual(
+            [c[0][0]['object']['metadata']['name']
+             for c in process_mock.call_args_list],
+            ['pod1', 'pod3'])
+        delete_mock.assert_called_once_with(
+            listeners.ETCD_URL.format(node['key']))
+        listeners.relay_stats.count.assert_called_with(
+            records=1, events=4, skipped=2)
+
+
+@mock.patch.object(listeners, 'session_scope', mock.MagicMock())
+@mock.patch.object(listeners, 'send_event_to_role')
+@mock.patch.object(listeners.ConnectionPool, 'get_connection')
+class TestEventDispatcher(unittest.TestCase):
+    """Queue between k8s watch and event handlers."""
+
+    @staticmethod
+    def _event(version, name='pod1', event_type='MODIFIED', namespace='ns'):
+        return {'type': event_type,
+                'object': {'metadata': {'name': name, 'namespace': namespace,
+                                        'resourceVersion': str(version)}}}
+
+    def _dispatcher(self, func, **kwargs):
+        dispatcher = listeners.EventDispatcher(
+            flask.Flask(__name__), func, 'LAST_EVENT_test', **kwargs)
+        dispatcher.reset(10)
+        return dispatcher
+
+    def _wait(self, dispatcher):
+        dispatcher.start()
+        gevent.sleep(0.1)
+        dispatcher.stop()
+
+    def test_coalesce_modified(self, redis_mock, _):
+        handled = []
+        dispatcher = self._dispatcher(lambda data, app: handled.append(data))
+        for version in (11, 12, 13):
+            self.assertTrue(dispatcher.put(self._event(version)))
+        dispatcher.put(self._event(14, event_type='DELETED'))
+        dispatcher.put(self._event(15, name='pod2'))
+        self.assertFalse(dispatcher.put(self._event(9)))
+        self.assertEqual(dispatcher.coalesced, 2)
+
+        self._wait(dispatcher)
+        self.assertEqual(
+            sorted((e['object']['metadata']['resourceVersion'], e['type'])
+                   for e in handled),
+            [('13', 'MODIFIED'), ('14', 'DELETED'), ('15', 'MODIFIED')])
+        redis_mock.return_value.set.assert_called_with('LAST_EVENT_test', 15)
+
+    def test_order_per_object(self, redis_mock, _):
+        handled = []
+
+        def handler(data, app):
+            gevent.sleep(0.001)
+            handled.append(data['object']['metadata'])
+
+        dispatcher = self._dispatcher(handler, workers=3)
+        for version in range(11, 41):
+            dispatcher.put(self._event(
+                version, name='pod{0}'.format(version % 5),
+                event_type=('ADDED', 'DELETED')[version % 2]))
+        self._wait(dispatcher)
+
+        self.assertEqual(len(handled), 30)
+        for name in ('pod{0}'.format(i) for i in range(5)):
+            versions = [int(m['resourceVersion']) for m in handled
+                        if m['name'] == name]
+            self.assertEqual(versions, sorted(versions))
+
+    def test_order_per_namespace(self, redis_mock, _):
+        """Old and new k8s pods of one KuberDock pod share namespace, their
+        events must be handled in order by one worker.
+        """
+        handled = []
+
+        def handler(data, app):
+            gevent.sleep(0.001)
+            handled.append(data)
+
+        dispatcher = self._dispatcher(handler, workers=4)
+        events = [
+            self._event(11, name='pod-old'),
+            self._event(12, name='pod-new', event_type='ADDED'),
+            self._event(13, name='pod-old', event_type='DELETED'),
+            self._event(14, name='pod-new'),
+        ]
+        events += [self._event(v, name='other', namespace='ns{0}'.format(v))
+                   for v in range(15, 25)]
+        for event in events:
+            dispatcher.put(event)
+        self._wait(dispatcher)
+
+        self.assertEqual(
+            [(e['object']['metadata']['name'], e['type']) for e in handled
+             if e['object']['metadata']['namespace'] == 'ns'],
+            [('pod-old', 'MODIFIED'), ('pod-new', 'ADDED'),
+             ('pod-old', 'DELETED'), ('pod-new', 'MODIFIED')])
+        self.assertEqual(len(handled), 14)
+
+    def test_coalesced_event_keeps_order(self, redis_mock, _):
+        handled = []
+        dispatcher = self._dispatcher(
+            lambda data, app: handled.append(
+                int(data['object']['metadata']['resourceVersion'])))
+        dispatcher.put(self._event(11, name='pod1'))
+        dispatcher.put(self._event(12, name='pod2', event_type='ADDED'))
+        dispatcher.put(self._event(13, name='pod1'))
+        self.assertEqual(dispatcher.coalesced, 1)
+        self._wait(dispatcher)
+        self.assertEqual(handled, [12, 13])
+
+    def test_saved_version_is_not_ahead_of_handled(self, redis_mock, _):
+        dispatcher = self._dispatcher(lambda data, app: None)
+        dispatcher.put(self._event(11, name='pod1'))
+        dispatcher.put(self._event(12, name='pod2'))
+        dispatcher._done(12)
+        self.assertFalse(redis_mock.return_value.set.called)
+        dispatcher._done(11)
+        redis_mock.return_value.set.assert_called_once_with(
+            'LAST_EVENT_test', 12)
+
+    @mock.patch.object(listeners.gevent, 'sleep', mock.Mock())
+    def test_skip_failed_event(self, redis_mock, send_event_mock):
+        handler = mock.Mock(side_effect=Exception)
+        dispatcher = self._dispatcher(handler)
+        dispatcher._handle(self._event(11))
+        self.assertEqual(handler.call_count, listeners.MAX_ATTEMPTS)
+        send_event_mock.assert_called_once_with(
+            'notify:error', {'message': listeners.LISTENER_PROBLEM_MSG},
+            'Admin')
+
+    @mock.patch.object(listeners, 'MAX_ATTEMPTS', 1)
+    def test_worker_survives_errors(self, redis_mock, send_event_mock):
+        send_event_mock.side_effect = Exception('redis is down')
+        handled = []
+
+        def handler(data, app):
+            if data['object']['metadata']['name'] == 'bad':
+                raise Exception
+            handled.append(data['object']['metadata']['name'])
+
+        dispatcher = self._dispatcher(handler, workers=1, max_size=1)
+        dispatcher.start()
+        dispatcher.put(self._event(11, name='bad'))
+        # blocks until the slot of the failed event is released
+        dispatcher.put(self._event(12, name='good'))
+        gevent.sleep(0.3)
+        dispatcher.stop()
+        self.assertEqual(handled, ['good'])
+        send_event_mock.assert_called_once_with(
+            'notify:error', {'message': listeners.LISTENER_PROBLEM_MSG},
+            'Admin')
 
 
 if __name__ == '__main__':
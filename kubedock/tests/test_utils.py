@@ -22,12 +22,15 @@ import subprocess
 import unittest
 from collections import namedtuple
 from datetime import datetime
+from uuid import uuid4
 
 import mock
 
 from ..exceptions import APIError
 from ..login import get_user_role
 from ..testutils.testcases import DBTestCase
+from ..users import models as users_models, utils as users_utils
+from ..users.models import SessionData
 from ..utils import (
     atomic,
     get_api_url,
@@ -44,6 +47,7 @@ from ..utils import (
     get_version,
     nested_dict_utils,
     domainize,
+    send_event_to_user,
 )
 
 
@@ -256,6 +260,82 @@ class TestAtomic(DBTestCase):
         self.assertTrue(self.current_transaction.is_active)
 
 
+class TestSessionChannels(DBTestCase):
+    """Session ids used in send_event_to_user/role are cached in redis."""
+
+    def setUp(self):
+        users_utils.reset_session_channels()
+        self.user, _ = self.fixtures.user_fixtures()
+        self.admin, _ = self.fixtures.admin_fixtures()
+
+    def tearDown(self):
+        users_utils.reset_session_channels()
+
+    def test_channels(self):
+        sid1, sid2 = str(uuid4()), str(uuid4())
+        users_models.add_session(sid1, self.user.id, self.user.role_id)
+        self.assertEqual(
+            SessionData.get_channels(user_id=self.user.id), [sid1])
+
+        users_models.add_session(sid2, self.admin.id, self.admin.role_id)
+        with self.count_queries() as queries:
+            self.assertEqual(
+                SessionData.get_channels(role_id=self.admin.role_id), [sid2])
+            self.assertEqual(
+                SessionData.get_channels(user_id=self.user.id), [sid1])
+        self.assertEqual(queries, [])
+
+        # admin is logged in as the user
+        users_models.take_session(sid2, self.user.id)
+        self.assertEqual(
+            sorted(SessionData.get_channels(user_id=self.user.id)),
+            sorted([sid1, sid2]))
+        users_models.release_session(sid2)
+        self.assertEqual(
+            SessionData.get_channels(user_id=self.user.id), [sid1])
+
+        users_models.clean_session(sid1)
+        self.assertEqual(SessionData.get_channels(user_id=self.user.id), [])
+
+    @mock.patch('kubedock.utils.send_event')
+    def test_send_event_to_user(self, send_event_mock):
+        sid = str(uuid4())
+        users_models.add_session(sid, self.user.id, self.user.role_id)
+        SessionData.get_channels(user_id=self.user.id)
+        with self.count_queries() as queries:
+            send_event_to_user('evt', {}, self.user.id)
+        self.assertEqual(queries, [])
+        send_event_mock.assert_called_once_with(
+            'evt', {}, None, [sid], 'SSEEVT')
+
+    def test_reload_from_db(self):
+        sid = str(uuid4())
+        users_models.add_session(sid, self.user.id, self.user.role_id)
+        users_utils.reset_session_channels()
+        self.assertEqual(SessionData.get_channels(user_id=self.user.id), [sid])
+
+    def test_load_concurrent_with_update(self):
+        sid1, sid2 = str(uuid4()), str(uuid4())
+        entries = [(sid, self.user.id, self.user.role_id, None)
+                   for sid in (sid1, sid2)]
+        reads = []
+
+        class Sessions(object):
+            def __iter__(self):
+                reads.append(1)
+                if len(reads) == 1:
+                    # sid2 is committed right after sessions were read
+                    users_utils.update_session_channels(added=entries[1:])
+                    return iter(entries[:1])
+                return iter(entries)
+
+        users_utils.load_session_channels(Sessions())
+        self.assertEqual(len(reads), 2)
+        self.assertEqual(
+            sorted(SessionData.get_channels(user_id=self.user.id)),
+            sorted([sid1, sid2]))
+
+
 class TestUtilsGetApiUrl(unittest.TestCase):
 
     def test_expected_urls(self):
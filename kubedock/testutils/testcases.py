@@ -21,6 +21,7 @@
 import logging
 import os
 import unittest
+from contextlib import contextmanager
 from json import dumps as json_dumps
 
 import sqlalchemy
@@ -111,6 +112,29 @@ class DBTestCase(FlaskTestCase):
 
         self.db = db
 
+    @contextmanager
+    def count_queries(self):
+        """Collect SQL statements executed inside the `with` block.
+
+        Usage::
+
+            with self.count_queries() as queries:
+                do_something()
+            self.assertEqual(len(queries), 1)
+        """
+        queries = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute',
+                                before_cursor_execute)
+        try:
+            yield queries
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute',
+                                    before_cursor_execute)
+
 
 class APITestCase(DBTestCase):
     def create_app(self):
@@ -34,6 +34,7 @@ from kubedock import settings
 from kubedock.core import db
 from kubedock.rbac.models import Role
 from kubedock.sessions import SessionData
+from kubedock.users.utils import reset_session_channels
 from kubedock.utils import send_event_to_role
 
 # For convenience to use in update scripts:
@@ -255,6 +256,7 @@ def close_all_sessions():
         send_event_to_role('refresh', {}, role_id)
     deleted = SessionData.query.delete()
     db.session.commit()
+    reset_session_channels()
     return deleted
 
 
@@ -33,7 +33,7 @@ from kubedock.constants import (KUBERDOCK_BACKEND_POD_NAME,
                                 KUBERDOCK_INGRESS_CONFIG_MAP_NAME,
                                 KUBERDOCK_INGRESS_CONFIG_MAP_NAMESPACE,
                                 KUBERDOCK_INGRESS_POD_NAME)
-from kubedock.core import db
+from kubedock.core import ConnectionPool, db
 from kubedock.domains.models import BaseDomain, PodDomain
 from kubedock.kapi import ingress, node_utils, nodes
 from kubedock.kapi.configmap import ConfigMapClient, ConfigMapNotFound
@@ -507,6 +507,33 @@ def _upgrade_220(upd, with_testing, *args, **kwargs):
 def _downgrade_220(upd, with_testing, exception, *args, **kwargs):
     pass
 ##################### END   220 update script #################################
+####$################ BEGIN 221 update script #################################
+"""Remove old SSE events history hashes"""
+
+
+def _upgrade_node_221(upd, with_testing, env, *args, **kwargs):
+    pass
+
+
+def _downgrade_node_221(upd, with_testing, env, exception, *args, **kwargs):
+    pass
+
+
+def _upgrade_221(upd, with_testing, *args, **kwargs):
+    # History of events is kept in sorted sets SSEEVT:<channel>:history now,
+    # old hashes SSEEVT:<channel> are not used anymore
+    upd.print_log('Remove old events history...')
+    redis = ConnectionPool.get_connection()
+    old_keys = [key for key in redis.scan_iter('SSEEVT:*')
+                if redis.type(key) == 'hash']
+    if old_keys:
+        redis.delete(*old_keys)
+    upd.print_log('{0} keys removed'.format(len(old_keys)))
+
+
+def _downgrade_221(upd, with_testing, exception, *args, **kwargs):
+    pass
+##################### END   221 update script #################################
 
 updates = [
     195,
@@ -520,6 +547,7 @@ updates = [
     213,
     214,
     220,
+    221,
 ]
 
 
@@ -58,9 +58,14 @@ class ContainerState(BaseModelMixin, db.Model):
         return '<ContainerState({0})>'.format(
             ', '.join('{0}={1}'.format(*item) for item in data.iteritems()))
 
-    def fix_overlap(self, end_time):
-        """Shift end_time timestamp of container state to fix overlaping."""
-        db.session.refresh(self)
+    def fix_overlap(self, end_time, refresh=True):
+        """Shift end_time timestamp of container state to fix overlaping.
+
+        :param refresh: reload the state from db first. Pass False if the
+            state is already up to date in the session.
+        """
+        if refresh:
+            db.session.refresh(self)
         if isinstance(end_time, basestring):
             end_time = datetime.strptime(end_time, '%Y-%m-%dT%H:%M:%SZ')
         if self.end_time is None or self.end_time > end_time:
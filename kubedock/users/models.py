@@ -22,8 +22,10 @@ import datetime
 import hashlib
 import json
 
+from sqlalchemy import inspect
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.exc import ResourceClosedError, IntegrityError
+from sqlalchemy.orm import Session
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # from flask import current_app
@@ -35,7 +37,9 @@ from .signals import (
     user_logged_out_by_another, user_get_all_settings, user_get_setting,
     user_set_setting)
 from .utils import (
-    get_user_last_activity, get_online_users, enrich_tz_with_offset)
+    get_user_last_activity, get_online_users, enrich_tz_with_offset,
+    session_channels_key, get_session_channels, load_session_channels,
+    update_session_channels)
 from ..settings import DEFAULT_TIMEZONE, KUBERDOCK_INTERNAL_USER
 
 
@@ -454,6 +458,57 @@ class SessionData(db.Model):
         return "<SessionData(id='%s', role_id='%s', time_stamp='%s')>" % (
             self.id, self.role_id, self.time_stamp)
 
+    @classmethod
+    def get_channels(cls, user_id=None, role_id=None):
+        """Get ids of sessions (SSE channels) of the user or the role.
+
+        The mapping is kept in redis and updated on session changes, so db is
+        queried only if redis has lost it.
+        """
+        key = session_channels_key(user_id=user_id, role_id=role_id)
+        channels = get_session_channels(key)
+        if channels is None:
+            load_session_channels(db.session.query(
+                cls.id, cls.user_id, cls.role_id, cls.impersonated_id))
+            channels = get_session_channels(key) or set()
+        return list(channels)
+
+    def _channels_entry(self, impersonated_id):
+        return self.id, self.user_id, self.role_id, impersonated_id
+
+
+@db.event.listens_for(Session, 'after_flush')
+def _collect_changed_sessions(session, flush_context):
+    added = session.info.setdefault('added_session_channels', [])
+    removed = session.info.setdefault('removed_session_channels', [])
+    for obj in session.new:
+        if isinstance(obj, SessionData):
+            added.append(obj._channels_entry(obj.impersonated_id))
+    for obj in session.deleted:
+        if isinstance(obj, SessionData):
+            removed.append(obj._channels_entry(obj.impersonated_id))
+    for obj in session.dirty:
+        if isinstance(obj, SessionData):
+            history = inspect(obj).attrs.impersonated_id.history
+            if history.has_changes():
+                for old_id in history.deleted:
+                    removed.append(obj._channels_entry(old_id))
+                added.append(obj._channels_entry(obj.impersonated_id))
+
+
+@db.event.listens_for(Session, 'after_commit')
+def _update_session_channels(session):
+    added = session.info.pop('added_session_channels', None)
+    removed = session.info.pop('removed_session_channels', None)
+    if added or removed:
+        update_session_channels(added or (), removed or ())
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def _forget_changed_sessions(session):
+    session.info.pop('added_session_channels', None)
+    session.info.pop('removed_session_channels', None)
+
 
 #####################
 ### Users signals ###
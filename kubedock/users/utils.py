@@ -59,6 +59,95 @@ def get_online_users():
                          for x in minutes])
 
 
+SESSION_CHANNELS_LOADED_KEY = 'session-channels/loaded'
+SESSION_CHANNELS_INDEX_KEY = 'session-channels/keys'
+# incremented on every change of the sets, see `load_session_channels`
+SESSION_CHANNELS_VERSION_KEY = 'session-channels/version'
+
+
+def session_channels_key(user_id=None, role_id=None):
+    """Redis key of the set of session ids (SSE channels) of the user or the
+    role. Sessions of a user include sessions impersonated as this user.
+    """
+    if user_id is not None:
+        return 'session-channels/user/%s' % user_id
+    return 'session-channels/role/%s' % role_id
+
+
+def get_session_channels(key):
+    """
+    :returns: set of session ids or None if the mapping isn't loaded to redis
+    """
+    redis = ConnectionPool.get_connection()
+    p = redis.pipeline()
+    p.exists(SESSION_CHANNELS_LOADED_KEY)
+    p.smembers(key)
+    loaded, channels = p.execute()
+    return channels if loaded else None
+
+
+def load_session_channels(sessions):
+    """Replace all user->sessions and role->sessions sets in redis.
+
+    Sets are rebuilt in a transaction which is retried if they were changed
+    by `update_session_channels` meanwhile, so sessions committed after
+    `sessions` were read aren't lost.
+
+    :param sessions: iterable of (sid, user_id, role_id, impersonated_id),
+        e.g. query. It is iterated again on every retry.
+    """
+    def rebuild(p):
+        # sessions are read after WATCH, so any later change causes retry
+        mapping = {}
+        for sid, user_id, role_id, impersonated_id in sessions:
+            for key in _session_keys(user_id, role_id, impersonated_id):
+                mapping.setdefault(key, set()).add(sid)
+        old_keys = p.smembers(SESSION_CHANNELS_INDEX_KEY)
+        p.multi()
+        for key in old_keys:
+            p.delete(key)
+        p.delete(SESSION_CHANNELS_INDEX_KEY)
+        for key, sids in mapping.iteritems():
+            p.sadd(key, *sids)
+            p.sadd(SESSION_CHANNELS_INDEX_KEY, key)
+        p.set(SESSION_CHANNELS_LOADED_KEY, 1)
+
+    redis = ConnectionPool.get_connection()
+    redis.transaction(rebuild, SESSION_CHANNELS_VERSION_KEY)
+
+
+def update_session_channels(added=(), removed=()):
+    """Add and remove sessions to/from sets of users and roles.
+
+    :param added: iterable of (sid, user_id, role_id, impersonated_id)
+    :param removed: iterable of (sid, user_id, role_id, impersonated_id)
+    """
+    redis = ConnectionPool.get_connection()
+    p = redis.pipeline()
+    for sid, user_id, role_id, impersonated_id in removed:
+        for key in _session_keys(user_id, role_id, impersonated_id):
+            p.srem(key, sid)
+    for sid, user_id, role_id, impersonated_id in added:
+        for key in _session_keys(user_id, role_id, impersonated_id):
+            p.sadd(key, sid)
+            p.sadd(SESSION_CHANNELS_INDEX_KEY, key)
+    p.incr(SESSION_CHANNELS_VERSION_KEY)
+    p.execute()
+
+
+def reset_session_channels():
+    """Mapping will be reloaded from db on the next use."""
+    ConnectionPool.get_connection().delete(SESSION_CHANNELS_LOADED_KEY)
+
+
+def _session_keys(user_id, role_id, impersonated_id):
+    keys = [session_channels_key(user_id=user_id),
+            session_channels_key(role_id=role_id)]
+    if impersonated_id is not None:
+        keys.append(session_channels_key(user_id=impersonated_id))
+    return keys
+
+
 def append_offset_to_timezone(tz):
     """Appends offset value to timezone string:
     Europe/London -> Europe/London (+000)
@@ -145,23 +145,32 @@ def catch_error(action, trigger):
     return outer
 
 
-def get_channel_key(conn, key, size=100):
+#: Number of events kept in history of a channel for replay on reconnect
+EVENT_HISTORY_SIZE = 100
+
+# Takes next event id, saves the event to capped history and publishes it.
+# KEYS: id counter, history (sorted set with event ids as scores)
+# ARGV: message without id (json list starting with a comma),
+#       history size, channel
+_SEND_EVENT_SCRIPT = """
+local eid = redis.call('INCR', KEYS[1])
+local message = '[' .. eid .. ARGV[1]
+redis.call('ZADD', KEYS[2], eid, message)
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+redis.call('PUBLISH', ARGV[3], message)
+return eid
+"""
+
+
+def event_history_keys(channel, prefix='SSEEVT'):
     """
-    Gets the last cache id for channel.
-    If keys amount exceeds size truncate keys
-    @param conn: object -> redis connection object
-    @param key: string -> redis key for hash
-    @param size: int -> key amount limit
-    @return: int -> last key incremented by one
+    Gets redis keys of the last event id and events history of the channel
+    @param channel: string -> channel name
+    @param prefix: string -> redis key prefix
+    @return: tuple -> (id key, history key)
     """
-    length = conn.hlen(key)
-    if length == 0:
-        return 1
-    keys = sorted(conn.hkeys(key), key=int)
-    if length >= size:
-        for k in keys[:-(size - 1)]:
-            conn.hdel(key, k)
-    return int(keys[-1]) + 1
+    key = ':'.join([prefix, channel])
+    return key + ':id', key + ':history'
 
 
 def send_event_to_user(event_name, data, user_id, to_file=None,
@@ -169,9 +178,7 @@ def send_event_to_user(event_name, data, user_id, to_file=None,
     """
     Selects all given user sessions and sends list to send_event
     """
-    sessions = [i.id for i in SessionData.query.filter(
-        (SessionData.user_id == user_id) |
-        (SessionData.impersonated_id == user_id))]
+    sessions = SessionData.get_channels(user_id=user_id)
     send_event(event_name, data, to_file, sessions, prefix)
 
 
@@ -180,11 +187,25 @@ def send_event_to_role(event_name, data, role, to_file=None, prefix='SSEEVT'):
     Selects all given role user sessions and sends list to send_event
     """
     if isinstance(role, basestring):
-        role = db.session.query(Role.id).filter(Role.rolename == role).scalar()
-    sessions = [i.id for i in SessionData.query.filter_by(role_id=role)]
+        role = get_role_id(role)
+    sessions = SessionData.get_channels(role_id=role)
     send_event(event_name, data, to_file, sessions, prefix)
 
 
+_role_ids = {}
+
+
+def get_role_id(rolename):
+    """Roles are never renamed, so id of the role is cached in process."""
+    if rolename not in _role_ids:
+        role_id = db.session.query(Role.id).filter(
+            Role.rolename == rolename).scalar()
+        if role_id is None:
+            return None
+        _role_ids[rolename] = role_id
+    return _role_ids[rolename]
+
+
 def resolve_channels(channels, role='Admin'):
     """
     Tries to produce a valid channels list
@@ -196,10 +217,10 @@ def resolve_channels(channels, role='Admin'):
         if has_request_context():
             channels = getattr(session, 'sid', None)
         if channels is None:
-            rid = Role.query.filter_by(rolename=role).first()
+            rid = get_role_id(role)
             if rid is None:
                 return []
-            return [i.id for i in SessionData.query.filter_by(role_id=rid.id)]
+            return SessionData.get_channels(role_id=rid)
     if not isinstance(channels, (tuple, list)):
         return [channels]
     return channels
@@ -217,12 +238,15 @@ def send_event(event_name, data, to_file=None, channels=None, prefix='SSEEVT'):
     """
     channels = resolve_channels(channels)
     conn = ConnectionPool.get_connection()
+    script = conn.register_script(_SEND_EVENT_SCRIPT)
+    # message without id, the id is added by the script
+    message_tail = json.dumps([event_name, data])[1:]
+    pipe = conn.pipeline(transaction=False)
     for channel in channels:
-        key = ':'.join([prefix, channel])
-        channel_key = get_channel_key(conn, key)
-        message = json.dumps([channel_key, event_name, data])
-        conn.hset(key, channel_key, message)
-        conn.publish(channel, message)
+        script(keys=event_history_keys(channel, prefix),
+               args=[', ' + message_tail, EVENT_HISTORY_SIZE, channel],
+               client=pipe)
+    pipe.execute()
     if to_file is not None:
         try:
             to_file.write(data)
@@ -18,6 +18,7 @@
 # You should have received a copy of the GNU General Public License
 # along with KuberDock; if not, see <http://www.gnu.org/licenses/>.
 
+from datetime import datetime
 from distutils.util import strtobool
 
 from kubedock.exceptions import APIError
@@ -34,6 +35,32 @@ def extbool(value):
     raise TypeError('Invalid type. Must be bool or string')
 
 
+def comma_separated_list(value):
+    """String with comma separated values (or list of strings) to list."""
+    if isinstance(value, basestring):
+        return [item.strip() for item in value.split(',') if item.strip()]
+    return list(value)
+
+
+def utc_datetime(value):
+    """Unix timestamp or ISO 8601 string ("2000-01-20T12:34:56Z") to naive
+    UTC datetime.
+    """
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.utcfromtimestamp(float(value))
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Invalid date: {0}'.format(value))
+
+
 def get_user(username):
     user = User.get(username)
     if user is None:
@@ -25,10 +25,11 @@ import pytz
 
 from kubedock.constants import DOMAINNAME_LENGTH
 from kubedock import certificate_utils
+from kubedock.settings import STATS_BATCH_MAX_PODS
 from kubedock.users import User
 from OpenSSL import crypto
 
-from .coerce import extbool, get_user
+from .coerce import comma_separated_list, extbool, get_user, utc_datetime
 
 PATH_LENGTH = 512
 
@@ -893,3 +894,42 @@ owner_mandatory_schema = {
     'required': True,
     'nullable': False
 }
+
+pods_list_schema = {
+    'limit': {'coerce': int, 'min': 1, 'required': False},
+    'offset': {'coerce': int, 'min': 0, 'required': False},
+    'sort': {
+        'type': 'string',
+        'allowed': ['name', '-name', 'status', '-status', 'id', '-id'],
+        'required': False,
+    },
+    'status': {
+        'type': 'list',
+        'coerce': comma_separated_list,
+        'allowed': ['running', 'stopped', 'pending', 'succeeded', 'failed',
+                    'unpaid', 'preparing', 'stopping', 'deleting'],
+        'required': False,
+    },
+    'fields': {
+        'type': 'list',
+        'coerce': comma_separated_list,
+        'schema': {'type': 'string'},
+        'required': False,
+    },
+}
+
+stats_range_schema = {
+    'start': {'coerce': utc_datetime, 'required': False},
+    'end': {'coerce': utc_datetime, 'required': False},
+    # length of aggregation interval, in seconds
+    'resolution': {'coerce': int, 'min': 1, 'required': False},
+}
+
+pods_stats_schema = dict(stats_range_schema, ids={
+    'type': 'list',
+    'coerce': comma_separated_list,
+    'schema': {'type': 'string'},
+    'minlength': 1,
+    'maxlength': STATS_BATCH_MAX_PODS,
+    'required': True,
+})